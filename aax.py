@@ -0,0 +1,367 @@
+import hashlib
+import mmap
+import struct
+import sys
+from array import array
+
+from startup import lazy_import
+
+# Only loaded once a file is decrypted in-process
+cryptography = lazy_import("cryptography")
+
+# Audible's fixed key, the same one ffmpeg uses for -activation_bytes
+FIXED_KEY = bytes.fromhex("77214d4b196a87cd520045fd20a51d67")
+DRM_BLOB_SIZE = 56
+# Sample data is decrypted in batches of about this many bytes
+BATCH_BYTES = 4 << 20
+# AudioSampleEntry fields before its child boxes (reserved, data ref, version, channels, rate...)
+AUDIO_ENTRY_FIELDS = 28
+
+class AaxError(Exception):
+    """The file could not be decrypted."""
+
+class UnsupportedFile(AaxError):
+    """The file is not laid out the way this engine expects; ffmpeg may still handle it."""
+
+class NotStreamable(UnsupportedFile):
+    """The sample table comes after the audio, so the file can't be decrypted as it arrives.
+
+    `head` holds the bytes already read from the stream.
+    """
+
+    def __init__(self, message, head):
+        super().__init__(message)
+        self.head = head
+
+def available():
+    return cryptography is not None
+
+# --- Box parsing ---
+
+def _children(buf, start, end):
+    """Yield (type, offset, size, header_size) for the boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, offset)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", buf, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise AaxError(f"corrupt {box_type.decode('latin-1')} box at byte {offset}")
+        yield box_type, offset, size, header
+        offset += size
+
+def _find(buf, box, box_type):
+    _, offset, size, header = box
+    return next((b for b in _children(buf, offset + header, offset + size) if b[0] == box_type), None)
+
+def _path(buf, box, *types):
+    for box_type in types:
+        if box is None:
+            return None
+        box = _find(buf, box, box_type)
+    return box
+
+def _payload(box):
+    _, offset, size, header = box
+    return offset + header, offset + size
+
+def _be_array(typecode, buf, start, count):
+    values = array(typecode)
+    values.frombytes(buf[start:start + count * values.itemsize])
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+class Layout:
+    """Where the encrypted audio track's samples and DRM boxes live in an AAX/AAXC file."""
+
+    def __init__(self, ftyp, entry_offset, adrm, samples):
+        self.ftyp = ftyp                  # (offset, size) of the ftyp box
+        self.entry_offset = entry_offset  # offset of the 'aavd' sample entry
+        self.adrm = adrm                  # box tuple of the 'adrm' box, or None (AAXC)
+        self.samples = samples            # [(offset, size)] in file order
+
+def sample_table(buf, stbl):
+    """(offset, size) of every sample described by an stbl box."""
+    stsz = _find(buf, stbl, b"stsz")
+    stsc = _find(buf, stbl, b"stsc")
+    stco = _find(buf, stbl, b"stco") or _find(buf, stbl, b"co64")
+    if not (stsz and stsc and stco):
+        raise UnsupportedFile("missing sample table boxes")
+
+    start, _ = _payload(stsz)
+    fixed_size, count = struct.unpack_from(">II", buf, start + 4)
+    sizes = [fixed_size] * count if fixed_size else _be_array("I", buf, start + 12, count)
+
+    start, _ = _payload(stco)
+    (chunk_count,) = struct.unpack_from(">I", buf, start + 4)
+    chunks = _be_array("Q" if stco[0] == b"co64" else "I", buf, start + 8, chunk_count)
+
+    start, _ = _payload(stsc)
+    (run_count,) = struct.unpack_from(">I", buf, start + 4)
+    runs = [struct.unpack_from(">II", buf, start + 8 + 12 * i) for i in range(run_count)]
+
+    samples = []
+    for i, (first_chunk, per_chunk) in enumerate(runs):
+        last_chunk = runs[i + 1][0] - 1 if i + 1 < len(runs) else chunk_count
+        for chunk in range(first_chunk - 1, last_chunk):
+            offset = chunks[chunk]
+            for _ in range(per_chunk):
+                if len(samples) == count:
+                    return samples
+                size = sizes[len(samples)]
+                samples.append((offset, size))
+                offset += size
+    if len(samples) != count:
+        raise AaxError(f"sample table describes {len(samples)} of {count} samples")
+    return samples
+
+def read_layout(buf):
+    top = list(_children(buf, 0, len(buf)))
+    ftyp = next((b for b in top if b[0] == b"ftyp"), None)
+    moov = next((b for b in top if b[0] == b"moov"), None)
+    if moov is None:
+        raise AaxError("missing moov box")
+    if any(b[0] == b"moof" for b in top):
+        raise UnsupportedFile("fragmented files are not supported")
+
+    for trak in _children(buf, *_payload(moov)):
+        if trak[0] != b"trak":
+            continue
+        stbl = _path(buf, trak, b"mdia", b"minf", b"stbl")
+        stsd = stbl and _find(buf, stbl, b"stsd")
+        if not stsd:
+            continue
+        entry_offset = _payload(stsd)[0] + 8
+        size, entry_type = struct.unpack_from(">I4s", buf, entry_offset)
+        if entry_type != b"aavd":
+            continue
+        adrm = next((b for b in _children(buf, entry_offset + 8 + AUDIO_ENTRY_FIELDS, entry_offset + size)
+                     if b[0] == b"adrm"), None)
+        samples = sample_table(buf, stbl)
+        if any(b[0] < a[0] for a, b in zip(samples, samples[1:])):
+            samples.sort()
+        if any(a[0] + a[1] > b[0] for a, b in zip(samples, samples[1:])):
+            raise AaxError("overlapping samples")
+        return Layout(ftyp and ftyp[1:3], entry_offset, adrm, samples)
+    raise UnsupportedFile("no encrypted (aavd) audio track")
+
+# --- Keys ---
+
+def _sha1(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+def _cbc_decrypt(key, iv, data):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+def _ecb_decryptor(key):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    return Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+
+def file_key(adrm_payload, activation_bytes):
+    """(key, iv) for the sample data, derived from the adrm box like ffmpeg's mov demuxer."""
+    if len(adrm_payload) < 8 + DRM_BLOB_SIZE + 4 + 20:
+        raise AaxError("adrm box too short")
+    blob = adrm_payload[8:8 + DRM_BLOB_SIZE]
+    checksum = adrm_payload[8 + DRM_BLOB_SIZE + 4:8 + DRM_BLOB_SIZE + 24]
+
+    activation = bytes.fromhex(activation_bytes)
+    intermediate_key = _sha1(FIXED_KEY, activation)
+    intermediate_iv = _sha1(FIXED_KEY, intermediate_key, activation)
+    if _sha1(intermediate_key[:16], intermediate_iv[:16]) != checksum:
+        raise AaxError("[aax] mismatch in checksums!")
+
+    # Only whole blocks are encrypted
+    whole = DRM_BLOB_SIZE & ~15
+    output = _cbc_decrypt(intermediate_key[:16], intermediate_iv[:16], blob[:whole]) + blob[whole:]
+    if output[:4] != activation[::-1]:
+        raise AaxError("[aax] error in drm blob decryption!")
+    key = output[8:24]
+    iv = _sha1(output[26:42], key, FIXED_KEY)[:16]
+    return key, iv
+
+# --- Decryption ---
+
+def _sample_key(buf, layout, activation_bytes, key, iv):
+    """The voucher's (key, iv) if given, else the ones derived from the adrm box."""
+    if key is not None:
+        return key, iv
+    if layout.adrm is None:
+        raise AaxError("no adrm box; AAXC files need the key and iv from their voucher")
+    if not activation_bytes:
+        raise AaxError("activation bytes required")
+    start, end = _payload(layout.adrm)
+    return file_key(buf[start:end], activation_bytes)
+
+def _decrypt_region(decrypt_blocks, iv, buf, batch):
+    """The file bytes from the first to the last sample of `batch`, decrypted.
+
+    Every sample is its own AES-CBC message starting from the same IV, with any
+    trailing partial block left in the clear. The whole batch goes through one ECB
+    call, and the CBC chaining is applied with a single big-integer XOR.
+    """
+    start = batch[0][0]
+    region = bytearray(buf[start:batch[-1][0] + batch[-1][1]])
+    spans = [(offset - start, size & ~15) for offset, size in batch if size >= 16]
+    if not spans:
+        return region
+    cipher_parts, chain_parts = [], []
+    for offset, whole in spans:
+        data = region[offset:offset + whole]
+        cipher_parts.append(data)
+        chain_parts.append(iv)
+        chain_parts.append(data[:-16])
+    ciphertext = b"".join(cipher_parts)
+    plain = (int.from_bytes(decrypt_blocks(ciphertext), "big") ^ int.from_bytes(b"".join(chain_parts), "big")
+             ).to_bytes(len(ciphertext), "big")
+
+    pos = 0
+    for offset, whole in spans:
+        region[offset:offset + whole] = plain[pos:pos + whole]
+        pos += whole
+    return region
+
+def decrypt_file(source, target, activation_bytes=None, key=None, iv=None, progress=None):
+    """Write a decrypted copy of an AAX/AAXC file to `target`.
+
+    The container is kept as is, so chapters, tags and cover art carry over; only
+    the audio samples are decrypted, the sample entry becomes plain 'mp4a' and the
+    DRM box is blanked. AAX files need `activation_bytes`; AAXC files need the
+    `key` and `iv` from their voucher. `progress(fraction)` is called as data is
+    written.
+    """
+    if not available():
+        raise UnsupportedFile("the 'cryptography' package is not installed")
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        layout = read_layout(buf)
+        key, iv = _sample_key(buf, layout, activation_bytes, key, iv)
+        decrypt_blocks = _ecb_decryptor(key).update
+
+        total = len(buf)
+        pos = 0
+        with open(target, "wb") as out:
+            samples = layout.samples
+            first = 0
+            while first < len(samples):
+                # Batches of consecutive samples up to BATCH_BYTES of file data
+                limit = samples[first][0] + BATCH_BYTES
+                last = first + 1
+                while last < len(samples) and samples[last][0] < limit:
+                    last += 1
+                batch = samples[first:last]
+                out.write(buf[pos:batch[0][0]])
+                out.write(_decrypt_region(decrypt_blocks, iv, buf, batch))
+                pos = batch[-1][0] + batch[-1][1]
+                first = last
+                if progress:
+                    progress(pos / total)
+            out.write(buf[pos:])
+            _mark_decrypted(out, layout)
+        if progress:
+            progress(1.0)
+
+def _mark_decrypted(out, layout):
+    """Turn the header written to `out` into a plain M4B's."""
+    # Same sizes everywhere, so no sample offsets move
+    out.seek(layout.entry_offset + 4)
+    out.write(b"mp4a")
+    if layout.adrm is not None:
+        _, offset, size, header = layout.adrm
+        out.seek(offset + 4)
+        out.write(b"free")
+        # Blank the DRM blob too, after either size of box header
+        out.seek(offset + header)
+        out.write(b"\0" * (size - header))
+    if layout.ftyp is not None:
+        out.seek(layout.ftyp[0] + 8)
+        out.write(b"M4B ")
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise AaxError(f"stream ended {size - len(data)} bytes early")
+    return data
+
+def read_head(stream):
+    """Read the top-level boxes up to the end of moov from `stream`.
+
+    Raises NotStreamable if the audio (mdat) comes first.
+    """
+    head = bytearray()
+    while True:
+        header = stream.read(8)
+        head += header
+        if len(header) < 8:
+            raise AaxError("missing moov box")
+        size, box_type = struct.unpack(">I4s", header)
+        if size == 1:
+            extended = _read_exactly(stream, 8)
+            head += extended
+            (size,) = struct.unpack(">Q", extended)
+            rest = size - 16
+        else:
+            rest = size - 8
+        if size == 0 or rest < 0:
+            raise NotStreamable("box without a size before moov", bytes(head))
+        if box_type == b"mdat":
+            raise NotStreamable("audio data before moov", bytes(head))
+        head += _read_exactly(stream, rest)
+        if box_type == b"moov":
+            return head
+
+def decrypt_stream(stream, target, activation_bytes=None, key=None, iv=None, progress=None, total=None):
+    """Like decrypt_file, but reads the encrypted file once, front to back, from `stream`.
+
+    `stream.read(n)` returns n bytes, or fewer only at the end. Works for files
+    with moov before mdat, the layout Audible serves; anything else raises
+    NotStreamable before `target` is created. `total` is the expected size, for
+    `progress`.
+    """
+    if not available():
+        raise UnsupportedFile("the 'cryptography' package is not installed")
+    head = read_head(stream)
+    layout = read_layout(head)
+    if layout.samples and layout.samples[0][0] < len(head):
+        raise NotStreamable("samples inside the header", bytes(head))
+    key, iv = _sample_key(head, layout, activation_bytes, key, iv)
+    decrypt_blocks = _ecb_decryptor(key).update
+
+    with open(target, "wb") as out:
+        out.write(head)
+        pos = len(head)
+        samples = layout.samples
+        first = 0
+        while first < len(samples):
+            limit = samples[first][0] + BATCH_BYTES
+            last = first + 1
+            while last < len(samples) and samples[last][0] < limit:
+                last += 1
+            start = samples[first][0]
+            while pos < start:
+                pos += out.write(_read_exactly(stream, min(BATCH_BYTES, start - pos)))
+            end = samples[last - 1][0] + samples[last - 1][1]
+            region = _read_exactly(stream, end - start)
+            # Offsets relative to the region just read
+            batch = [(offset - start, size) for offset, size in samples[first:last]]
+            out.write(_decrypt_region(decrypt_blocks, iv, region, batch))
+            pos = end
+            first = last
+            if progress and total:
+                progress(min(1.0, pos / total))
+        while True:
+            data = stream.read(BATCH_BYTES)
+            if not data:
+                break
+            out.write(data)
+        _mark_decrypted(out, layout)
+    if progress:
+        progress(1.0)
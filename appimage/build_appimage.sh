@@ -25,7 +25,7 @@ cp /usr/local/bin/ffmpeg AppDir/usr/bin/
 cp /usr/local/bin/ffprobe AppDir/usr/bin/
 
 # Configure Python plugin via environment variables
-export PIP_INSTALL="audible-cli tqdm"
+export PIP_INSTALL="audible-cli tqdm cryptography"
 export PYTHON_VERSION=3.11
 
 # Run linuxdeploy with python plugin
@@ -38,6 +38,29 @@ linuxdeploy --appdir AppDir \
 # Copy our application code into the bundled python environment
 cp /build/main.py AppDir/usr/bin/main.py
 cp /build/process_library.py AppDir/usr/bin/process_library.py
+cp /build/state_db.py AppDir/usr/bin/state_db.py
+cp /build/library_sync.py AppDir/usr/bin/library_sync.py
+cp /build/library_reader.py AppDir/usr/bin/library_reader.py
+cp /build/downloads.py AppDir/usr/bin/downloads.py
+cp /build/metrics.py AppDir/usr/bin/metrics.py
+cp /build/aax.py AppDir/usr/bin/aax.py
+cp /build/converters.py AppDir/usr/bin/converters.py
+cp /build/daemon.py AppDir/usr/bin/daemon.py
+cp /build/subprocesses.py AppDir/usr/bin/subprocesses.py
+cp /build/naming.py AppDir/usr/bin/naming.py
+cp /build/planner.py AppDir/usr/bin/planner.py
+cp /build/scheduler.py AppDir/usr/bin/scheduler.py
+cp /build/fingerprints.py AppDir/usr/bin/fingerprints.py
+cp /build/streaming.py AppDir/usr/bin/streaming.py
+cp /build/profiles.py AppDir/usr/bin/profiles.py
+cp /build/library_layout.py AppDir/usr/bin/library_layout.py
+cp /build/startup.py AppDir/usr/bin/startup.py
+cp /build/audible_api.py AppDir/usr/bin/audible_api.py
+cp /build/leases.py AppDir/usr/bin/leases.py
+
+# The AppImage is read-only, so Python could never cache bytecode for our modules itself
+# and would compile them on every launch; hashes are not checked since the sources never change
+AppDir/usr/bin/python3.11 -m compileall -q -l --invalidation-mode unchecked-hash AppDir/usr/bin
 
 # Create the entry point wrapper
 # In the AppImage, usr/bin is in the PATH
@@ -1,37 +1,47 @@
 import os
 import sys
 import subprocess
-import time
-import shutil
 from pathlib import Path
 
-# Add parent directory to sys.path to import process_library
+# In the AppImage the modules sit next to this file; in the repo, one directory up
 current_dir = Path(__file__).parent.resolve()
-sys.path.append(str(current_dir.parent))
+if not (current_dir / "process_library.py").exists():
+    sys.path.append(str(current_dir.parent))
+
+try:
+    import startup
+except ImportError:
+    print("Error: Could not import process_library.")
+    sys.exit(1)
+
+# Before the other imports, so they are timed too
+PROFILE_STARTUP = "--profile-startup"
+if PROFILE_STARTUP in sys.argv:
+    sys.argv.remove(PROFILE_STARTUP)
+    startup.enable()
 
 try:
     import process_library
+    import library_sync
+    import subprocesses
 except ImportError:
-    # In the AppImage, process_library might be in the same dir or site-packages
-    try:
-        import process_library
-    except ImportError:
-        print("Error: Could not import process_library.")
-        sys.exit(1)
+    print("Error: Could not import process_library.")
+    sys.exit(1)
+startup.mark("imports")
+
+def ask(prompt):
+    # Time at a prompt is the user's, not startup's
+    with startup.waiting():
+        return input(prompt).strip()
 
 def run_command(cmd, check=True, capture_output=False):
-    try:
-        result = subprocess.run(
-            cmd, 
-            check=check, 
-            text=True, 
-            capture_output=capture_output
-        )
-        return result
-    except subprocess.CalledProcessError as e:
-        if check:
-            raise e
-        return e
+    # Interactive (browser login), so no timeout and the terminal stays attached
+    pipe = subprocess.PIPE if capture_output else None
+    with startup.waiting():
+        result = subprocesses.run(cmd, "audible", timeout=None, stdin=None, stdout=pipe, stderr=pipe)
+    if check:
+        result.check_returncode()
+    return result
 
 def main():
     print("----------------------------------------------------------------")
@@ -60,7 +70,23 @@ def main():
     
     print("\nPlease enter the profile name you want to use.")
     print("If you have already logged in, enter the same name as before.")
-    profile_name = input("Profile Name [default]: ").strip() or "default"
+    print("To process several logged-in accounts together, enter their names separated by commas, or 'all'.")
+    profile_name = ask("Profile Name [default]: ") or "default"
+
+    # "all" is profiles.ALL_PROFILES, spelled out so single-profile runs never import profiles
+    if profile_name.strip() == "all" or "," in profile_name:
+        import profiles
+        try:
+            names = profiles.resolve_profiles(profile_name, config_dir)
+        except ValueError as e:
+            print(f"Error: {e}. Log in to each profile on its own first.")
+            sys.exit(1)
+        print(f"\n--- PROCESSING PROFILES: {', '.join(names)} ---")
+        # Syncs each profile's library, merges them and downloads every title once
+        profiles.process_profiles(names, pending_only=True)
+        startup.first_work("run finished")
+        print("\nDONE!")
+        return
 
     # Check if profile exists in config
     profile_exists = False
@@ -76,7 +102,7 @@ def main():
     else:
         print(f"Profile '{profile_name}' not found. Starting login process...")
         print("\nPlease enter your country code (us, uk, de, fr, ca, it, au, in, jp, es, br)")
-        country_code = input("Country Code [us]: ").strip() or "us"
+        country_code = ask("Country Code [us]: ") or "us"
         
         auth_file = f"{profile_name}.json"
         
@@ -107,33 +133,27 @@ def main():
             print("Error: Login failed.")
             sys.exit(1)
 
+    startup.mark("login check")
+
     # --- Step 2: Prepare Library ---
     print("\n--- STEP 2: PREPARING LIBRARY ---")
     
-    library_file = "library.json"
-    if os.path.exists(library_file):
-        print(f"{library_file} found. Skipping export.")
-    else:
-        print("Exporting library to list...")
-        try:
-            cmd = [
-                "audible", "-P", profile_name, 
-                "library", "export", 
-                "--format", "json", 
-                "--output", library_file
-            ]
-            run_command(cmd)
-        except subprocess.CalledProcessError:
-            print("Error: Failed to export library.")
-            sys.exit(1)
+    # First run exports everything; later runs only fetch new purchases
+    if library_sync.sync_library(profile_name) is None:
+        print("Error: Failed to export library.")
+        sys.exit(1)
+
+    startup.mark("library sync")
 
     # --- Step 3: Process Books ---
     print("\n--- STEP 3: PROCESSING BOOKS ---")
     print("Starting smart download & convert process...")
     
     # Call the processing logic
-    # We pass the profile name to the function
-    process_library.process_books(profile_name)
+    # Only books that aren't converted or failed yet need checking
+    process_library.process_books(profile_name, pending_only=True)
+    # Still report when every book was already done
+    startup.first_work("run finished")
 
     print("\nDONE!")
 
@@ -19,9 +19,20 @@ ls -l "$AUDIBLE_CONFIG_DIR/config.toml"
 echo ""
 echo "Please enter the profile name you want to use."
 echo "If you have already logged in, enter the same name as before."
+echo "To process several logged-in accounts together, enter their names separated by commas, or 'all'."
 read -p "Profile Name [default]: " PROFILE_NAME
 PROFILE_NAME=${PROFILE_NAME:-default}
 
+if [ "$PROFILE_NAME" = "all" ] || [[ "$PROFILE_NAME" == *,* ]]; then
+    # Syncs each profile's library, merges them and downloads every title once
+    echo "Running: python process_library.py --profiles \"$PROFILE_NAME\" --pending-only"
+    python3 /usr/local/bin/process_library.py --profiles "$PROFILE_NAME" --pending-only
+    STATUS=$?
+    echo ""
+    echo "DONE!"
+    exit $STATUS
+fi
+
 # Check if profile exists in config.toml
 if grep -q "\[profile.$PROFILE_NAME\]" "$AUDIBLE_CONFIG_DIR/config.toml"; then
     echo "Profile '$PROFILE_NAME' found in config. Skipping login."
@@ -67,16 +78,8 @@ echo ""
 echo "----------------------------------------------------------------"
 echo "STEP 2: PREPARING LIBRARY"
 echo "----------------------------------------------------------------"
-echo "Checking for existing library export..."
-if [ -f "library.json" ]; then
-    echo "library.json found. Skipping export."
-else
-    echo "Exporting library to list..."
-    audible -P "$PROFILE_NAME" library export --format json --output library.json
-fi
-
-if [ ! -f "library.json" ]; then
-    echo "Error: Failed to export library."
+# First run exports everything; later runs only fetch new purchases
+if ! python3 /usr/local/bin/library_sync.py "$PROFILE_NAME"; then
     exit 1
 fi
 
@@ -85,9 +88,9 @@ echo "----------------------------------------------------------------"
 echo "STEP 3: PROCESSING BOOKS"
 echo "----------------------------------------------------------------"
 echo "Starting smart download & convert process..."
-echo "Running: python process_library.py \"$PROFILE_NAME\""
+echo "Running: python process_library.py \"$PROFILE_NAME\" --pending-only"
 
-python3 /usr/local/bin/process_library.py "$PROFILE_NAME"
+python3 /usr/local/bin/process_library.py "$PROFILE_NAME" --pending-only
 
 echo ""
 echo "DONE!"
\ No newline at end of file
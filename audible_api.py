@@ -0,0 +1,102 @@
+import json
+import os
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+from startup import lazy_import
+
+# The package audible-cli is built on; loaded only once a call needs it
+audible = lazy_import("audible")
+httpx = lazy_import("httpx")
+
+CONFIG_FILE = "config.toml"
+# Fields of `audible library export --format json` that can be rebuilt from the API
+EXPORT_GROUPS = "contributors,product_attrs,product_desc,series"
+PAGE_SIZE = 1000
+
+_enabled = True
+
+class ApiUnavailable(Exception):
+    """The call can't be made in-process; the audible CLI is used instead."""
+
+def available():
+    return audible is not None and httpx is not None and tomllib is not None
+
+def set_enabled(value):
+    """--audible-cli: fork the audible CLI for every call, as before."""
+    global _enabled
+    _enabled = value
+
+def in_process():
+    """Whether activation bytes, library exports and AAX downloads go through the API."""
+    return _enabled and available()
+
+def config_dir():
+    return os.environ.get("AUDIBLE_CONFIG_DIR") or os.path.join(os.path.expanduser("~"), ".audible")
+
+def load_auth(profile_name, directory=None):
+    """The audible Authenticator of an audible-cli profile."""
+    path = os.path.join(directory or config_dir(), CONFIG_FILE)
+    try:
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    except (OSError, ValueError) as e:
+        raise ApiUnavailable(f"could not read {path}: {e}")
+    profile = config.get("profile", {}).get(profile_name) or {}
+    if not profile.get("auth_file"):
+        raise ApiUnavailable(f"no auth file for profile '{profile_name}' in {path}")
+    try:
+        return audible.Authenticator.from_file(os.path.join(directory or config_dir(), profile["auth_file"]))
+    except Exception as e:
+        # Password-protected auth files among others; audible-cli can still prompt for those
+        raise ApiUnavailable(f"could not load the auth file: {e}")
+
+def activation_bytes(profile_name):
+    """The profile's activation bytes as 8 hex digits, like `audible activation-bytes`."""
+    auth = load_auth(profile_name)
+    try:
+        value = auth.get_activation_bytes()
+    except Exception as e:
+        raise ApiUnavailable(str(e) or type(e).__name__)
+    return value if isinstance(value, str) else None
+
+def export_item(item):
+    """A library item in the shape `audible library export --format json` writes it."""
+    row = {"asin": item.get("asin"), "title": item.get("title")}
+    if item.get("subtitle"):
+        row["subtitle"] = item["subtitle"]
+    for key in ("authors", "narrators"):
+        if item.get(key):
+            row[key] = ", ".join(p.get("name", "") for p in item[key])
+    if item.get("series"):
+        row["series_title"] = item["series"][0].get("title")
+        row["series_sequence"] = item["series"][0].get("sequence")
+    for key in ("runtime_length_min", "release_date", "purchase_date"):
+        if item.get(key) is not None:
+            row[key] = item[key]
+    return row
+
+def export_library(profile_name, output, start_date=None):
+    """Write the profile's library (purchases since `start_date` only, if given) to `output` as JSON."""
+    auth = load_auth(profile_name)
+    params = {"response_groups": EXPORT_GROUPS, "num_results": PAGE_SIZE}
+    if start_date:
+        params["purchased_after"] = start_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    items = []
+    try:
+        with audible.Client(auth=auth) as client:
+            page = 1
+            while True:
+                batch = client.get("library", page=page, **params).get("items") or []
+                items.extend(export_item(i) for i in batch if i.get("asin"))
+                if len(batch) < PAGE_SIZE:
+                    break
+                page += 1
+    except Exception as e:
+        raise ApiUnavailable(str(e) or type(e).__name__)
+    with open(output, "w") as f:
+        json.dump(items, f, indent=4)
+    return len(items)
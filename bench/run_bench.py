@@ -0,0 +1,222 @@
+"""Offline benchmark for process_library.py, rename_books.py and rename_from_library.py.
+
+Builds synthetic libraries and directory trees, puts the stub audible/ffmpeg/ffprobe
+from bench/stubs on PATH and reports wall time, subprocess count, peak RSS and
+(with --strace) syscalls for each tool. No network or Audible account needed.
+
+    python bench/run_bench.py --sizes 100,1000 --latency 0.01
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+sys.path.insert(0, STUBS_DIR)
+
+from mp4box import audio_file
+
+DEFAULT_SIZES = "100,1000,10000,50000"
+PROFILE = "bench"
+
+# Runs the tool in-process and records its own peak RSS on exit
+BOOTSTRAP = """
+import atexit, os, resource, runpy, sys
+atexit.register(lambda: open(os.environ["BENCH_RSS_FILE"], "w").write(
+    str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+WORDS = ("shadow", "river", "empire", "last", "silent", "garden", "night", "iron", "glass",
+         "winter", "crown", "storm", "lost", "city", "star", "secret", "fire", "ocean")
+
+def synthetic_library(size, seed=0):
+    rng = random.Random(seed)
+    books = []
+    for i in range(size):
+        # Fixed-width number so no title is a substring of another after normalization
+        title = " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 4))) + f" Vol {i:06d}"
+        book = {
+            "asin": f"B{i:09d}",
+            "title": title,
+            "subtitle": rng.choice(["", "A Novel", "Unabridged"]),
+            "authors": ", ".join(f"Author{rng.randint(0, size // 5 + 1)} Surname" for _ in range(rng.randint(1, 2))),
+            "narrators": f"Narrator{rng.randint(0, 200)}",
+            "series_title": f"{rng.choice(WORDS).capitalize()} Saga" if i % 3 == 0 else "",
+            "series_sequence": str(i % 7 + 1) if i % 3 == 0 else "",
+            "runtime_length_min": rng.randint(60, 1500),
+            "purchase_date": f"20{10 + i % 14:02d}-{i % 12 + 1:02d}-01T00:00:00Z",
+            "genres": "Fiction, Fantasy",
+            "release_date": "2015-05-05",
+        }
+        books.append(book)
+    return books
+
+def sanitize(name):
+    return re.sub(r'_{2,}', '_', re.sub(r'[^a-zA-Z0-9\-\.]', '_', str(name))).strip('_')
+
+def write_m4b(path, book):
+    with open(path, "wb") as f:
+        f.write(audio_file({"title": book["title"], "artist": book["authors"], "album": book["title"]},
+                           mdat_size=1024, brand=b"M4B "))
+
+def build_process_tree(root, books, pending):
+    """A working dir where all but `pending` books already have a converted M4B."""
+    os.makedirs(os.path.join(root, ".audible"))
+    with open(os.path.join(root, "library.json"), "w") as f:
+        json.dump(books, f, indent=4)
+    for book in books[pending:]:
+        parts = [sanitize(book["authors"]), sanitize(book["series_title"]), sanitize(book["title"]), book["asin"]]
+        write_m4b(os.path.join(root, "_".join(p for p in parts if p) + ".m4b"), book)
+
+def build_rename_tree(root, books):
+    """An audiobooks dir of legacy names: half carry the ASIN, half only the title."""
+    audiobooks = os.path.join(root, "audiobooks")
+    os.makedirs(audiobooks)
+    with open(os.path.join(audiobooks, "library.json"), "w") as f:
+        json.dump(books, f, indent=4)
+    for i, book in enumerate(books):
+        if i % 2:
+            name = f"{book['title']} ({book['asin']}).m4b"
+        else:
+            name = f"{book['title']}-LC_64_22050_stereo.m4b"
+        write_m4b(os.path.join(audiobooks, name.replace("/", "_")), book)
+
+def parse_strace_total(path):
+    """Total call count from an `strace -c` summary."""
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[-1] == "total":
+                    return int(fields[3])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def run_tool(script, args, cwd, env, strace=False):
+    log = os.path.join(cwd, ".bench_calls.log")
+    rss_file = os.path.join(cwd, ".bench_rss")
+    for path in (log, rss_file):
+        try: os.remove(path)
+        except OSError: pass
+    env = dict(env, BENCH_LOG=log, BENCH_RSS_FILE=rss_file)
+    cmd = [sys.executable, "-c", BOOTSTRAP, os.path.join(REPO_DIR, script)] + args
+    trace = None
+    if strace:
+        trace = os.path.join(cwd, ".bench_strace")
+        cmd = ["strace", "-f", "-c", "-o", trace] + cmd
+
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        print(f"  {script} exited with {result.returncode}:\n{result.stderr[-2000:]}")
+
+    calls = collections.Counter()
+    try:
+        with open(log) as f:
+            calls.update(line.strip() for line in f if line.strip())
+    except OSError:
+        pass
+    try:
+        with open(rss_file) as f:
+            peak_rss_kb = int(f.read())
+    except (OSError, ValueError):
+        peak_rss_kb = None
+    return {
+        "wall_s": round(wall, 3),
+        "subprocesses": sum(calls.values()),
+        "by_program": dict(calls),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1) if peak_rss_kb else None,
+        "syscalls": parse_strace_total(trace) if trace else None,
+        "returncode": result.returncode,
+    }
+
+def bench_size(size, args, env):
+    books = synthetic_library(size, seed=args.seed)
+    pending = min(args.max_pending, max(1, int(size * args.pending)))
+    results = []
+
+    def measure(label, script, tool_args, cwd, run_env):
+        print(f"  {label}...", flush=True)
+        row = run_tool(script, tool_args, cwd, run_env)
+        if args.strace:
+            # Traced separately so strace overhead doesn't skew the wall time
+            row["syscalls"] = run_tool(script, tool_args, cwd, run_env, strace=True)["syscalls"]
+        row.update(tool=label, titles=size)
+        results.append(row)
+
+    with tempfile.TemporaryDirectory(prefix=f"bench_{size}_", dir=args.workdir) as tmp:
+        root = os.path.join(tmp, "process")
+        os.makedirs(root)
+        build_process_tree(root, books, pending)
+        process_env = dict(env, AUDIBLE_CONFIG_DIR=os.path.join(root, ".audible"))
+        measure(f"process_library (first run, {pending} new)", "process_library.py", [PROFILE], root, process_env)
+        measure("process_library (resume)", "process_library.py", [PROFILE], root, process_env)
+        measure("process_library --pending-only", "process_library.py", [PROFILE, "--pending-only"], root,
+                process_env)
+        shutil.rmtree(root)
+
+        for script in ("rename_books.py", "rename_from_library.py"):
+            root = os.path.join(tmp, script[:-3])
+            build_rename_tree(root, books)
+            name = script[:-3]
+            measure(f"{name} (first run)", script, [], root, env)
+            measure(f"{name} (second run)", script, [], root, env)
+            shutil.rmtree(root)
+    return results
+
+def print_table(results):
+    print(f"\n{'titles':>7}  {'tool':<44}{'wall':>9}{'procs':>8}{'rss MB':>8}{'syscalls':>11}")
+    for r in results:
+        syscalls = str(r["syscalls"]) if r["syscalls"] is not None else "-"
+        rss = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] else "-"
+        failed = "" if r["returncode"] == 0 else "  (failed)"
+        print(f"{r['titles']:>7}  {r['tool']:<44}{r['wall_s']:>8.2f}s{r['subprocesses']:>8}{rss:>8}{syscalls:>11}{failed}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark with stub audible/ffmpeg/ffprobe.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Comma-separated library sizes (default {DEFAULT_SIZES})")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds each stub call sleeps; override per program with BENCH_LATENCY_AUDIBLE etc.")
+    parser.add_argument("--pending", type=float, default=0.01,
+                        help="Fraction of titles process_library has to download and convert (default 0.01)")
+    parser.add_argument("--max-pending", type=int, default=500, help="Upper bound on that number of titles")
+    parser.add_argument("--strace", action="store_true", help="Also count syscalls with strace -f -c (extra run)")
+    parser.add_argument("--workdir", default=None, help="Where to build the synthetic trees (default: system temp)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    if args.strace and not shutil.which("strace"):
+        parser.error("--strace needs strace on PATH")
+
+    env = dict(os.environ, PATH=STUBS_DIR + os.pathsep + os.environ.get("PATH", ""))
+    if args.latency:
+        env["BENCH_LATENCY"] = str(args.latency)
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        print(f"Benchmarking {size} titles...", flush=True)
+        results += bench_size(size, args, env)
+    print_table(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "latency": args.latency, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
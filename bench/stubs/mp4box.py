@@ -0,0 +1,52 @@
+import json
+import os
+import struct
+import time
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def mvhd(seconds, timescale=1000):
+    # version 0: flags, creation, modification, timescale, duration, then the rest of the box
+    return box(b"mvhd", struct.pack(">I II II", 0, 0, 0, timescale, int(seconds * timescale)) + b"\0" * 80)
+
+def audio_file(tags=None, seconds=3600, mdat_size=64 * 1024, brand=b"aax "):
+    """A small but structurally valid MP4: ftyp, optional JSON tags in a free box, moov/mvhd, mdat."""
+    data = box(b"ftyp", brand + b"\0\0\0\0")
+    if tags:
+        data += box(b"free", json.dumps(tags).encode("utf-8"))
+    data += box(b"moov", mvhd(seconds))
+    data += box(b"mdat", b"\0" * mdat_size)
+    return data
+
+def read_tags(path):
+    """Tags stored by audio_file(), or {}."""
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return {}
+            size, box_type = struct.unpack(">I4s", header)
+            if box_type == b"free":
+                try:
+                    return json.loads(f.read(size - 8))
+                except ValueError:
+                    return {}
+            if box_type in (b"moov", b"mdat") or size < 8:
+                return {}
+            offset += size
+            f.seek(offset)
+
+def stub_start(program):
+    """Log the call to $BENCH_LOG and sleep for the configured latency."""
+    log = os.environ.get("BENCH_LOG")
+    if log:
+        fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, (program + "\n").encode())
+        finally:
+            os.close(fd)
+    latency = os.environ.get(f"BENCH_LATENCY_{program.upper()}") or os.environ.get("BENCH_LATENCY")
+    if latency:
+        time.sleep(float(latency))
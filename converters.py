@@ -0,0 +1,98 @@
+import re
+import subprocess
+
+import aax
+import subprocesses
+from downloads import read_duration
+
+# ffmpeg's mov demuxer reports wrong activation bytes as a checksum mismatch
+DECRYPTION_ERROR_RE = re.compile(r'mismatch in checksum|activation.?bytes|decrypt', re.IGNORECASE)
+
+def decryption_args(activation_bytes, voucher=None):
+    """ffmpeg options for an AAX file (activation bytes) or an AAXC file (voucher key and iv)."""
+    if voucher:
+        key, iv = voucher
+        return ["-audible_key", key, "-audible_iv", iv]
+    return ["-activation_bytes", activation_bytes]
+
+def report_errors(result, prefix=""):
+    text = (result.stderr or "").strip()
+    if text:
+        print("\n".join(prefix + line for line in text.splitlines()))
+    return text
+
+class FFmpegConverter:
+    """Decrypt and remux with an `ffmpeg -c copy` subprocess."""
+    name = "ffmpeg"
+
+    def convert(self, source_file, target, activation_bytes, progress=None, show_stats=False, voucher=None,
+                prefix=""):
+        """Returns (success, errors); errors is ffmpeg's stderr, or None when it went to the terminal.
+
+        `voucher` is the (key, iv) of an AAXC file, used instead of the activation
+        bytes. `progress(fraction)` is fed from ffmpeg's -progress output; with
+        `show_stats` ffmpeg prints its own stats line instead. Error lines start
+        with `prefix`, which tells the titles apart when several convert at once.
+        """
+        io_args = decryption_args(activation_bytes, voucher) + ["-i", source_file, "-c", "copy", target]
+        if show_stats and not progress:
+            cmd = ["ffmpeg", "-y", "-hide_banner", "-stats", "-loglevel", "error"] + io_args
+            result = subprocesses.run(cmd, "ffmpeg")
+            # A timeout is no hint that the activation bytes are wrong
+            return result.returncode == 0, "" if result.timed_out else None
+
+        duration = read_duration(source_file) if progress else None
+        if not duration:
+            cmd = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "error"] + io_args
+            result = subprocesses.run(cmd, "ffmpeg", stderr=subprocess.PIPE)
+            return result.returncode == 0, report_errors(result, prefix)
+
+        def on_line(line):
+            if line.startswith("out_time_ms="):
+                try:
+                    progress(min(1.0, int(line.split("=")[1]) / 1e6 / duration))
+                except ValueError:
+                    pass
+
+        cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-progress", "pipe:1"] + io_args
+        result = subprocesses.run(cmd, "ffmpeg", stderr=subprocess.PIPE, on_line=on_line)
+        return result.returncode == 0, report_errors(result, prefix)
+
+class NativeConverter:
+    """Decrypt in-process with the aax module; no subprocess per title."""
+    name = "native"
+
+    def convert(self, source_file, target, activation_bytes, progress=None, show_stats=False, voucher=None,
+                prefix=""):
+        key, iv = (bytes.fromhex(v) for v in voucher) if voucher else (None, None)
+        try:
+            aax.decrypt_file(source_file, target, activation_bytes, key=key, iv=iv, progress=progress)
+            return True, ""
+        except (aax.AaxError, OSError) as e:
+            print(f"{prefix}{e}")
+            return False, str(e)
+
+class AutoConverter:
+    """The in-process engine when it can handle a file, ffmpeg otherwise."""
+    name = "auto"
+
+    def __init__(self):
+        self.native = NativeConverter()
+        self.ffmpeg = FFmpegConverter()
+
+    def convert(self, source_file, target, activation_bytes, progress=None, show_stats=False, voucher=None,
+                prefix=""):
+        if aax.available():
+            success, errors = self.native.convert(source_file, target, activation_bytes, progress=progress,
+                                                  voucher=voucher, prefix=prefix)
+            # Wrong activation bytes fail the same way in ffmpeg; let the caller refresh them
+            if success or DECRYPTION_ERROR_RE.search(errors):
+                return success, errors
+            print(f"    {prefix}Falling back to ffmpeg for {source_file}...")
+        return self.ffmpeg.convert(source_file, target, activation_bytes, progress=progress,
+                                   show_stats=show_stats, voucher=voucher, prefix=prefix)
+
+CONVERTERS = {c.name: c for c in (FFmpegConverter, NativeConverter, AutoConverter)}
+
+def get_converter(name="ffmpeg"):
+    return CONVERTERS[name]()
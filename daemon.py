@@ -0,0 +1,375 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import struct
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import library_layout
+import library_sync
+import metrics
+import process_library
+import subprocesses
+from library_reader import read_books
+from naming import LAYOUT_FLAT
+from state_db import CONVERTED, FAILED, PENDING, M4B, SOURCE
+
+DEFAULT_INTERVAL = 6 * 3600
+# Failed titles are retried after this long, doubling with every failure up to MAX_RETRY_DELAY
+RETRY_DELAY = 3600
+MAX_RETRY_DELAY = 7 * 24 * 3600
+# Wait this long after a file event so a burst of them starts a single pass
+SETTLE_SECONDS = 2.0
+
+# inotify(7) event bits
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+class DirectoryWatcher:
+    """Calls on_change(name, present) as files appear in or vanish from a directory.
+
+    Uses inotify through libc. Where that is not available `available` is False and
+    the caller has to rescan the directory itself.
+    """
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
+
+    def __init__(self, path, on_change):
+        self.on_change = on_change
+        self.fd = None
+        self._stop = threading.Event()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, os.fsencode(path), self.MASK) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"File watching unavailable ({e}); rescanning the directory every pass instead.")
+            return
+        self.fd = fd
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def available(self):
+        return self.fd is not None
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 1.0)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                start = offset + INOTIFY_EVENT.size
+                name = data[start:start + length].rstrip(b"\0")
+                offset = start + length
+                if name:
+                    self.on_change(os.fsdecode(name), bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+
+    def close(self):
+        if self.fd is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        os.close(self.fd)
+        self.fd = None
+
+def file_kind(name):
+    if name.startswith(".") or name.endswith("_tmp.m4b"):
+        return None
+    if name.endswith(".m4b"):
+        return M4B
+    if name.endswith((".aax", ".aaxc")):
+        return SOURCE
+    return None
+
+class LibraryDaemon:
+    """Keeps the library, file indexes and activation bytes loaded between passes.
+
+    A pass syncs library.json when the poll interval is up, then processes the
+    titles that are new, unfinished, or failed and due for another try. New
+    AAX/AAXC files in the directory start a pass early.
+    """
+
+    def __init__(self, profile_name, interval=DEFAULT_INTERVAL, health_port=None, converter="ffmpeg",
+                 aaxc_policy=process_library.AAXC_CONVERT, metrics_file=metrics.METRICS_FILE,
+                 retry_delay=RETRY_DELAY, scheduler=None, stream=False, leases=None):
+        self.profile_name = profile_name
+        self.interval = interval
+        self.health_port = health_port
+        self.converter = converter
+        self.aaxc_policy = aaxc_policy
+        self.metrics_file = metrics_file
+        self.retry_delay = retry_delay
+        self.scheduler = scheduler
+        self.stream = stream
+        self.leases = leases
+        self.stop = threading.Event()
+        self.wake = threading.Event()
+        self.books = []
+        self.library_mtime = None
+        self.dropped = set()  # source files that appeared in the directory
+        self.ws = None
+        self.watcher = None
+        self.server = None
+        self.started = time.time()
+        self.state = "starting"
+        self.current = None
+        self.passes = 0
+        self.next_sync = 0.0
+        self.next_retry = float("inf")
+        self.last_sync = None
+        self.last_pass = None
+        self.last_error = None
+
+    # --- File events ---
+
+    def on_file_change(self, name, present):
+        kind = file_kind(name)
+        if kind is None:
+            return
+        index = self.ws.m4b_index if kind == M4B else self.ws.source_index
+        if present:
+            index.add(name)
+            # Downloads of our own are already recorded, with their ASIN, and need no extra pass
+            if self.ws.state.add_file(name, kind) and kind == SOURCE:
+                self.dropped.add(name)
+                self.wake.set()
+        else:
+            index.discard(name)
+            self.ws.state.forget_file(name)
+
+    def rescan(self):
+        """Stand-in for file events: bring the indexes in line with a directory listing."""
+        m4b_files = library_layout.list_m4b_files("", self.ws.layout)
+        for kind, index, files in ((M4B, self.ws.m4b_index, m4b_files),
+                                   (SOURCE, self.ws.source_index, process_library.list_source_files())):
+            for path in set(self.ws.state.paths(kind)) - set(files):
+                self.ws.state.forget_file(path)
+            for path in index.sync(files):
+                if self.ws.state.add_file(path, kind) and kind == SOURCE:
+                    self.dropped.add(path)
+
+    # --- Passes ---
+
+    def sync(self):
+        self.state = "syncing"
+        with metrics.stage("library_sync") as m:
+            delta = library_sync.sync_library(self.profile_name)
+            m["ok"] = delta is not None
+        self.next_sync = time.time() + self.interval
+        if delta is None:
+            self.last_error = "library export failed"
+            print("Error: Failed to export library; keeping the previous copy.")
+            if self.books or not os.path.exists(library_sync.LIBRARY_FILE):
+                return
+        else:
+            self.last_sync = time.time()
+        # A full export that only dropped titles leaves the delta empty but rewrites the file
+        mtime = os.path.getmtime(library_sync.LIBRARY_FILE)
+        if delta or not self.books or mtime != self.library_mtime:
+            with metrics.stage("load_library"):
+                self.books = read_books(library_sync.LIBRARY_FILE)
+            self.library_mtime = mtime
+
+    def dropped_sources(self, book):
+        """Source files for `book` put in the directory since the last pass, rather than downloaded by us."""
+        matches = self.ws.find_files(SOURCE, book.get("asin"), book.get("title"))
+        # The event for one of our downloads can beat download_sources recording its ASIN
+        return [f for f in matches if f in self.dropped and (self.ws.state.file(f) or {}).get("asin") is None]
+
+    def due_books(self):
+        """Books that are not converted, skipping failures still inside their retry delay."""
+        ws = self.ws
+        ws.statuses = ws.state.statuses()
+        failed = ws.state.failed_books()
+        now = time.time()
+        self.next_retry = float("inf")
+        due = []
+        for book in self.books:
+            asin = book.get("asin")
+            status = ws.statuses.get(asin)
+            if status == CONVERTED:
+                continue
+            if status == FAILED:
+                retries, updated_at = failed.get(asin, (1, 0))
+                delay = min(MAX_RETRY_DELAY, self.retry_delay * 2 ** max(0, retries - 1))
+                dropped = self.dropped_sources(book)
+                if dropped:
+                    # prepare_book retries failed titles that have source files
+                    self.dropped.difference_update(dropped)
+                    due.append(book)
+                    continue
+                retry_at = (updated_at or 0) + delay
+                if now < retry_at:
+                    self.next_retry = min(self.next_retry, retry_at)
+                    continue
+                ws.state.set_status(asin, PENDING)
+                ws.statuses[asin] = PENDING
+            due.append(book)
+        return due
+
+    def run_pass(self, sync):
+        if sync:
+            self.sync()
+        if not self.books:
+            return
+        # The watch only covers the top directory; M4Bs of the other layouts live below it
+        if not self.watcher.available or self.ws.layout != LAYOUT_FLAT:
+            self.rescan()
+
+        self.state = "processing"
+        books = self.ws.scheduler.order(self.due_books())
+        if books:
+            print(f"\n{len(books)} of {len(self.books)} books need work.")
+        for book in books:
+            if self.stop.is_set():
+                break
+            self.current = {"asin": book.get("asin"), "title": book.get("title"), "since": time.time()}
+            try:
+                if process_library.process_book(self.ws, book) == process_library.LEASED:
+                    # Another node is on it; look again once its lease could have run out
+                    self.next_retry = min(self.next_retry, time.time() + self.leases.ttl)
+            except Exception as e:
+                self.last_error = f"{book.get('title')}: {e}"
+                print(f"  Error processing '{book.get('title')}': {e}")
+            finally:
+                self.current = None
+        if not self.leases:
+            try: os.rmdir(process_library.STAGING_DIR)
+            except OSError: pass
+        self.passes += 1
+        self.last_pass = time.time()
+
+    def run(self):
+        metrics.configure(self.metrics_file, tool="process_library --daemon")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.request_stop)
+        if self.health_port:
+            self.server = start_health_server(self, self.health_port)
+            print(f"Health endpoint on http://127.0.0.1:{self.server.server_port}/health")
+
+        self.sync()
+        if not self.books:
+            print("Error: library.json could not be loaded.")
+            self.shutdown()
+            return 1
+        print(f"Found {len(self.books)} books in library.")
+        self.ws = process_library.open_workspace(self.profile_name, self.books, threaded=True,
+                                                 converter=self.converter, aaxc_policy=self.aaxc_policy,
+                                                 scheduler=self.scheduler, stream=self.stream, leases=self.leases)
+        self.watcher = DirectoryWatcher(".", self.on_file_change)
+
+        sync = False
+        while not self.stop.is_set():
+            try:
+                self.run_pass(sync)
+            except subprocesses.Cancelled:
+                print("Aborted the current title.")
+                break
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error: {e}")
+            self.state = "idle"
+            if self.stop.is_set():
+                break
+            woke = self.wake.wait(max(0.0, min(self.next_sync, self.next_retry) - time.time()))
+            if woke:
+                self.stop.wait(SETTLE_SECONDS)
+                self.wake.clear()
+            sync = time.time() >= self.next_sync
+        self.shutdown()
+        return 0
+
+    def request_stop(self, signum=None, frame=None):
+        if self.stop.is_set():
+            # Asked twice: don't wait for the current title
+            subprocesses.cancel_all()
+            return
+        print("\nStopping after the current title (signal again to abort it)...")
+        self.stop.set()
+        self.wake.set()
+
+    def shutdown(self):
+        self.state = "stopping"
+        if self.watcher:
+            self.watcher.close()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.ws:
+            self.ws.close()
+        metrics.finish()
+
+    # --- Health ---
+
+    def health(self):
+        """The /health document; healthy while library syncs keep succeeding."""
+        now = time.time()
+        stale_after = 2 * self.interval + 600
+        healthy = not self.stop.is_set() and (
+            self.last_sync is None and now - self.started < stale_after
+            or self.last_sync is not None and now - self.last_sync < stale_after)
+        counts = Counter(self.ws.state.statuses().values()) if self.ws else {}
+        return {
+            "healthy": healthy,
+            "state": self.state,
+            "uptime_s": round(now - self.started, 1),
+            "passes": self.passes,
+            "current": self.current,
+            "last_sync": self.last_sync,
+            "last_pass": self.last_pass,
+            "next_sync": self.next_sync,
+            "last_error": self.last_error,
+            "library_books": len(self.books),
+            "books": dict(counts),
+            "watching": bool(self.watcher and self.watcher.available),
+            "downloads_paused": self.ws.scheduler.paused if self.ws else None,
+        }
+
+class HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        daemon = self.server.daemon
+        if self.path == "/health":
+            body = daemon.health()
+            code = 200 if body["healthy"] else 503
+        elif self.path == "/metrics":
+            body, code = metrics.summary(), 200
+        else:
+            body, code = {"error": "not found"}, 404
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_health_server(daemon, port):
+    """Serve /health and /metrics on localhost only."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), HealthHandler)
+    server.daemon_threads = True
+    server.daemon = daemon
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_daemon(profile_name, **options):
+    return LibraryDaemon(profile_name, **options).run()
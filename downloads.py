@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import struct
+import time
+
+MANIFEST_FILE = "manifest.json"
+SOURCE_EXTENSIONS = (".aax", ".aaxc")
+# An in-process download in progress; renamed to the source file once all of it arrived
+PART_SUFFIX = ".part"
+# Boxes every AAX/AAXC file needs before ffmpeg can do anything with it
+REQUIRED_BOXES = {b"moov", b"mdat"}
+CHECKSUM_SPAN = 1 << 20
+
+def scan_boxes(path):
+    """Walk the top-level MP4 boxes of `path`.
+
+    Returns (boxes, file_size) where boxes is a list of (type, offset, size). The
+    last box may extend past the end of a truncated file.
+    """
+    file_size = os.path.getsize(path)
+    boxes = []
+    with open(path, "rb") as f:
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, box_type = struct.unpack(">I4s", f.read(8))
+            if size == 1:
+                if offset + 16 > file_size:
+                    boxes.append((box_type, offset, None))
+                    break
+                (size,) = struct.unpack(">Q", f.read(8))
+            elif size == 0:
+                size = file_size - offset
+            if size < 8:
+                boxes.append((box_type, offset, None))
+                break
+            boxes.append((box_type, offset, size))
+            offset += size
+    return boxes, file_size
+
+def read_duration(path):
+    """Duration in seconds from the moov/mvhd box, or None.
+
+    Only reads box headers and the mvhd payload: a few small reads, no matter how
+    large the file is.
+    """
+    try:
+        boxes, file_size = scan_boxes(path)
+        moov = next((b for b in boxes if b[0] == b"moov" and b[2]), None)
+        if moov is None:
+            return None
+        _, moov_offset, moov_size = moov
+        with open(path, "rb") as f:
+            offset = moov_offset + 8
+            end = min(moov_offset + moov_size, file_size)
+            while offset + 8 <= end:
+                f.seek(offset)
+                size, box_type = struct.unpack(">I4s", f.read(8))
+                if box_type == b"mvhd":
+                    version = f.read(4)[0]
+                    if version == 1:
+                        timescale, duration = struct.unpack(">16xIQ", f.read(28))
+                    else:
+                        timescale, duration = struct.unpack(">8xII", f.read(16))
+                    return duration / timescale if timescale else None
+                if size < 8:
+                    return None
+                offset += size
+    except (OSError, struct.error, IndexError):
+        return None
+    return None
+
+def expected_size(path):
+    """Total size implied by the box headers seen so far (a lower bound for partial files)."""
+    try:
+        boxes, file_size = scan_boxes(path)
+    except OSError:
+        return None
+    if not boxes or boxes[-1][2] is None:
+        return None
+    box_type, offset, size = boxes[-1]
+    return max(file_size, offset + size)
+
+def verify_source(path):
+    """Check that an AAX/AAXC file is complete. Returns (ok, reason)."""
+    try:
+        boxes, file_size = scan_boxes(path)
+    except OSError as e:
+        return False, f"unreadable: {e}"
+    if not boxes:
+        return False, "empty or not an MP4 container"
+    box_type, offset, size = boxes[-1]
+    if size is None:
+        return False, f"corrupt box header at byte {offset}"
+    if offset + size > file_size:
+        return False, f"truncated: {file_size} of {offset + size} bytes"
+    if offset + size < file_size:
+        return False, f"incomplete box header at byte {offset + size}"
+    missing = REQUIRED_BOXES - {b[0] for b in boxes}
+    if missing:
+        return False, "missing " + ", ".join(sorted(m.decode() for m in missing)) + " box"
+    return True, ""
+
+def partial_file(staging_dir):
+    """The partial file an interrupted in-process download left in `staging_dir`, or None.
+
+    Its size, not the manifest, says where to resume: a killed run can't update the manifest.
+    """
+    try:
+        names = sorted(n for n in os.listdir(staging_dir) if n.endswith(SOURCE_EXTENSIONS[0] + PART_SUFFIX))
+    except OSError:
+        return None
+    return os.path.join(staging_dir, names[0]) if names else None
+
+def voucher_path(source):
+    return source.rsplit('.', 1)[0] + ".voucher"
+
+def read_voucher(source):
+    """(key, iv) hex strings from the voucher audible-cli saves next to an AAXC file, or None."""
+    try:
+        with open(voucher_path(source), "r") as f:
+            data = json.load(f)
+        license_response = data["content_license"]["license_response"]
+        key, iv = license_response["key"], license_response["iv"]
+        if len(bytes.fromhex(key)) != 16 or len(bytes.fromhex(iv)) != 16:
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return key, iv
+
+def quick_checksum(path, span=CHECKSUM_SPAN):
+    """BLAKE2b of the size plus the first and last `span` bytes."""
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(span))
+        if size > span:
+            f.seek(max(span, size - span))
+            h.update(f.read(span))
+    return h.hexdigest()
+
+class DownloadManifest:
+    """Sidecar manifest for one book's staging directory.
+
+    Records each downloaded file's size, the size its box headers promise and, once
+    verified, a quick checksum, so an interrupted run can tell what is already good.
+    """
+
+    def __init__(self, staging_dir):
+        self.path = os.path.join(staging_dir, MANIFEST_FILE)
+        self.data = {"attempts": 0, "files": {}}
+        try:
+            with open(self.path, "r") as f:
+                loaded = json.load(f)
+            if isinstance(loaded, dict) and isinstance(loaded.get("files"), dict):
+                self.data = loaded
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def attempts(self):
+        return self.data.get("attempts", 0)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def start_attempt(self):
+        self.data["attempts"] = self.attempts + 1
+        self.data["started_at"] = time.time()
+        self.save()
+
+    def record(self, name, path, verified, reason=""):
+        size = os.path.getsize(path)
+        entry = {"size": size, "expected_size": expected_size(path), "verified": verified}
+        if verified:
+            entry["checksum"] = quick_checksum(path)
+        else:
+            entry["reason"] = reason
+        self.data["files"][name] = entry
+        self.save()
+        return entry
+
+    def record_partial(self, name, received, total):
+        """Note how far the download to the partial file `name` got, so the next attempt resumes there."""
+        self.data["files"][name] = {"size": received, "expected_size": total or None, "verified": False,
+                                    "reason": "interrupted"}
+        self.save()
+
+    def forget(self, name):
+        if self.data["files"].pop(name, None) is not None:
+            self.save()
+
+    def is_verified(self, name, path):
+        """True if `name` was verified before and still has the same checksum."""
+        entry = self.data["files"].get(name)
+        if not entry or not entry.get("verified"):
+            return False
+        try:
+            return entry.get("size") == os.path.getsize(path) and entry.get("checksum") == quick_checksum(path)
+        except OSError:
+            return False
+
+    def progress(self):
+        """(bytes on disk, expected bytes) over the files seen so far."""
+        done = sum(e.get("size") or 0 for e in self.data["files"].values())
+        expected = sum(e.get("expected_size") or e.get("size") or 0 for e in self.data["files"].values())
+        return done, expected
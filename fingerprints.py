@@ -0,0 +1,238 @@
+import argparse
+import filecmp
+import hashlib
+import os
+import re
+import struct
+import sys
+from collections import defaultdict
+
+import library_layout
+from naming import part_number
+from state_db import StateDB, STATE_FILE, M4B
+
+# Bytes hashed from each end of a file; with the size that tells converted books apart
+HASH_SPAN = 64 * 1024
+ASIN_RE = re.compile(r'[A-Z0-9]{10}')
+# Audible's ASIN atom in moov/udta/meta/ilst; ffmpeg-style freeform tags are checked too
+ASIN_ATOM = b"CDEK"
+FREEFORM_ATOM = b"----"
+
+def fingerprint(path):
+    """A fast partial content hash: size plus BLAKE2b of the first and last HASH_SPAN bytes."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(struct.pack(">Q", size))
+        h.update(f.read(HASH_SPAN))
+        if size > HASH_SPAN:
+            f.seek(max(HASH_SPAN, size - HASH_SPAN))
+            h.update(f.read(HASH_SPAN))
+    return f"{size:x}-{h.hexdigest()}"
+
+def _children(f, start, end):
+    """(type, payload start, end) for the boxes between `start` and `end`, reading only headers."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", f.read(8))
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, min(offset + size, end)
+        offset += size
+
+def _data_value(f, start, end):
+    for box_type, payload, box_end in _children(f, start, end):
+        if box_type == b"data":
+            f.seek(payload + 8)  # type and locale
+            return f.read(min(box_end - payload - 8, 256)).decode("utf-8", "replace").strip("\0 ")
+    return None
+
+def embedded_asin(path):
+    """The ASIN tag stored in an M4B's metadata, or None."""
+    try:
+        with open(path, "rb") as f:
+            box = (0, os.fstat(f.fileno()).st_size)
+            # meta is a full box: 4 bytes of version and flags before its children
+            for wanted, skip in ((b"moov", 0), (b"udta", 0), (b"meta", 4), (b"ilst", 0)):
+                found = next(((s, e) for t, s, e in _children(f, *box) if t == wanted), None)
+                if found is None:
+                    return None
+                box = (found[0] + skip, found[1])
+            for item, start, end in _children(f, *box):
+                value = None
+                if item == ASIN_ATOM:
+                    value = _data_value(f, start, end)
+                elif item == FREEFORM_ATOM:
+                    names = [b for b in _children(f, start, end) if b[0] == b"name"]
+                    if names:
+                        f.seek(names[0][1] + 4)
+                        if f.read(names[0][2] - names[0][1] - 4).strip(b"\0").upper() == b"ASIN":
+                            value = _data_value(f, start, end)
+                if value and ASIN_RE.fullmatch(value):
+                    return value
+    except (OSError, struct.error):
+        return None
+    return None
+
+def load_fingerprints(filepaths, state):
+    """{filepath: (digest, embedded ASIN or None)} for files that could be read.
+
+    Cached in the state store keyed by name, size, mtime and inode, like the tag
+    cache, so unchanged files are only read once.
+    """
+    cache = state.fingerprint_cache()
+    result = {}
+    rows = []
+    for filepath in filepaths:
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        key = os.path.relpath(filepath, state.base_dir or ".")
+        stamp = (st.st_size, st.st_mtime, st.st_ino)
+        cached = cache.get(key)
+        if cached and cached[:3] == stamp:
+            result[filepath] = cached[3:]
+            continue
+        try:
+            digest = fingerprint(filepath)
+        except OSError:
+            continue
+        result[filepath] = (digest, embedded_asin(filepath))
+        rows.append((key,) + stamp + result[filepath])
+    if rows:
+        state.store_fingerprints(rows)
+    return result
+
+def file_identity(path, state):
+    """(ASIN in the file's tags, fingerprint) from the state store while it is current, else (tag, None)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    row = state.fingerprint(os.path.relpath(path, state.base_dir or "."))
+    if row and (row["size"], row["mtime"], row["inode"]) == (st.st_size, st.st_mtime, st.st_ino):
+        return row["asin"], row["digest"]
+    return embedded_asin(path), None
+
+def claims_asin(path, asin, state):
+    """Whether a file is `asin` going by its content: True or False, or None for a file without an ASIN tag."""
+    tagged, digest = file_identity(path, state)
+    if digest and state.digest_recorded_for(digest, asin):
+        return True
+    if tagged:
+        return tagged == asin
+    return None
+
+def record_identities(fingerprints, state):
+    """Attribute files to the ASIN in their tags where the state store has none. Returns how many."""
+    count = 0
+    for filepath, (_, asin) in fingerprints.items():
+        path = os.path.relpath(filepath, state.base_dir or ".")
+        if asin and state.owner(path) is None:
+            state.record_file(path, asin, M4B)
+            count += 1
+    return count
+
+def duplicate_groups(fingerprints):
+    """Lists of files with the same fingerprint that are not yet hard links of one file."""
+    by_digest = defaultdict(list)
+    for filepath, (digest, _) in fingerprints.items():
+        by_digest[digest].append(filepath)
+    groups = []
+    for paths in by_digest.values():
+        if len(paths) < 2:
+            continue
+        inodes = set()
+        for p in paths:
+            try:
+                st = os.stat(p)
+                inodes.add((st.st_dev, st.st_ino))
+            except OSError:
+                pass
+        if len(inodes) > 1:
+            groups.append(sorted(paths))
+    return groups
+
+def identity_conflicts(fingerprints, owner_of):
+    """Files claiming the same ASIN (and part) with different content, as {(asin, part): [files]}."""
+    by_identity = defaultdict(dict)
+    for filepath, (digest, asin) in fingerprints.items():
+        asin = asin or owner_of(filepath)
+        if asin:
+            by_identity[(asin, part_number(os.path.basename(filepath)))][digest] = filepath
+    return {key: sorted(files.values()) for key, files in by_identity.items() if len(files) > 1}
+
+def link_duplicates(paths):
+    """Replace every copy in `paths` with a hard link to the oldest one. Returns the bytes freed.
+
+    The partial fingerprint only nominates duplicates; every pair is compared in
+    full before anything is replaced.
+    """
+    keep = min(paths, key=lambda p: (os.path.getmtime(p), p))
+    freed = 0
+    for other in paths:
+        if other == keep or os.path.samefile(keep, other):
+            continue
+        if not filecmp.cmp(keep, other, shallow=False):
+            print(f"  {other} differs from {keep} despite the same fingerprint; left alone.")
+            continue
+        size = os.path.getsize(other)
+        tmp = other + ".dedup"
+        try:
+            os.link(keep, tmp)
+            os.replace(tmp, other)
+        except OSError as e:
+            print(f"  Could not link {other}: {e}")
+            try: os.remove(tmp)
+            except OSError: pass
+            continue
+        print(f"  Linked {other} -> {keep}")
+        freed += size
+    return freed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find duplicate M4B files by content fingerprint.")
+    parser.add_argument("directory", nargs="?", default=".")
+    parser.add_argument("--link", action="store_true",
+                        help="Replace verified duplicates with hard links to one copy")
+    args = parser.parse_args(argv)
+    if not library_layout.check_migration(args.directory):
+        return 1
+    state = StateDB(os.path.join(args.directory, STATE_FILE))
+    files = library_layout.list_m4b_files(args.directory, library_layout.get_layout(state))
+    print(f"Fingerprinting {len(files)} M4B files...")
+    fingerprints = load_fingerprints(files, state)
+    tagged = record_identities(fingerprints, state)
+    if tagged:
+        print(f"  {tagged} files attributed to a book by their ASIN tag.")
+
+    groups = duplicate_groups(fingerprints)
+    wasted = sum(os.path.getsize(g[0]) * (len(g) - 1) for g in groups)
+    print(f"{len(groups)} sets of duplicates ({wasted / 2**20:.1f} MB in extra copies).")
+    freed = 0
+    for paths in groups:
+        print("Duplicates:\n    " + "\n    ".join(paths))
+        if args.link:
+            freed += link_duplicates(paths)
+    if args.link:
+        print(f"Freed {freed / 2**20:.1f} MB.")
+
+    def owner_of(filepath):
+        return state.owner(os.path.relpath(filepath, state.base_dir or "."))
+
+    for (asin, part), paths in sorted(identity_conflicts(fingerprints, owner_of).items()):
+        label = f"{asin} part {part}" if part else asin
+        print(f"Different files for {label}:\n    " + "\n    ".join(paths))
+    state.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
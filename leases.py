@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+# Lease files of the nodes sharing a library directory, one per title being worked on
+LEASE_DIR = ".leases"
+LEASE_SUFFIX = ".lease"
+# Touched with every heartbeat; its mtime is the volume's clock, not this host's
+NODE_SUFFIX = ".node"
+# A lease whose holder hasn't renewed it for this long may be taken over
+DEFAULT_TTL = 300.0
+# The lowest TTL that leaves room for a few missed heartbeats on a slow mount
+MIN_TTL = 20.0
+
+def default_node_id():
+    """Hostname plus PID: unique across the containers and processes sharing a volume."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def read_lease(path):
+    """The contents of a lease file, or {} while it is still being written (or gone)."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+class LeaseTable:
+    """Claims on titles, kept as files in a directory every node can see.
+
+    A lease is created with O_CREAT|O_EXCL, which is atomic on local disks, NFS
+    (v3 and later) and SMB, so at most one node holds a title. A heartbeat thread
+    renews the leases this node holds by touching them; a lease nobody renewed
+    for `ttl` seconds belongs to a node that died or hung, and is taken over by
+    renaming it out of the way. Ages are measured against the volume's clock
+    (the mtime of a file just touched) so hosts don't have to agree on the time.
+
+    A node that is taken over finds out at its next heartbeat or check: `held()`
+    compares the token in the file with its own before it finishes a title.
+    """
+
+    def __init__(self, directory=LEASE_DIR, node=None, ttl=DEFAULT_TTL):
+        self.directory = directory
+        self.node = node or default_node_id()
+        self.ttl = max(MIN_TTL, ttl)
+        self.interval = self.ttl / 4
+        self._held = {}  # key -> token
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def path(self, key):
+        return os.path.join(self.directory, key + LEASE_SUFFIX)
+
+    def _node_path(self):
+        return os.path.join(self.directory, self.node + NODE_SUFFIX)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.volume_time()
+        self._thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the heartbeat and give up every lease still held."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        for key in list(self._held):
+            self.release(key)
+        try: os.remove(self._node_path())
+        except OSError: pass
+
+    def volume_time(self):
+        """The current time on the shared volume's clock."""
+        path = self._node_path()
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with open(path, "w"):
+                pass
+        return os.stat(path).st_mtime
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.volume_time()
+            except OSError:
+                pass
+            with self._lock:
+                held = list(self._held.items())
+            for key, token in held:
+                try:
+                    if read_lease(self.path(key)).get("token", token) == token:
+                        os.utime(self.path(key))
+                        continue
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # The volume is away for now; the lease lives as long as the next heartbeat is in time
+                    print(f"  Warning: Could not renew the lease on {key}: {e}")
+                    continue
+                with self._lock:
+                    if self._held.get(key) != token:
+                        continue  # released in the meantime
+                    del self._held[key]
+                print(f"  Warning: Another node took over the lease on {key}.")
+
+    def acquire(self, key):
+        """Lease `key` for this node. False if another node holds a live lease on it."""
+        if key in self._held:
+            return True
+        path = self.path(key)
+        token = uuid.uuid4().hex
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if not self._take_over(path, token):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"node": self.node, "token": token, "acquired": time.time()}, f)
+            with self._lock:
+                self._held[key] = token
+            return True
+        return False
+
+    def _age(self, path):
+        return self.volume_time() - os.stat(path).st_mtime
+
+    def _take_over(self, path, token):
+        """Move a stale lease at `path` out of the way. True if the lease can be created again."""
+        try:
+            if self._age(path) <= self.ttl:
+                return False
+        except FileNotFoundError:
+            return True
+        stale = f"{path}.{token}.stale"
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            # Another node got there first; creating the lease decides between us
+            return True
+        try:
+            if self._age(stale) <= self.ttl:
+                # Renewed between the check and the rename: hand it back to its holder
+                try: os.link(stale, path)
+                except OSError: pass
+                return False
+            holder = read_lease(stale).get("node", "an unknown node")
+            print(f"  Taking over the lease on {os.path.basename(path)[:-len(LEASE_SUFFIX)]} "
+                  f"from {holder} (not renewed for {self._age(stale):.0f}s).")
+            return True
+        finally:
+            try: os.remove(stale)
+            except OSError: pass
+
+    def held(self, key):
+        """Whether this node still holds the lease on `key`, going by the file itself."""
+        token = self._held.get(key)
+        return token is not None and read_lease(self.path(key)).get("token") == token
+
+    def release(self, key):
+        with self._lock:
+            token = self._held.pop(key, None)
+        if token is not None and read_lease(self.path(key)).get("token") == token:
+            try: os.remove(self.path(key))
+            except OSError: pass
+
+    def live_nodes(self):
+        """The other nodes whose heartbeat is recent enough that they are still working here."""
+        now = self.volume_time()
+        nodes = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return nodes
+        for entry in entries:
+            node = entry.name[:-len(NODE_SUFFIX)]
+            if not entry.name.endswith(NODE_SUFFIX) or node == self.node:
+                continue
+            try:
+                if now - entry.stat().st_mtime <= self.ttl:
+                    nodes.append(node)
+            except OSError:
+                pass
+        return sorted(nodes)
+
+    def holder(self, key):
+        """The node holding a live lease on `key`, or None if it is free or stale."""
+        path = self.path(key)
+        try:
+            if self._age(path) > self.ttl:
+                return None
+        except OSError:
+            return None
+        return read_lease(path).get("node", "another node")
+
+def list_leases(directory=LEASE_DIR):
+    """(key, node, seconds since renewed) for every lease file in `directory`."""
+    table = LeaseTable(directory, node=f"list-{default_node_id()}")
+    try:
+        now = table.volume_time()
+    except OSError:
+        return []
+    leases = []
+    try:
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            if entry.name.endswith(LEASE_SUFFIX):
+                try:
+                    age = now - entry.stat().st_mtime
+                except OSError:
+                    continue
+                node = read_lease(entry.path).get("node", "?")
+                leases.append((entry.name[:-len(LEASE_SUFFIX)], node, age))
+    finally:
+        try: os.remove(table._node_path())
+        except OSError: pass
+    return leases
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show which nodes are working on which titles of a shared library.")
+    parser.add_argument("directory", nargs="?", default=".",
+                        help="Library directory (default: the current one)")
+    parser.add_argument("--ttl", type=float, default=DEFAULT_TTL,
+                        help="Lease lifetime the nodes run with, in seconds, to mark stale leases")
+    args = parser.parse_args(argv)
+
+    directory = os.path.join(args.directory, LEASE_DIR)
+    if not os.path.isdir(directory):
+        print("No leases: no node has worked on this library in shared mode.")
+        return 0
+    leases = list_leases(directory)
+    for key, node, age in leases:
+        print(f"  {key:<12} {node:<32} renewed {age:5.0f}s ago{' (stale)' if age > args.ttl else ''}")
+    print(f"{len(leases)} titles leased.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
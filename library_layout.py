@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+import fingerprints
+from library_reader import read_books
+from naming import LAYOUTS, LAYOUT_ASIN_SHARDS, LAYOUT_DEPTH, LAYOUT_FLAT, layout_path
+from state_db import StateDB, STATE_FILE
+
+# The layout a library directory uses is kept in its state store
+LAYOUT_KEY = "layout"
+# Moves of a migration that has not finished; the tools refuse to run while it exists
+JOURNAL_FILE = ".layout-journal"
+ASIN_RE = re.compile(r'(?=([A-Z0-9]{10}))')
+
+# What became of a journaled move
+MOVED = "moved"
+CONFLICT = "conflict"
+MISSING = "missing"
+
+def get_layout(state):
+    layout = state.get_meta(LAYOUT_KEY, LAYOUT_FLAT)
+    return layout if layout in LAYOUTS else LAYOUT_FLAT
+
+def journal_path(directory=""):
+    return os.path.join(directory, JOURNAL_FILE)
+
+def check_migration(directory=""):
+    """False (after printing why) if a layout migration in `directory` was interrupted."""
+    if not os.path.exists(journal_path(directory)):
+        return True
+    print(f"Error: A layout migration of '{directory or '.'}' did not finish. "
+          f"Run `python library_layout.py {directory or '.'}` to complete it first.")
+    return False
+
+def list_m4b_files(directory="", layout=LAYOUT_FLAT, depth=None):
+    """M4B files under `directory`, as paths joined with it (like glob).
+
+    Only the directory levels `layout` puts books in are read, so a flat library
+    costs one listing. Hidden directories (staging, config) and half-written
+    _tmp.m4b files are skipped.
+    """
+    depth = LAYOUT_DEPTH[layout] if depth is None else depth
+    files = []
+    pending = [("", 0)]
+    while pending:
+        rel, level = pending.pop()
+        try:
+            entries = sorted(os.scandir(os.path.join(directory, rel) or "."), key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            path = os.path.join(rel, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if level < depth:
+                        subdirs.append((path, level + 1))
+                elif entry.name.endswith(".m4b") and not entry.name.endswith("_tmp.m4b") and entry.is_file():
+                    files.append(os.path.join(directory, path) if directory else path)
+            except OSError:
+                pass
+        pending.extend(reversed(subdirs))
+    return files
+
+def make_dirs(directory, path):
+    """Create the directories `path` (relative to `directory`) needs."""
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(os.path.join(directory, parent), exist_ok=True)
+
+def prune_dirs(directory, path):
+    """Remove the directories above `path` that are empty now, up to `directory`."""
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(directory, parent))
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
+
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# --- Migration ---
+
+def identify(directory, path, state, asins):
+    """The ASIN of an M4B: as recorded in the state store, from its tags, or from its name."""
+    asin = state.owner(path) or fingerprints.embedded_asin(os.path.join(directory, path))
+    if asin:
+        return asin
+    return next((m for m in ASIN_RE.findall(os.path.basename(path)) if m in asins), None)
+
+def plan_moves(directory, layout, books, state):
+    """(moves, unidentified) to put every M4B in `directory` where `layout` wants it.
+
+    Files keep their names; only their directory changes. Files that can't be tied
+    to a library book stay where they are, except when flattening. Moves are dicts
+    with `src`, `dst` (relative to `directory`) and `asin`.
+    """
+    by_asin = {b["asin"]: b for b in books if b.get("asin")}
+    moves, unidentified, claimed = [], [], set()
+    for filepath in list_m4b_files(directory, depth=max(LAYOUT_DEPTH.values())):
+        path = os.path.relpath(filepath, directory or ".")
+        asin = identify(directory, path, state, by_asin)
+        book = by_asin.get(asin)
+        if book is None and asin and layout == LAYOUT_ASIN_SHARDS:
+            # Shards only need the ASIN; the author layouts need the library entry
+            book = {"asin": asin}
+        if book is None and layout != LAYOUT_FLAT:
+            unidentified.append(path)
+            continue
+        target = layout_path(book or {}, os.path.basename(path), layout)
+        if target == path:
+            continue
+        if target in claimed:
+            print(f"  Leaving {path}: {target} is claimed by another file.")
+            continue
+        claimed.add(target)
+        moves.append({"src": path, "dst": target, "asin": asin})
+    return moves, unidentified
+
+def write_journal(path, header, moves):
+    """Write the full list of moves durably before the first file is touched."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        for record in [header] + moves:
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(os.path.dirname(path))
+
+def read_journal(path):
+    """(header, moves, indexes of finished moves). A torn last line from a crash is ignored."""
+    header, moves, done = None, [], set()
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if header is None:
+                header = record
+            elif "done" in record:
+                done.add(record["done"])
+            else:
+                moves.append(record)
+    if header is None or LAYOUT_KEY not in header:
+        raise ValueError(f"{path} is not a layout journal")
+    return header, moves, done
+
+def move_file(directory, move):
+    """Carry out one journaled move. Safe to repeat after a crash at any point."""
+    src, dst = move["src"], move["dst"]
+    src_path, dst_path = os.path.join(directory, src), os.path.join(directory, dst)
+    if os.path.lexists(dst_path):
+        if not os.path.lexists(src_path):
+            # Moved by the run that was interrupted, before it could log it
+            return MOVED
+        print(f"  Leaving {src}: {dst} already exists.")
+        return CONFLICT
+    if not os.path.lexists(src_path):
+        print(f"  {src} no longer exists.")
+        return MISSING
+    make_dirs(directory, dst)
+    os.rename(src_path, dst_path)
+    prune_dirs(directory, src)
+    return MOVED
+
+def run_journal(directory, state):
+    """Carry out (or finish) the migration in the journal, then switch the layout and drop the journal."""
+    path = journal_path(directory)
+    header, moves, done = read_journal(path)
+    counts = {MOVED: 0, CONFLICT: 0, MISSING: 0}
+    if done:
+        print(f"Resuming the migration to '{header[LAYOUT_KEY]}': {len(done)} of {len(moves)} moves done.")
+    with open(path, "a") as log:
+        for i, move in enumerate(moves):
+            if i in done:
+                continue
+            result = move_file(directory, move)
+            if result == MOVED:
+                state.rename_file(move["src"], move["dst"], move.get("asin"))
+            counts[result] += 1
+            # Only saves re-checking finished moves on resume; the files themselves are the record
+            log.write(json.dumps({"done": i}) + "\n")
+            log.flush()
+    state.set_meta(LAYOUT_KEY, header[LAYOUT_KEY])
+    os.remove(path)
+    fsync_dir(directory)
+    print(f"Layout is now '{header[LAYOUT_KEY]}': {counts[MOVED]} moved, {counts[CONFLICT]} left because "
+          f"the target exists, {counts[MISSING]} missing.")
+    return counts
+
+def migrate(directory, layout, books, state):
+    """Move the M4B files in `directory` into `layout`, in place."""
+    current = get_layout(state)
+    moves, unidentified = plan_moves(directory, layout, books, state)
+    for path in unidentified:
+        print(f"  Leaving {path}: no library book found for it.")
+    print(f"Moving {len(moves)} files from the '{current}' to the '{layout}' layout...")
+    write_journal(journal_path(directory), {LAYOUT_KEY: layout, "previous": current}, moves)
+    return run_journal(directory, state)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Show or change how M4B files are laid out in a library directory.")
+    parser.add_argument("directory", nargs="?", default=".",
+                        help="Library directory with library_state.db (default: the current one)")
+    parser.add_argument("--layout", choices=LAYOUTS, help="Move the existing files into this layout")
+    parser.add_argument("--library", help="library.json to look books up in (default: the one in DIRECTORY)")
+    args = parser.parse_args(argv)
+
+    directory = "" if args.directory == "." else args.directory
+    state = StateDB(os.path.join(directory, STATE_FILE))
+    try:
+        if os.path.exists(journal_path(directory)):
+            try:
+                header = read_journal(journal_path(directory))[0]
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}")
+                return 1
+            if args.layout and args.layout != header[LAYOUT_KEY]:
+                print(f"Error: Finish the interrupted migration to '{header[LAYOUT_KEY]}' first "
+                      f"(run without --layout).")
+                return 1
+            run_journal(directory, state)
+            return 0
+        if not args.layout:
+            print(f"Layout: {get_layout(state)}")
+            return 0
+        library = args.library or os.path.join(directory, "library.json")
+        try:
+            books = read_books(library)
+        except Exception as e:
+            print(f"Warning: Could not load {library} ({e}); only flat and asin-shards layouts can place files.")
+            books = []
+        migrate(directory, args.layout, books, state)
+    finally:
+        state.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
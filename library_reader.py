@@ -0,0 +1,230 @@
+import json
+import mmap
+import os
+import struct
+
+# The only library fields the tools use; everything else in the export is dropped
+FIELDS = ("asin", "title", "authors", "series_title", "runtime_length_min")
+
+SIDECAR_SUFFIX = ".idx"
+# Bumped with the encodings: an older sidecar is rebuilt instead of misread
+SIDECAR_MAGIC = b"VALIB002"
+# magic, source size, source mtime_ns, record count
+HEADER = struct.Struct("<8sQQI")
+OFFSET = struct.Struct("<Q")
+FLOAT = struct.Struct("<d")
+LENGTH = struct.Struct("<I")
+
+# Field value encodings in the sidecar
+T_NONE, T_STR, T_LIST, T_INT, T_FLOAT = 0, 1, 2, 3, 4
+LIST_SEP = "\x1f"
+
+CHUNK_SIZE = 1 << 20
+
+class Book:
+    """Compact library record. Supports the dict-style access the tools already use."""
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(*(data.get(name) for name in FIELDS))
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in FIELDS else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in FIELDS and getattr(self, key) is not None
+
+    def __repr__(self):
+        return f"Book(asin={self.asin!r}, title={self.title!r})"
+
+def iter_json_array(path, chunk_size=CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array one at a time.
+
+    Only one element (plus a read buffer) is held in memory at once.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+        started = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        while True:
+            # Skip whitespace and separators
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                fill()
+            if pos >= len(buf):
+                raise ValueError(f"{path}: unexpected end of file")
+
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError(f"{path}: expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                    break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+            pos = end
+            yield item
+
+def stream_books(path):
+    """Yield compact Book records straight from a library.json export."""
+    for item in iter_json_array(path):
+        if isinstance(item, dict):
+            yield Book.from_dict(item)
+
+# --- Binary sidecar ---
+
+def _encode(value):
+    if value is None:
+        return bytes([T_NONE])
+    if isinstance(value, bool):
+        value = str(value)
+    if isinstance(value, int):
+        return bytes([T_INT]) + struct.pack("<q", value)
+    if isinstance(value, float):
+        return bytes([T_FLOAT]) + FLOAT.pack(value)
+    if isinstance(value, list):
+        data = LIST_SEP.join(str(v) for v in value).encode("utf-8")
+        return bytes([T_LIST]) + LENGTH.pack(len(data)) + data
+    data = str(value).encode("utf-8")
+    return bytes([T_STR]) + LENGTH.pack(len(data)) + data
+
+def _decode(buf, pos):
+    kind = buf[pos]
+    pos += 1
+    if kind == T_NONE:
+        return None, pos
+    if kind == T_INT:
+        return struct.unpack_from("<q", buf, pos)[0], pos + 8
+    if kind == T_FLOAT:
+        return FLOAT.unpack_from(buf, pos)[0], pos + FLOAT.size
+    (length,) = LENGTH.unpack_from(buf, pos)
+    pos += LENGTH.size
+    text = bytes(buf[pos:pos + length]).decode("utf-8")
+    pos += length
+    if kind == T_LIST:
+        return (text.split(LIST_SEP) if text else []), pos
+    return text, pos
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def write_sidecar(path, books, sidecar_path=None):
+    """Write the compact binary form of `books` next to `path`. Returns the sidecar path."""
+    sidecar_path = sidecar_path or path + SIDECAR_SUFFIX
+    size, mtime_ns = _source_stamp(path)
+    records = [b"".join(_encode(getattr(book, name)) for name in FIELDS) for book in books]
+    tmp = sidecar_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(SIDECAR_MAGIC, size, mtime_ns, len(records)))
+        offset = HEADER.size + OFFSET.size * len(records)
+        for record in records:
+            f.write(OFFSET.pack(offset))
+            offset += len(record)
+        for record in records:
+            f.write(record)
+    os.replace(tmp, sidecar_path)
+    return sidecar_path
+
+class CompactLibrary:
+    """Read-only sequence of Books backed by a memory-mapped sidecar file."""
+
+    def __init__(self, sidecar_path):
+        with open(sidecar_path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.source_size, self.source_mtime_ns, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != SIDECAR_MAGIC:
+            self._map.close()
+            raise ValueError(f"{sidecar_path}: not a library sidecar")
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        (pos,) = OFFSET.unpack_from(self._map, HEADER.size + OFFSET.size * index)
+        values = []
+        for _ in FIELDS:
+            value, pos = _decode(self._map, pos)
+            values.append(value)
+        return Book(*values)
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def close(self):
+        self._map.close()
+
+def open_sidecar(path):
+    """The CompactLibrary for `path` if an up-to-date sidecar exists, else None."""
+    sidecar_path = path + SIDECAR_SUFFIX
+    try:
+        library = CompactLibrary(sidecar_path)
+    except (OSError, ValueError, struct.error):
+        return None
+    try:
+        current = _source_stamp(path)
+    except OSError:
+        current = None
+    if current != (library.source_size, library.source_mtime_ns):
+        library.close()
+        return None
+    return library
+
+def read_books(path, sidecar=True, save_sidecar=True):
+    """Load a library export as compact Book records.
+
+    With `sidecar`, an up-to-date `<path>.idx` is memory-mapped instead of parsing
+    the JSON; otherwise the JSON is streamed and, with `save_sidecar`, the sidecar
+    (re)written for next time. Plans pass save_sidecar=False so they leave every
+    file alone. Raises FileNotFoundError if `path` does not exist.
+    """
+    if sidecar:
+        library = open_sidecar(path)
+        if library is not None:
+            return library
+    books = list(stream_books(path))
+    if sidecar and save_sidecar:
+        try:
+            write_sidecar(path, books)
+        except OSError:
+            pass
+    return books
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import audible_api
+import subprocesses
+from state_db import StateDB, STATE_FILE
+
+LIBRARY_FILE = "library.json"
+WATERMARK_KEY = "library_synced_at"
+# When the whole library was last exported, the only way to see titles that left the account
+FULL_SYNC_KEY = "library_full_sync_at"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Re-request a little history each time; merging by ASIN makes the overlap harmless
+OVERLAP = timedelta(days=2)
+# Incremental exports only list additions, so a full one reconciles removals this often
+FULL_SYNC_AGE = timedelta(days=30)
+
+def export_library(profile_name, output, start_date=None):
+    if audible_api.in_process():
+        try:
+            audible_api.export_library(profile_name, output, start_date)
+            return True
+        except (audible_api.ApiUnavailable, OSError) as e:
+            print(f"In-process library export failed ({e}); using the audible CLI.")
+    cmd = ["audible", "-P", profile_name, "library", "export", "--format", "json", "--output", output]
+    if start_date:
+        cmd += ["--start-date", start_date.strftime(DATE_FORMAT)]
+    result = subprocesses.run(cmd, "audible", stderr=subprocesses.TEE, retries=subprocesses.THROTTLE_RETRIES,
+                              label="Library export")
+    return result.returncode == 0
+
+def read_library(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def write_library(path, books):
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(prefix=".library.", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(books, f, indent=4)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
+
+def merge_library(books, updates):
+    """Merge `updates` into `books` by ASIN. Returns the records that were added or changed."""
+    position = {b.get("asin"): i for i, b in enumerate(books) if b.get("asin")}
+    delta = []
+    for item in updates:
+        asin = item.get("asin")
+        if not asin:
+            continue
+        i = position.get(asin)
+        if i is None:
+            position[asin] = len(books)
+            books.append(item)
+            delta.append(item)
+        elif books[i] != item:
+            books[i] = item
+            delta.append(item)
+    return delta
+
+def watermark_key(library_file, key=WATERMARK_KEY):
+    """Each library file (one per profile in multi-profile runs) is synced up to its own point."""
+    name = os.path.basename(library_file)
+    return key if name == LIBRARY_FILE else f"{key}:{name}"
+
+def read_date(state, key):
+    value = state.get_meta(key)
+    if value:
+        try:
+            return datetime.strptime(value, DATE_FORMAT).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return None
+
+def load_watermark(state, library_file):
+    # library.json from before incremental sync: it is at least as fresh as its mtime
+    return (read_date(state, watermark_key(library_file))
+            or datetime.fromtimestamp(os.path.getmtime(library_file), tz=timezone.utc))
+
+def full_sync_due(state, library_file, now):
+    """The date of the last full export if it is older than FULL_SYNC_AGE; "never" if there was none."""
+    last = read_date(state, watermark_key(library_file, FULL_SYNC_KEY))
+    if last is None:
+        return "never"
+    return last.strftime("%Y-%m-%d") if now - last > FULL_SYNC_AGE else None
+
+def removed_books(old, books):
+    """Records of `old` whose ASIN is no longer in `books`."""
+    kept = {b.get("asin") for b in books}
+    return [b for b in old if b.get("asin") and b.get("asin") not in kept]
+
+def sync_library(profile_name, library_file=LIBRARY_FILE, full=False):
+    """Bring `library_file` up to date and return the books that were added or changed.
+
+    The first sync (or `full=True`) exports the whole library. Later syncs only ask
+    audible for items added since the stored watermark and merge them by ASIN;
+    titles that leave the account (returns, expired loans) don't show up in those,
+    so a full export replaces the file every FULL_SYNC_AGE and drops them.
+    Returns None if the export failed.
+    """
+    state = StateDB(os.path.join(os.path.dirname(library_file), STATE_FILE))
+    started = datetime.now(timezone.utc)
+    try:
+        due = None if full or not os.path.exists(library_file) else full_sync_due(state, library_file, started)
+        if full or due or not os.path.exists(library_file):
+            if due:
+                print(f"Exporting the full library to drop titles that have left the account "
+                      f"(last full export: {due})...")
+            else:
+                print("Exporting full library...")
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(library_file) or ".") as tmpdir:
+                output = os.path.join(tmpdir, "library.json")
+                if not export_library(profile_name, output):
+                    return None
+                books = read_library(output)
+                old = read_library(library_file) if os.path.exists(library_file) else []
+                delta = merge_library(old, books)
+                write_library(library_file, books)
+            removed = removed_books(old, books)
+            if removed:
+                print(f"Dropped {len(removed)} titles no longer in the library: "
+                      f"{', '.join(str(b.get('title') or b['asin']) for b in removed[:5])}"
+                      f"{', ...' if len(removed) > 5 else ''}")
+            state.set_meta(watermark_key(library_file, FULL_SYNC_KEY), started.strftime(DATE_FORMAT))
+        else:
+            since = load_watermark(state, library_file) - OVERLAP
+            print(f"Syncing library changes since {since.strftime(DATE_FORMAT)} (new titles only; titles that "
+                  f"left the account are dropped by the next full export)...")
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(library_file) or ".") as tmpdir:
+                output = os.path.join(tmpdir, "library.json")
+                if not export_library(profile_name, output, start_date=since):
+                    return None
+                updates = read_library(output)
+            books = read_library(library_file)
+            delta = merge_library(books, updates)
+            if delta:
+                write_library(library_file, books)
+        state.set_meta(watermark_key(library_file), started.strftime(DATE_FORMAT))
+        print(f"Library has {len(books)} books ({len(delta)} new or changed).")
+        return delta
+    finally:
+        state.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or incrementally sync library.json.")
+    parser.add_argument("profile_name")
+    parser.add_argument("--library", default=LIBRARY_FILE)
+    parser.add_argument("--full", action="store_true",
+                        help="Re-export the whole library, dropping titles that have left the account")
+    parser.add_argument("--audible-cli", action="store_true",
+                        help="Export with the audible CLI instead of the audible API in-process")
+    args = parser.parse_args()
+    audible_api.set_enabled(not args.audible_cli)
+
+    if sync_library(args.profile_name, args.library, full=args.full) is None:
+        print("Error: Failed to export library.")
+        sys.exit(1)
@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import subprocesses
+
+# ffprobe mostly waits on disk, so a few more workers than cores still helps
+PROBE_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+def probe_tags(filepath):
+    """Extract format tags from an m4b file using ffprobe. Returns None if it fails."""
+    cmd = [
+        "ffprobe", "-v", "quiet", 
+        "-print_format", "json", 
+        "-show_format", 
+        filepath
+    ]
+    try:
+        with metrics.stage("probe"):
+            result = subprocesses.run(cmd, "ffprobe", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result.check_returncode()
+        data = json.loads(result.stdout)
+        return data.get("format", {}).get("tags", {})
+    except Exception as e:
+        print(f"Error reading metadata for {filepath}: {e}")
+        return None
+
+def cached_tags(filepaths, state):
+    """Tags from the state store's cache, without running ffprobe.
+
+    Returns ({filepath: tags}, misses); misses are (filepath, key, stamp) for
+    files that changed or were never probed. Missing files map to {}.
+    """
+    cache = state.tag_cache()
+    result = {}
+    misses = []
+    for filepath in filepaths:
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            result[filepath] = {}
+            continue
+        key = os.path.relpath(filepath, state.base_dir or ".")
+        stamp = (st.st_size, st.st_mtime, st.st_ino)
+        cached = cache.get(key)
+        if cached and cached[:3] == stamp:
+            result[filepath] = json.loads(cached[3])
+        else:
+            misses.append((filepath, key, stamp))
+    return result, misses
+
+def load_tags(filepaths, state, workers=PROBE_WORKERS):
+    """Tags for each path, as {filepath: tags}.
+
+    Results are cached in the state store keyed by name, size, mtime and inode,
+    so unchanged files are never probed again. Cache misses are probed
+    concurrently. Files that could not be probed map to {}.
+    """
+    result, misses = cached_tags(filepaths, state)
+    if misses:
+        print(f"Reading metadata for {len(misses)} files...")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            probed = list(pool.map(probe_tags, [m[0] for m in misses]))
+        rows = []
+        for (filepath, key, stamp), tags in zip(misses, probed):
+            result[filepath] = tags or {}
+            if tags is not None:
+                rows.append((key,) + stamp + (json.dumps(tags),))
+        state.store_tags(rows)
+    return result
@@ -0,0 +1,156 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+METRICS_FILE = "metrics.jsonl"
+SLOWEST_TITLES = 5
+
+class Metrics:
+    """Per-book, per-stage timings, byte counts and subprocess counts for one run.
+
+    Every finished stage is appended to a JSON-lines file (when one is configured)
+    and kept in memory for the end-of-run summary. Safe to use from worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, path=None, tool=None):
+        with self._lock:
+            self.path = path
+            self.tool = tool
+            self.run_id = uuid.uuid4().hex[:12]
+            self.started = time.time()
+            self.stages = defaultdict(list)      # stage -> [(seconds, bytes)]
+            self.book_seconds = defaultdict(float)
+            self.book_titles = {}
+            self.subprocesses = defaultdict(int)
+
+    def _write(self, event):
+        if not self.path:
+            return
+        event = dict(event, run=self.run_id, tool=self.tool, ts=round(time.time(), 3))
+        try:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(event) + "\n")
+        except OSError:
+            pass
+
+    @contextmanager
+    def stage(self, name, asin=None, title=None):
+        """Time a stage. Callers may set record["bytes"] or record["ok"] inside the block."""
+        record = {"bytes": 0, "ok": True}
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record["ok"] = False
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(name, seconds, asin=asin, title=title, nbytes=record["bytes"], ok=record["ok"])
+
+    def add(self, name, seconds, asin=None, title=None, nbytes=0, ok=True):
+        event = {"event": "stage", "stage": name, "seconds": round(seconds, 4), "ok": ok}
+        if asin:
+            event["asin"] = asin
+        if title:
+            event["title"] = title
+        if nbytes:
+            event["bytes"] = nbytes
+            event["mb_per_s"] = round(nbytes / seconds / 1e6, 2) if seconds > 0 else None
+        with self._lock:
+            self.stages[name].append((seconds, nbytes or 0))
+            if asin:
+                self.book_seconds[asin] += seconds
+                if title:
+                    self.book_titles[asin] = title
+            self._write(event)
+
+    def subprocess_started(self, program):
+        with self._lock:
+            self.subprocesses[program] += 1
+
+    def summary(self):
+        with self._lock:
+            stages = {}
+            for name, samples in self.stages.items():
+                times = sorted(s for s, _ in samples)
+                total_bytes = sum(b for _, b in samples)
+                total = sum(times)
+                stages[name] = {
+                    "count": len(times),
+                    "total_s": round(total, 3),
+                    "p50_s": round(percentile(times, 50), 4),
+                    "p95_s": round(percentile(times, 95), 4),
+                    "max_s": round(times[-1], 4),
+                    "bytes": total_bytes,
+                    "mb_per_s": round(total_bytes / total / 1e6, 2) if total_bytes and total > 0 else None,
+                }
+            slowest = sorted(self.book_seconds.items(), key=lambda kv: kv[1], reverse=True)[:SLOWEST_TITLES]
+            return {
+                "event": "summary",
+                "wall_s": round(time.time() - self.started, 3),
+                "stages": stages,
+                "subprocesses": dict(self.subprocesses),
+                "slowest": [{"asin": a, "title": self.book_titles.get(a), "seconds": round(s, 3)}
+                            for a, s in slowest],
+            }
+
+    def finish(self):
+        """Write the summary event and print it. Returns the summary dict."""
+        summary = self.summary()
+        with self._lock:
+            self._write(summary)
+        print_summary(summary)
+        return summary
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def print_summary(summary):
+    print("\n--- Run summary ---")
+    print(f"Wall time: {summary['wall_s']:.1f}s")
+    if summary["stages"]:
+        print(f"  {'stage':<18}{'count':>7}{'total':>10}{'p50':>9}{'p95':>9}{'MB/s':>8}")
+        for name, s in sorted(summary["stages"].items(), key=lambda kv: kv[1]["total_s"], reverse=True):
+            rate = f"{s['mb_per_s']:.1f}" if s["mb_per_s"] else "-"
+            print(f"  {name:<18}{s['count']:>7}{s['total_s']:>9.1f}s{s['p50_s']:>8.2f}s{s['p95_s']:>8.2f}s{rate:>8}")
+    if summary["subprocesses"]:
+        counts = ", ".join(f"{k}={v}" for k, v in sorted(summary["subprocesses"].items()))
+        print(f"Subprocesses: {counts}")
+    if summary["slowest"]:
+        print("Slowest titles:")
+        for b in summary["slowest"]:
+            print(f"  {b['seconds']:>9.1f}s  {b['title'] or b['asin']}")
+
+# Process-wide recorder; tools call configure() at startup
+_metrics = Metrics()
+
+def configure(path=METRICS_FILE, tool=None):
+    _metrics.reset(path=path, tool=tool or os.path.basename(sys.argv[0] or "python"))
+    return _metrics
+
+def stage(name, asin=None, title=None):
+    return _metrics.stage(name, asin=asin, title=title)
+
+def add(name, seconds, asin=None, title=None, nbytes=0, ok=True):
+    _metrics.add(name, seconds, asin=asin, title=title, nbytes=nbytes, ok=ok)
+
+def subprocess_started(program):
+    _metrics.subprocess_started(program)
+
+def summary():
+    return _metrics.summary()
+
+def finish():
+    return _metrics.finish()
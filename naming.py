@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+from functools import lru_cache
+
+# Characters kept in filenames; everything else becomes "_"
+UNSAFE_RE = re.compile(r'[^a-zA-Z0-9\-\.]')
+UNDERSCORES_RE = re.compile(r'_{2,}')
+NOT_ALNUM_RE = re.compile(r'[^a-z0-9]')
+WORD_RE = re.compile(r'[a-z0-9]+')
+# "Part 1", "Part_1", "Part-1" or "Part1" in a file name
+PART_RE = re.compile(r'Part[\s_-]?(\d+)', re.IGNORECASE)
+
+NAME_CACHE_SIZE = 1 << 16
+
+# Where books go below the library directory: all in one directory, in one per
+# (lead) author, per author and series, or in 256 shards by a hash of the ASIN
+LAYOUT_FLAT = "flat"
+LAYOUT_AUTHOR = "author"
+LAYOUT_AUTHOR_SERIES = "author-series"
+LAYOUT_ASIN_SHARDS = "asin-shards"
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_AUTHOR, LAYOUT_AUTHOR_SERIES, LAYOUT_ASIN_SHARDS)
+# How many directory levels a layout puts books below the library directory
+LAYOUT_DEPTH = {LAYOUT_FLAT: 0, LAYOUT_AUTHOR: 1, LAYOUT_AUTHOR_SERIES: 2, LAYOUT_ASIN_SHARDS: 1}
+UNKNOWN_AUTHOR = "Unknown_Author"
+
+def sanitize_filename(name):
+    # Replace non-alphanumeric (except - and .) with _, collapse runs of underscores
+    if not name: return ""
+    s = UNSAFE_RE.sub('_', str(name))
+    s = UNDERSCORES_RE.sub('_', s)
+    return s.strip('_')
+
+def normalize_string(s):
+    # Remove all non-alphanumeric characters and lowercase
+    if not s: return ""
+    return NOT_ALNUM_RE.sub('', s.lower())
+
+def contains_title(filename, title):
+    """Whether `title` appears in `filename` as whole words.
+
+    Unlike a substring test on normalized strings, "It" matches "King_It.m4b"
+    but not "Bitter.m4b" or "Write_Ito.m4b".
+    """
+    words = WORD_RE.findall(title.lower()) if title else []
+    if not words:
+        return False
+    name = WORD_RE.findall(filename.lower())
+    n = len(words)
+    return any(name[i:i + n] == words for i in range(len(name) - n + 1))
+
+def join_authors(authors):
+    """Authors as one string; the library has them as a string or a list."""
+    if isinstance(authors, (list, tuple)):
+        return ", ".join(a for a in authors if a)
+    return authors or ""
+
+def part_number(filename):
+    """The N of a "Part N" marker in `filename`, or None."""
+    match = PART_RE.search(filename)
+    return match.group(1) if match else None
+
+def build_name(author, series, title, asin=None, part=None):
+    """`Author_Series_Title_ASIN[_Part_N].m4b`, leaving out empty pieces."""
+    pieces = [sanitize_filename(author), sanitize_filename(series), sanitize_filename(title), asin]
+    if part:
+        pieces.append(f"Part_{part}")
+    return "_".join(p for p in pieces if p) + ".m4b"
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def _cached_name(author, series, title, asin, part):
+    return build_name(author, series, title, asin, part)
+
+def target_name(book, part=None):
+    """The file name for a library book (and part number), the same in every tool."""
+    return _cached_name(join_authors(book.get("authors")), book.get("series_title") or "",
+                        book.get("title") or "", book.get("asin") or "", part)
+
+def lead_author(authors):
+    """The first of a book's authors."""
+    if isinstance(authors, (list, tuple)):
+        return next((a for a in authors if a), "")
+    return (authors or "").split(",")[0].strip()
+
+def target_dir(book, layout=LAYOUT_FLAT):
+    """The directory a book's files go to under `layout`, relative to the library ("" for the top)."""
+    if layout == LAYOUT_ASIN_SHARDS:
+        asin = book.get("asin")
+        # ASINs share their first characters, so they are hashed to spread evenly
+        return hashlib.sha1(asin.encode()).hexdigest()[:2] if asin else ""
+    if layout in (LAYOUT_AUTHOR, LAYOUT_AUTHOR_SERIES):
+        author = sanitize_filename(lead_author(book.get("authors"))) or UNKNOWN_AUTHOR
+        series = sanitize_filename(book.get("series_title")) if layout == LAYOUT_AUTHOR_SERIES else ""
+        return os.path.join(author, series) if series else author
+    return ""
+
+def layout_path(book, filename, layout=LAYOUT_FLAT):
+    """`filename` placed in the book's directory under `layout`."""
+    directory = target_dir(book, layout)
+    return os.path.join(directory, filename) if directory else filename
+
+def target_path(book, part=None, layout=LAYOUT_FLAT):
+    """The path of a book's M4B (and part) under `layout`, relative to the library."""
+    return layout_path(book, target_name(book, part), layout)
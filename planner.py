@@ -0,0 +1,208 @@
+import contextlib
+import filecmp
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import library_layout
+from fingerprints import fingerprint
+from state_db import StateDB, CONVERTED, M4B
+
+PLAN_VERSION = 1
+
+# Plan entry actions
+SKIP = "skip"
+DOWNLOAD = "download"
+CONVERT = "convert"
+RENAME = "rename"
+RECORD = "record"          # already named right; only the state store learns about it
+CONFLICT = "conflict"
+UNIDENTIFIED = "unidentified"
+
+# Why a rename is a conflict
+TARGET_EXISTS = "target exists"
+DUPLICATE_TARGET = "duplicate target"
+
+class PlanError(ValueError):
+    pass
+
+def open_state(path):
+    """The state store at `path`, or an empty in-memory one so planning never creates a file."""
+    return StateDB(path if os.path.exists(path) else ":memory:")
+
+def make_plan(tool, entries, **info):
+    plan = {"version": PLAN_VERSION, "tool": tool, "created": round(time.time(), 3)}
+    plan.update(info)
+    plan["summary"] = dict(Counter(e["action"] for e in entries))
+    plan["download_bytes"] = sum(e.get("estimated_bytes", 0) for e in entries if e["action"] == DOWNLOAD)
+    plan["entries"] = entries
+    return plan
+
+@contextlib.contextmanager
+def plan_output(path):
+    """Progress messages go to stderr while the plan itself is written to stdout ('-')."""
+    if path == "-":
+        with contextlib.redirect_stdout(sys.stderr):
+            yield
+    else:
+        yield
+
+def write_plan(plan, path):
+    """Write a plan as JSON, one entry per line so plans from two runs diff cleanly."""
+    lines = ['{'] + [f'  {json.dumps(k)}: {json.dumps(v)},' for k, v in plan.items() if k != "entries"]
+    lines.append('  "entries": [')
+    lines.append(",\n".join("    " + json.dumps(e, sort_keys=True) for e in plan["entries"]))
+    lines.append('  ]')
+    lines.append('}')
+    text = "\n".join(lines) + "\n"
+    if path == "-":
+        sys.stdout.write(text)
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+    print(f"Plan written to {path}: " + ", ".join(f"{n} {a}" for a, n in sorted(plan["summary"].items())))
+
+def read_plan(path, tool):
+    try:
+        with open(path, "r") as f:
+            plan = json.load(f)
+    except (OSError, ValueError) as e:
+        raise PlanError(f"could not read plan {path}: {e}")
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise PlanError(f"{path} is not a plan this version can apply")
+    if plan.get("tool") != tool:
+        raise PlanError(f"{path} is a plan for {plan.get('tool')}, not {tool}")
+    return plan
+
+def select_work(plan, max_titles=0, max_download_bytes=0):
+    """ASINs of the download/convert entries to run, in plan order, within the caps.
+
+    Downloads are taken while their estimated sizes fit under `max_download_bytes`
+    (0 = no cap); `max_titles` caps the number of titles overall.
+    """
+    selected, download_bytes = [], 0
+    for entry in plan["entries"]:
+        if entry["action"] not in (DOWNLOAD, CONVERT):
+            continue
+        if max_titles and len(selected) >= max_titles:
+            break
+        if entry["action"] == DOWNLOAD:
+            nbytes = entry.get("estimated_bytes", 0)
+            if max_download_bytes and download_bytes + nbytes > max_download_bytes:
+                continue
+            download_bytes += nbytes
+        selected.append(entry["asin"])
+    return selected
+
+# --- Renames ---
+
+def rename_entries(directory, names):
+    """Plan entries for files and their new names.
+
+    `names` holds (filename, new name, book or None, known) tuples, where `known`
+    says whether the state store already tracks the file. For a file that could
+    not be identified the new name is None and `known` is the reason. A target that
+    already exists, or that an earlier file claims, is a conflict instead of a
+    rename; an existing target whose fingerprint matches the file is marked
+    `identical`.
+    """
+    entries = []
+    claimed = set()
+    for filename, final_name, book, known in names:
+        if final_name is None:
+            entries.append({"action": UNIDENTIFIED, "path": filename, "reason": known})
+            continue
+        entry = {"path": filename, "target": final_name,
+                 "asin": book.get("asin") if book else None, "title": book.get("title") if book else None}
+        if filename == final_name:
+            entry["action"] = SKIP if known else RECORD
+        elif final_name in claimed:
+            entry.update(action=CONFLICT, reason=DUPLICATE_TARGET)
+        elif os.path.exists(os.path.join(directory, final_name)):
+            entry.update(action=CONFLICT, reason=TARGET_EXISTS,
+                         identical=same_fingerprint(os.path.join(directory, filename),
+                                                    os.path.join(directory, final_name)))
+        else:
+            entry["action"] = RENAME
+        claimed.add(final_name)
+        entries.append(entry)
+    return entries
+
+def same_fingerprint(path, other):
+    try:
+        return fingerprint(path) == fingerprint(other)
+    except OSError:
+        return False
+
+def identical_files(path, other):
+    try:
+        return filecmp.cmp(path, other, shallow=False)
+    except OSError:
+        return False
+
+def apply_renames(entries, directory, state, overwrite=False):
+    """Carry out the rename entries of a plan.
+
+    Conflicts are skipped, except that a file replaces an existing target with
+    `overwrite`, or without it when both hold the same bytes. A rename whose
+    target has appeared since planning is treated the same way.
+    """
+    done = Counter()
+    for entry in entries:
+        action, filename, final_name = entry["action"], entry["path"], entry.get("target")
+        if action == UNIDENTIFIED:
+            print(f"Could not identify book for: {filename} ({entry['reason']})")
+            continue
+        if action not in (RENAME, RECORD, CONFLICT):
+            continue
+        filepath = os.path.join(directory, filename)
+        new_filepath = os.path.join(directory, final_name)
+        if not os.path.exists(filepath):
+            print(f"Skipping {filename}: no longer exists.")
+            continue
+        if action == RENAME and os.path.exists(new_filepath):
+            action, entry = CONFLICT, dict(entry, reason=TARGET_EXISTS, identical=True)
+        if action == CONFLICT:
+            # The fingerprint only nominates; the files are compared in full here
+            duplicate = (entry["reason"] == TARGET_EXISTS and entry.get("identical")
+                         and identical_files(filepath, new_filepath))
+            if not (duplicate or overwrite and entry["reason"] == TARGET_EXISTS):
+                print(f"Skipping {filename}: {entry['reason']} ({final_name})")
+                done[CONFLICT] += 1
+                continue
+            if duplicate:
+                print(f"Target exists with the same content: {final_name}. Replacing the duplicate...")
+            else:
+                print(f"Target exists: {final_name}. Overwriting...")
+        elif action == RENAME:
+            print(f"Renaming: {filename}\n      ->  {final_name}")
+
+        if action == RECORD:
+            # Already named correctly; remember it so the next run skips the lookup
+            state.record_file(final_name, entry["asin"], M4B)
+        else:
+            try:
+                # os.replace overwrites an existing target in one step
+                library_layout.make_dirs(directory, final_name)
+                os.replace(filepath, new_filepath)
+            except OSError as e:
+                print(f"Error renaming {filename}: {e}")
+                continue
+            library_layout.prune_dirs(directory, filename)
+            state.rename_file(filename, final_name, entry["asin"])
+        done[action] += 1
+        if entry["asin"]:
+            state.set_status(entry["asin"], CONVERTED, title=entry["title"], output_path=final_name)
+    return done
+
+def add_rename_arguments(parser):
+    parser.add_argument("--plan", metavar="FILE",
+                        help="Only write the renames this run would do to FILE as JSON ('-' for stdout); "
+                             "no file is touched and ffprobe is not run")
+    parser.add_argument("--apply", metavar="FILE", help="Carry out a plan written with --plan")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="With --apply, let renames replace existing files listed as conflicts")
@@ -1,248 +1,1634 @@
+import argparse
+import asyncio
+import copy
 import json
 import os
+import shutil
 import subprocess
 import re
 import sys
 import glob
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    tqdm = None
-
-def sanitize_filename(name):
-    # Replace non-alphanumeric (except - and .) with _
-    # Collapse multiple underscores
-    if not name: return ""
-    s = re.sub(r'[^a-zA-Z0-9\-\.]', '_', str(name))
-    s = re.sub(r'_{2,}', '_', s)
-    return s.strip('_')
-
-def normalize_string(s):
-    # Remove all non-alphanumeric characters and lowercase
-    return re.sub(r'[^a-z0-9]', '', s.lower())
-
-def mark_failed(clean_title, reason):
-    filename = f"err_{clean_title}.notdownloadable"
-    try:
-        with open(filename, "w") as f:
-            f.write(reason)
-        print(f"  Marked as failed: {filename}")
-    except OSError as e:
-        print(f"  Error writing failure marker: {e}")
+import aax
+import audible_api
+import library_layout
+import metrics
+import planner
+import startup
+import streaming
+import subprocesses
+from scheduler import DownloadScheduler, ORDERS, ORDER_LIBRARY
+from converters import DECRYPTION_ERROR_RE, CONVERTERS, get_converter
+from downloads import (DownloadManifest, PART_SUFFIX, SOURCE_EXTENSIONS, partial_file, read_duration, read_voucher,
+                       verify_source, voucher_path)
+from leases import DEFAULT_TTL, LEASE_DIR, LeaseTable
+from library_reader import read_books
+from fingerprints import claims_asin, embedded_asin
+from naming import LAYOUT_FLAT, contains_title, normalize_string, part_number, sanitize_filename, target_path
+from startup import lazy_import
+from state_db import StateDB, STATE_FILE, PENDING, DOWNLOADED, CONVERTED, FAILED, M4B, SOURCE
+
+# Progress bars are optional, and tqdm is only loaded once one is shown
+tqdm = lazy_import("tqdm")
+
+class FileIndex:
+    """In-memory index of local files for ASIN/title matching.
+
+    Answers the same question as scanning every filename with
+    ``asin.lower() in name.lower() or normalized_title in normalize_string(name)``
+    but only normalizes each filename once, before the first lookup after it was added.
+    """
+    ASIN_LEN = 10
+    NGRAM = 3
+    # ASINs are alphanumeric, so only windows inside alphanumeric runs can match one
+    ALNUM_RUN_RE = re.compile(r'[a-z0-9]{10,}')
+
+    def __init__(self, paths=()):
+        self._order = {}                 # path -> insertion sequence
+        self._lower = {}                 # path -> lowercased name
+        self._norm = {}                  # path -> normalized name
+        self._by_window = defaultdict(set)  # ASIN-sized lowercase window -> paths
+        self._by_gram = defaultdict(set)    # normalized trigram -> paths
+        self._unindexed = {}             # paths added but not in the tables yet, in order
+        self._seq = 0
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        return path in self._order
+
+    def __iter__(self):
+        return iter(list(self._order))
+
+    def __len__(self):
+        return len(self._order)
+
+    def _windows(self, s, size):
+        return {s[i:i + size] for i in range(len(s) - size + 1)}
+
+    def _asin_windows(self, lower):
+        windows = set()
+        for run in self.ALNUM_RUN_RE.findall(lower):
+            windows |= self._windows(run, self.ASIN_LEN)
+        return windows
+
+    def add(self, path):
+        if path in self._order:
+            return
+        self._order[path] = self._seq
+        self._seq += 1
+        self._unindexed[path] = None
+
+    def _index_pending(self):
+        """Put paths added since the last lookup into the tables.
+
+        Runs where every book is already converted never look a file up, so they
+        don't pay for indexing thousands of names.
+        """
+        for path in self._unindexed:
+            # Only the name: directories of a layout repeat the author and series
+            name = os.path.basename(path)
+            lower = name.lower()
+            norm = normalize_string(name)
+            self._lower[path] = lower
+            self._norm[path] = norm
+            for w in self._asin_windows(lower):
+                self._by_window[w].add(path)
+            for g in self._windows(norm, self.NGRAM):
+                self._by_gram[g].add(path)
+        self._unindexed.clear()
+
+    def discard(self, path):
+        if path not in self._order:
+            return
+        del self._order[path]
+        if path in self._unindexed:
+            del self._unindexed[path]
+            return
+        lower = self._lower.pop(path)
+        norm = self._norm.pop(path)
+        for w in self._asin_windows(lower):
+            bucket = self._by_window[w]
+            bucket.discard(path)
+            if not bucket:
+                del self._by_window[w]
+        for g in self._windows(norm, self.NGRAM):
+            bucket = self._by_gram[g]
+            bucket.discard(path)
+            if not bucket:
+                del self._by_gram[g]
+
+    def sync(self, paths):
+        """Make the index mirror `paths`. Returns the newly added paths in order."""
+        paths = list(paths)
+        current = set(paths)
+        for path in list(self._order):
+            if path not in current:
+                self.discard(path)
+        added = [p for p in paths if p not in self._order]
+        for path in added:
+            self.add(path)
+        return added
+
+    def _asin_hits(self, asin):
+        key = asin.lower()
+        if len(key) == self.ASIN_LEN and key.isalnum() and key.isascii():
+            return self._by_window.get(key, set())
+        return {p for p, lower in self._lower.items() if key in lower}
+
+    def _title_hits(self, normalized_title):
+        if len(normalized_title) < self.NGRAM:
+            # Too short for the trigram index (an empty title matches everything)
+            return {p for p, norm in self._norm.items() if normalized_title in norm}
+        postings = []
+        for g in self._windows(normalized_title, self.NGRAM):
+            bucket = self._by_gram.get(g)
+            if not bucket:
+                return set()
+            postings.append(bucket)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for bucket in postings[1:]:
+            candidates &= bucket
+            if not candidates:
+                return candidates
+        return {p for p in candidates if normalized_title in self._norm[p]}
+
+    def match(self, asin, normalized_title):
+        """Files whose name contains the ASIN or the normalized title, in insertion order."""
+        self._index_pending()
+        hits = self._asin_hits(asin) | self._title_hits(normalized_title)
+        return sorted(hits, key=self._order.__getitem__)
+
+def verified_matches(candidates, asin, title, owner_of, claims=None):
+    """The candidate files that belong to `asin`.
+
+    A file recorded for an ASIN only counts for that ASIN. Files recorded for no
+    book count when their name holds the ASIN. A name that only holds the title
+    isn't enough when `claims(path, asin)` can tell from the file's ASIN tag or
+    stored fingerprint; the whole title as words (so "It" no longer matches
+    every name with "it" in it) only decides for files without a tag.
+    """
+    key = asin.lower()
+    matches = []
+    for path in candidates:
+        owner = owner_of(path)
+        if owner == asin:
+            matches.append(path)
+        elif owner is None:
+            name = os.path.basename(path)
+            if key in name.lower():
+                matches.append(path)
+                continue
+            claimed = claims(path, asin) if claims else None
+            if claimed or claimed is None and contains_title(name, title):
+                matches.append(path)
+    return matches
+
+def assign_owners(index, books, owners):
+    """Attribute the files in `index` to books: by the ASIN in their name first, then by whole title.
+
+    `owners` ({path: asin}) is filled in; files already in it keep their owner,
+    and each file goes to one book only.
+    """
+    for by_title in (False, True):
+        for book in books:
+            asin, title = book.get('asin'), book.get('title')
+            if not asin or not title:
+                continue
+            for path in index.match(asin, normalize_string(title)):
+                name = os.path.basename(path)
+                if path not in owners and (contains_title(name, title) if by_title
+                                           else asin.lower() in name.lower()):
+                    owners[path] = asin
+
+def list_source_files():
+    return glob.glob("*.aax") + glob.glob("*.aaxc")
+
+STAGING_DIR = ".downloads"
+# What to do with an AAXC file: convert it with its voucher, or replace it with an AAX download
+AAXC_CONVERT = "convert"
+AAXC_PREFER_AAX = "prefer-aax"
+# Incomplete downloads are retried on later runs up to this many times
+MAX_DOWNLOAD_ATTEMPTS = 3
+# What process_book() returns for a title another node holds the lease on
+LEASED = "leased"
+# Seconds a state store write waits for other nodes' writes in shared mode
+SHARED_DB_TIMEOUT = 120.0
+# How often the end of a shared run checks on the titles other nodes hold
+LEASE_POLL = 5.0
+# Held by the node that imports the directory into the state store, so only one does
+IMPORT_LEASE = "import"
+# Meta key recording the profile a title owned by several accounts was downloaded with
+DOWNLOADED_BY = "downloaded_by."
+
+def mark_failed(ws, job, reason, prefix=""):
+    ws.state.mark_failed(job["asin"], reason, title=job["title"])
+    print(f"  {prefix}Marked as failed: {job['title']} ({job['asin']})")
+
+class Workspace:
+    """What the stages of a run share: file indexes, state store and activation bytes."""
+
+    def __init__(self, profile_name, state, threaded=False, converter="ffmpeg", aaxc_policy=AAXC_CONVERT,
+                 scheduler=None, stream=False, layout=None, leases=None):
+        self.profile_name = profile_name
+        # Starts the per-title output of this account when several work at once
+        self.prefix = ""
+        self.stream = stream
+        # Shared mode: the LeaseTable through which titles are claimed from the other nodes
+        self.leases = leases
+        # Where M4B files go below the working directory
+        self.layout = layout or library_layout.get_layout(state)
+        self.aaxc_policy = aaxc_policy
+        self.state = state
+        # Built from the state store, not a directory listing
+        self.m4b_index = FileIndex(state.paths(M4B))
+        self.source_index = FileIndex(state.paths(SOURCE))
+        if threaded:
+            self.m4b_index = LockedIndex(self.m4b_index)
+            self.source_index = LockedIndex(self.source_index)
+        self.statuses = state.statuses()
+        self.activation = ActivationBytesCache(profile_name)
+        self.converter = get_converter(converter)
+        self.scheduler = scheduler or DownloadScheduler()
+
+    def for_profile(self, profile_name, scheduler):
+        """This workspace for another account: its own activation bytes and download limits.
+
+        The state store, file indexes and converter are shared.
+        """
+        ws = copy.copy(self)
+        ws.profile_name = profile_name
+        ws.prefix = f"[{profile_name}] "
+        ws.activation = ActivationBytesCache(profile_name)
+        ws.scheduler = scheduler
+        return ws
+
+    def find_files(self, kind, asin, title):
+        """Files of `kind` that belong to a book: recorded for its ASIN, or verified by name."""
+        index = self.m4b_index if kind == M4B else self.source_index
+        owned = [p for p in self.state.paths_for(asin, kind) if p in index]
+        candidates = [p for p in index.match(asin, normalize_string(title)) if p not in owned]
+        return owned + verified_matches(candidates, asin, title, self.state.owner,
+                                        lambda path, asin: claims_asin(path, asin, self.state))
+
+    def tmp_path(self, final_filename):
+        """Where an M4B is written before it is renamed into place; per node in shared mode."""
+        node = f".{self.leases.node}" if self.leases else ""
+        return final_filename.rsplit('.', 1)[0] + node + "_tmp.m4b"
+
+    def close(self):
+        """End of a run: give up any leases, drop the empty staging dir and close the state store."""
+        # In shared mode another node may be about to download into the staging dir
+        if self.leases:
+            self.leases.close()
+        else:
+            try: os.rmdir(STAGING_DIR)
+            except OSError: pass
+        self.state.close()
+
+def import_state(state, books, layout=LAYOUT_FLAT):
+    """Seed the state store from the working directory (and the subdirectories of its layout).
+
+    Runs once (or with --rescan): records every M4B and AAX/AAXC file and attributes
+    each to at most one library book, by the ASIN tag inside it, then the ASIN in
+    its name, then (for files without a tag) the whole title in its name. Also imports the failure
+    reasons from legacy err_*.notdownloadable markers.
+    """
+    print("Importing existing files into the state store...")
+    m4b_files = library_layout.list_m4b_files("", layout)
+    source_files = list_source_files()
+    markers = {}
+    for marker in glob.glob("err_*.notdownloadable"):
+        markers[marker[len("err_"):-len(".notdownloadable")]] = marker
+
+    state.clear_files()
+    owners = {}
+    for path in m4b_files + source_files:
+        asin = embedded_asin(path)
+        if asin:
+            owners[path] = asin
+    assign_owners(FileIndex(m4b_files), books, owners)
+    assign_owners(FileIndex(source_files), books, owners)
+    files_by_book = defaultdict(lambda: ([], []))
+    for path in m4b_files:
+        if path in owners:
+            files_by_book[owners[path]][0].append(path)
+    for path in source_files:
+        if path in owners:
+            files_by_book[owners[path]][1].append(path)
+
+    counts = {CONVERTED: 0, DOWNLOADED: 0, FAILED: 0}
+    for book in books:
+        asin = book.get('asin')
+        title = book.get('title')
+        if not asin or not title:
+            continue
+        m4bs, sources = files_by_book.get(asin, ([], []))
+        marker = markers.get(sanitize_filename(title))
+        if m4bs:
+            state.set_status(asin, CONVERTED, title=title, output_path=m4bs[0])
+            counts[CONVERTED] += 1
+        elif sources:
+            state.set_status(asin, DOWNLOADED, title=title)
+            counts[DOWNLOADED] += 1
+        elif marker:
+            try:
+                with open(marker, "r") as f:
+                    reason = f.read().strip()
+            except OSError:
+                reason = ""
+            state.mark_failed(asin, reason or "Imported failure marker", title=title)
+            counts[FAILED] += 1
+
+    # Files that match no book are kept too, so they still count for the skip check
+    for path in m4b_files:
+        state.record_file(path, owners.get(path), M4B)
+    for path in source_files:
+        state.record_file(path, owners.get(path), SOURCE)
+    state.mark_imported()
+    print(f"  Imported {len(m4b_files)} M4B and {len(source_files)} source files "
+          f"({counts[CONVERTED]} converted, {counts[DOWNLOADED]} downloaded, {counts[FAILED]} failed).")
 
 def get_duration(filename):
-    cmd = [
-        "ffprobe", "-v", "error", 
-        "-show_entries", "format=duration", 
-        "-of", "default=noprint_wrappers=1:nokey=1", 
-        filename
-    ]
-    try:
-        res = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return float(res.stdout.strip())
-    except Exception:
-        return None
+    # Read straight from the mvhd box instead of a second ffprobe pass over the file
+    return read_duration(filename)
 
-def process_books(profile_name):
+def load_books(save_sidecar=True):
     try:
-        with open("library.json", "r") as f:
-            books = json.load(f)
+        with metrics.stage("load_library"):
+            books = read_books("library.json", save_sidecar=save_sidecar)
     except FileNotFoundError:
         print("Error: library.json not found.")
         sys.exit(1)
 
     print(f"Found {len(books)} books in library.")
+    return books
 
-    # Get all M4B files once
-    all_m4b_files = glob.glob("*.m4b")
+# Why plan_book() drops a source file
+DISCARD_MISSING = "missing"
+DISCARD_PREFER_AAX = "prefer-aax"
+DISCARD_NO_VOUCHER = "no voucher"
 
-    for book in books:
-        asin = book.get('asin')
-        title = book.get('title')
-        authors = book.get('authors')
-        series_title = book.get('series_title')
-        
-        if not asin or not title:
+def plan_book(book, ws):
+    """Steps 1-3 without side effects: what a run would do with `book`, as a plan entry.
+
+    Only the file indexes, the state store and the headers of existing source
+    files are read. Returns None for books without an ASIN or title.
+    """
+    asin = book.get('asin')
+    title = book.get('title')
+    
+    if not asin or not title:
+        return None
+    entry = {"asin": asin, "title": title}
+
+    # 1. Check for existing M4B (Highest Priority) - Skip if found
+    status = ws.statuses.get(asin)
+    if status == CONVERTED or ws.find_files(M4B, asin, title):
+        entry.update(action=planner.SKIP, reason="converted")
+        return entry
+
+    # 2. Check for existing AAX/AAXC source files
+    source_files, discard = [], []
+    for f in ws.find_files(SOURCE, asin, title):
+        ok, reason = verify_source(f) if os.path.exists(f) else (False, DISCARD_MISSING)
+        if ok:
+            source_files.append(f)
+        else:
+            discard.append({"path": f, "reason": reason})
+
+    # 3. Check for previous failures
+    if status == FAILED and not source_files:
+        entry.update(action=planner.SKIP, reason="failed", discard=discard)
+        return entry
+    entry["retry"] = status == FAILED
+
+    # AAXC files are converted with the key from their voucher unless AAX is preferred
+    for f in [f for f in source_files if f.endswith(".aaxc")]:
+        if ws.aaxc_policy == AAXC_PREFER_AAX:
+            reason = DISCARD_PREFER_AAX
+        elif read_voucher(f) is None:
+            reason = DISCARD_NO_VOUCHER
+        else:
             continue
-        
-        # Prepare tracking names
-        clean_title_prefix = sanitize_filename(title)
-        err_filename = f"err_{clean_title_prefix}.notdownloadable"
-        
-        # Calculate base target name early
-        clean_author = sanitize_filename(authors)
-        clean_series = sanitize_filename(series_title)
-        clean_title = sanitize_filename(title)
-        
-        # Base name for the new file: Author_Series_Title_ASIN
-        name_parts = [clean_author]
-        if clean_series:
-            name_parts.append(clean_series)
-        name_parts.append(clean_title)
-        name_parts.append(asin)
-        
-        base_target_name = "_".join(name_parts)
-
-        # 1. Check for existing M4B (Highest Priority) - Skip if found
-        normalized_title = normalize_string(title)
-        found_match = False
-        
-        for m4b in all_m4b_files:
-            norm_m4b = normalize_string(m4b)
-            if normalized_title in norm_m4b or asin.lower() in m4b.lower():
-                found_match = True
-                break
-        
-        if found_match:
-            print(f"Skipping '{title}' - Matching M4B file found.")
+        source_files.remove(f)
+        discard.append({"path": f, "reason": reason})
+
+    entry["discard"] = discard
+    if not source_files:
+        entry.update(action=planner.DOWNLOAD, targets=[target_path(book, layout=ws.layout)],
+                     estimated_bytes=estimate_size(book))
+        return entry
+    targets = [target_path(book, part_number(f), ws.layout) for f in source_files]
+    entry.update(action=planner.CONVERT, sources=source_files, targets=targets)
+    # convert_sources keeps an M4B that is already there and only removes the source
+    existing = [t for t in targets if os.path.exists(t)]
+    if existing:
+        entry["existing"] = existing
+    return entry
+
+def drop_source(ws, path):
+    ws.source_index.discard(path)
+    ws.state.forget_file(path)
+
+def announce_book(job, prefix=""):
+    print(f"\n{prefix}Processing: {job['title']} (ASIN: {job['asin']})")
+
+def prepare_book(book, ws, announce=True):
+    """Steps 1-3: decide whether a book needs work. Returns a job dict or None to skip.
+
+    Without `announce` the caller prints the book's header once it starts on it.
+    """
+    entry = plan_book(book, ws)
+    if entry is None:
+        return None
+    title, asin = entry["title"], entry["asin"]
+    if entry.get("reason") == "converted":
+        print(f"{ws.prefix}Skipping '{title}' - Matching M4B file found.")
+        return None
+
+    # Incomplete and vanished files first: they never count as a reason to retry
+    for item in entry["discard"]:
+        f, reason = item["path"], item["reason"]
+        if reason in (DISCARD_PREFER_AAX, DISCARD_NO_VOUCHER):
             continue
+        if reason != DISCARD_MISSING:
+            # A partial file from an interrupted run would only fail in ffmpeg
+            print(f"  {ws.prefix}Discarding incomplete source file {f} ({reason}).")
+            try: os.remove(f)
+            except OSError: pass
+        drop_source(ws, f)
 
-        # 2. Check for existing AAX/AAXC source files
-        source_files = []
-        all_source_files = glob.glob("*.aax") + glob.glob("*.aaxc")
-        
-        for f in all_source_files:
-            if asin.lower() in f.lower() or normalized_title in normalize_string(f):
-                source_files.append(f)
+    if entry["action"] == planner.SKIP:
+        print(f"{ws.prefix}Skipping '{title}' - Previously marked as not downloadable.")
+        return None
+    if entry["retry"]:
+        print(f"  {ws.prefix}Found source file(s) for '{title}', ignoring previous failure. Retrying...")
+        ws.state.set_status(asin, PENDING, title=title)
 
-        # 3. Check for previous failure markers
-        if os.path.exists(err_filename):
-            if source_files:
-                print(f"  Found source file(s) for '{title}', ignoring previous failure marker. Retrying...")
-                try: os.remove(err_filename)
-                except OSError: pass
-            else:
-                print(f"Skipping '{title}' - Previously marked as not downloadable.")
-                continue
+    if announce:
+        announce_book(entry, ws.prefix)
 
-        print(f"\nProcessing: {title} (ASIN: {asin})")
+    for item in entry["discard"]:
+        f = item["path"]
+        if item["reason"] == DISCARD_PREFER_AAX:
+            print(f"  {ws.prefix}Found AAXC file ({f}). Deleting to attempt AAX download...")
+        elif item["reason"] == DISCARD_NO_VOUCHER:
+            print(f"  {ws.prefix}Found AAXC file ({f}) without a usable voucher. Deleting to download it again...")
+        else:
+            continue
+        try:
+            os.remove(f)
+            drop_source(ws, f)
+            if os.path.exists(voucher_path(f)):
+                os.remove(voucher_path(f))
+        except OSError: pass
 
-        if source_files:
-             for f in list(source_files):
-                 if f.endswith(".aaxc"):
-                     print(f"  Found AAXC file ({f}). Deleting to attempt AAX download...")
-                     try:
-                         os.remove(f)
-                         voucher = f.rsplit('.', 1)[0] + ".voucher"
-                         if os.path.exists(voucher):
-                             os.remove(voucher)
-                         source_files.remove(f)
-                     except OSError: pass
-             
+    return {
+        "asin": asin,
+        "title": title,
+        "book": book,
+        "normalized_title": normalize_string(title),
+        "source_files": entry.get("sources", []),
+    }
+
+def run_download(profile_name, asin, output_dir=None, prefix=""):
+    extra = ["-o", output_dir] if output_dir else []
+    # Throttled downloads are retried with backoff; stderr is still shown as it comes
+    options = dict(stderr=subprocesses.TEE, retries=subprocesses.THROTTLE_RETRIES, label=f"{prefix}Download",
+                   group=profile_name)
+
+    # Attempt 1: Force AAX
+    cmd = ["audible", "-P", profile_name, "download", "-a", asin, "--aax", "-y"] + extra
+    result = subprocesses.run(cmd, "download", **options)
+
+    if result.returncode != 0 and not result.timed_out:
+        print(f"  {prefix}AAX failed. Retrying with fallback...")
+        cmd_fallback = ["audible", "-P", profile_name, "download", "-a", asin, "--aax-fallback", "-y"] + extra
+        subprocesses.run(cmd_fallback, "download", **options)
+
+def format_size(nbytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024 or unit == "GB":
+            return f"{nbytes:.1f} {unit}" if unit != "B" else f"{nbytes} B"
+        nbytes /= 1024
+
+def check_staged_sources(staging, manifest, prefix=""):
+    """Split the AAX/AAXC files in a staging dir into (complete, incomplete) names."""
+    complete, incomplete = [], []
+    for name in sorted(os.listdir(staging)):
+        if not name.endswith(SOURCE_EXTENSIONS):
+            continue
+        path = os.path.join(staging, name)
+        if manifest.is_verified(name, path):
+            complete.append(name)
+            continue
+        ok, reason = verify_source(path)
+        manifest.record(name, path, ok, reason)
+        if ok:
+            complete.append(name)
+        else:
+            print(f"  {prefix}Incomplete download {name}: {reason}")
+            incomplete.append(name)
+    return complete, incomplete
+
+def download_sources(ws, job, prefix="", last_try=True):
+    """Step 4: download a book. Returns its verified source files.
+
+    Each download goes to a per-ASIN staging dir with a manifest and is only moved
+    into the working directory once its MP4 structure checks out, so a partial
+    file never reaches ffmpeg. The staging dir survives interruptions: a download
+    that finished before a crash is picked up without fetching it again.
+
+    A failed download marks the book as failed, unless it isn't the `last_try`:
+    then None is returned so that another account can try it.
+    """
+    title, asin = job["title"], job["asin"]
+    staging = os.path.join(STAGING_DIR, asin)
+    os.makedirs(staging, exist_ok=True)
+    manifest = DownloadManifest(staging)
+
+    complete, incomplete = check_staged_sources(staging, manifest, prefix)
+    if complete and not incomplete:
+        print(f"  {prefix}Found completed download(s) from an earlier run.")
+    else:
+        estimated = estimate_size(job["book"])
+        if not ws.scheduler.admit(estimated):
+            # Left pending rather than failing halfway with a full disk
+            print(f"  {prefix}Not enough free space for '{title}' (about {format_size(estimated)} plus its M4B, "
+                  f"keeping {format_size(ws.scheduler.min_free)} free); leaving it for a later run.")
+            try: os.rmdir(staging)
+            except OSError: pass
+            return []
+        # audible skips files that already exist, so drop truncated ones; its own
+        # in-progress files are left alone so it can continue from them
+        for name in incomplete:
+            try: os.remove(os.path.join(staging, name))
+            except OSError: pass
+        if manifest.attempts:
+            done, expected = manifest.progress()
+            print(f"  {prefix}Retrying download of '{title}' (attempt {manifest.attempts + 1}, "
+                  f"{format_size(done)} of {format_size(expected)} seen last time)...")
+        else:
+            print(f"  {prefix}Downloading '{title}'..." if prefix else "  Downloading...")
+        manifest.start_attempt()
+        try:
+            with metrics.stage("download", asin, title) as m:
+                # In-process downloads keep to the limits as they read; the CLI's are watched from outside
+                if not (audible_api.in_process() and fetch_aax(ws, job, staging, manifest, prefix)):
+                    with ws.scheduler.downloading(staging):
+                        run_download(ws.profile_name, asin, staging, prefix=prefix)
+                if lease_lost(ws, job, prefix):
+                    # The staging dir is the other node's now
+                    m["ok"] = False
+                    return []
+                complete, incomplete = check_staged_sources(staging, manifest, prefix)
+                m["bytes"] = files_size(os.path.join(staging, name) for name in complete)
+                m["ok"] = bool(complete) and not incomplete
+        finally:
+            ws.scheduler.release(estimated)
+
+    new_files = []
+    for name in complete:
+        voucher = voucher_path(name)
+        try:
+            if os.path.exists(os.path.join(staging, voucher)):
+                os.replace(os.path.join(staging, voucher), voucher)
+            os.replace(os.path.join(staging, name), name)
+        except OSError as e:
+            print(f"  {prefix}Error moving {name}: {e}")
+            continue
+        ws.source_index.add(name)
+        ws.state.record_file(name, asin, SOURCE)
+        new_files.append(name)
+    if complete and not incomplete:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if not new_files:
+        source_files = ws.find_files(SOURCE, asin, title)
         if not source_files:
-            print(f"  Downloading...")
-            before_files = set(glob.glob("*.aax") + glob.glob("*.aaxc"))
-
-            # Attempt 1: Force AAX
-            cmd = ["audible", "-P", profile_name, "download", "-a", asin, "--aax", "-y"]
-            result = subprocess.run(cmd)
-
-            if result.returncode != 0:
-                print(f"  AAX failed. Retrying with fallback...")
-                cmd_fallback = ["audible", "-P", profile_name, "download", "-a", asin, "--aax-fallback", "-y"]
-                subprocess.run(cmd_fallback)
-
-            after_files = set(glob.glob("*.aax") + glob.glob("*.aaxc"))
-            new_files = list(after_files - before_files)
-            
-            if not new_files:
-                all_source_files_now = glob.glob("*.aax") + glob.glob("*.aaxc")
-                for f in all_source_files_now:
-                     norm_f = normalize_string(f)
-                     if asin.lower() in f.lower() or normalized_title in norm_f:
-                         source_files.append(f)
-                
-                if not source_files:
-                    reason = f"Error: Download failed or file not found for {title} (ASIN: {asin})"
-                    print(f"  {reason}")
-                    mark_failed(clean_title_prefix, reason)
-                    continue
-            else:
-                source_files = new_files
-                for f in source_files:
-                    print(f"  Downloaded: {f}")
-
-        # 5. Get Activation Bytes
-        auth_cmd = ["audible", "-P", profile_name, "activation-bytes"]
-        auth_res = subprocess.run(auth_cmd, capture_output=True, text=True)
-        match = re.search(r'[a-fA-F0-9]{8}', auth_res.stdout)
-        if not match:
+            if (incomplete or partial_file(staging)) and manifest.attempts < MAX_DOWNLOAD_ATTEMPTS:
+                # Left pending so the next run tries again
+                print(f"  {prefix}Download of '{title}' is incomplete; it will be retried next run.")
+                return []
+            reason = f"Error: Download failed or file not found for {title} (ASIN: {asin})"
+            print(f"  {prefix}{reason}")
+            if not last_try:
+                return None
+            mark_failed(ws, job, reason, prefix)
+        return source_files
+
+    ws.state.set_status(asin, DOWNLOADED, title=title)
+    for f in new_files:
+        print(f"  {prefix}Downloaded: {f}")
+    return new_files
+
+def save_stream(head, reader, path, offset=0, total=0, manifest=None):
+    """Write a download to `path` through a partial file, which is kept if the transfer breaks off.
+
+    With `offset` the partial file already holds that many bytes and the rest is
+    appended. `manifest` records how far it got, for the next attempt to resume.
+    """
+    part = path + PART_SUFFIX
+    with open(part, "ab" if offset else "wb") as f:
+        f.truncate(offset)
+        try:
+            f.write(head)
+            while True:
+                data = reader.read(streaming.CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+        except BaseException:
+            if manifest is not None:
+                try:
+                    f.flush()
+                    manifest.record_partial(os.path.basename(part), f.tell(), total)
+                except OSError:
+                    pass
+            raise
+    if manifest is not None:
+        manifest.forget(os.path.basename(part))
+    os.replace(part, path)
+
+def chunk_hook(ws):
+    """on_chunk for in-process downloads: stop with the run's children and keep to the scheduler's limits."""
+    def on_chunk(nbytes):
+        subprocesses.check_cancelled()
+        ws.scheduler.throttle(nbytes)
+    return on_chunk
+
+def fetch_aax(ws, job, staging, manifest, prefix=""):
+    """Download a title's AAX file into `staging` through the API, without starting the audible CLI.
+
+    A partial file from an interrupted attempt is resumed with a range request.
+    Returns False if the CLI has to do it: AAXC-only titles, a password-protected
+    auth file or a failed request, as long as no part of the title is on disk. The
+    CLI would start again from byte 0, so after that the partial file is kept for
+    the next attempt instead.
+    """
+    part = partial_file(staging)
+    offset = files_size([part]) if part else 0
+    try:
+        with streaming.TitleStream(ws.profile_name, job["asin"], audible_config_dir(),
+                                   on_chunk=chunk_hook(ws), offset=offset) as stream:
+            if stream.offset:
+                print(f"  {prefix}Resuming the download at {format_size(stream.offset)} of "
+                      f"{format_size(stream.size)}...")
+            path = (part[:-len(PART_SUFFIX)] if part
+                    else os.path.join(staging, f"{sanitize_filename(job['title'])}-{stream.codec}.aax"))
+            save_stream(b"", stream.reader, path, stream.offset, stream.size, manifest)
+    except (streaming.StreamUnavailable, OSError) as e:
+        part = partial_file(staging)
+        if part and files_size([part]):
+            print(f"  {prefix}Download interrupted ({e}); {format_size(files_size([part]))} kept to resume from.")
+            return True
+        if part:
+            try: os.remove(part)
+            except OSError: pass
+        print(f"  {prefix}Can't download in-process ({e}); using the audible CLI.")
+        return False
+    return True
+
+def stream_book(ws, job, show_progress=True, prefix=""):
+    """Steps 4-6 in one pass: decrypt the download as it arrives, writing only the M4B.
+
+    Returns False when the title can't be streamed, so the caller downloads and
+    converts it the usual way. If the file was already coming in by then, it is
+    saved to the staging dir and download_sources picks it up from there.
+    """
+    title, asin = job["title"], job["asin"]
+    activation_bytes = ws.activation.get()
+    if not activation_bytes:
+        return False
+    final_filename = target_path(job["book"], layout=ws.layout)
+    tmp_target_m4b = ws.tmp_path(final_filename)
+    estimated = estimate_size(job["book"])
+    # Only the M4B ever lands on disk
+    if not ws.scheduler.admit(estimated, copies=1):
+        print(f"  {prefix}Not enough free space for '{title}' (about {format_size(estimated)}, "
+              f"keeping {format_size(ws.scheduler.min_free)} free); leaving it for a later run.")
+        return True
+
+    print(f"  {prefix}Streaming '{title}'..." if prefix else "  Streaming...")
+    try:
+        library_layout.make_dirs("", final_filename)
+        with metrics.stage("stream", asin, title) as m:
+            with streaming.TitleStream(ws.profile_name, asin, audible_config_dir(),
+                                       on_chunk=chunk_hook(ws)) as stream:
+                bar = None
+                if show_progress and tqdm and stream.size:
+                    bar = tqdm.tqdm(total=stream.size, unit='B', unit_scale=True, desc="    Progress", leave=False)
+                try:
+                    aax.decrypt_stream(stream.reader, tmp_target_m4b, activation_bytes, total=stream.size,
+                                       progress=bar and (lambda f: bar.update(int(f * stream.size) - bar.n)))
+                except aax.NotStreamable as e:
+                    m["ok"] = False
+                    staging = os.path.join(STAGING_DIR, asin)
+                    os.makedirs(staging, exist_ok=True)
+                    print(f"  {prefix}Can't decrypt '{title}' as it arrives ({e}); saving the download.")
+                    save_stream(e.head, stream.reader,
+                                os.path.join(staging, f"{sanitize_filename(title)}-{stream.codec}.aax"))
+                    return False
+                finally:
+                    if bar:
+                        bar.close()
+            m["bytes"] = stream.size
+    except (streaming.StreamUnavailable, aax.AaxError, OSError) as e:
+        try: os.remove(tmp_target_m4b)
+        except OSError: pass
+        if DECRYPTION_ERROR_RE.search(str(e)):
+            # Found out from the header alone, so a retry costs little
+            ws.activation.invalidate(activation_bytes)
+            fresh = ws.activation.get()
+            if fresh and fresh != activation_bytes:
+                print(f"  {prefix}Retrying with refreshed activation bytes...")
+                return stream_book(ws, job, show_progress, prefix)
+        print(f"  {prefix}Can't stream '{title}' ({e}); downloading it first.")
+        return False
+    except BaseException:
+        # Ctrl-C or a cancelled run: don't leave a half-written M4B behind
+        try: os.remove(tmp_target_m4b)
+        except OSError: pass
+        raise
+    finally:
+        ws.scheduler.release(estimated, copies=1)
+
+    ws.activation.confirm(activation_bytes)
+    if lease_lost(ws, job, prefix):
+        try: os.remove(tmp_target_m4b)
+        except OSError: pass
+        return True
+    try:
+        os.replace(tmp_target_m4b, final_filename)
+    except OSError as e:
+        print(f"    {prefix}Error finalizing file: {e}")
+        return True
+    ws.m4b_index.add(final_filename)
+    ws.state.record_file(final_filename, asin, M4B)
+    ws.state.set_status(asin, CONVERTED, title=title, output_path=final_filename)
+    print(f"  {prefix}Streamed and converted: {final_filename}")
+    return True
+
+def get_activation_bytes(profile_name):
+    if audible_api.in_process():
+        try:
+            with metrics.stage("activation_bytes"):
+                value = audible_api.activation_bytes(profile_name)
+            if value and re.fullmatch(r'[a-fA-F0-9]{8}', value):
+                return value
+        except audible_api.ApiUnavailable as e:
+            print(f"  Could not get activation bytes in-process ({e}); asking the audible CLI.")
+    auth_cmd = ["audible", "-P", profile_name, "activation-bytes"]
+    with metrics.stage("activation_bytes"):
+        auth_res = subprocesses.run(auth_cmd, "audible", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    match = re.search(r'[a-fA-F0-9]{8}', auth_res.stdout or "")
+    return match.group(0) if match else None
+
+def audible_config_dir():
+    return audible_api.config_dir()
+
+class ActivationBytesCache:
+    """Per-profile activation bytes, persisted in the audible config dir.
+
+    The value is fetched with `audible activation-bytes` at most once per run,
+    marked verified after the first successful conversion and dropped when
+    ffmpeg reports a decryption failure.
+    """
+    FILENAME = "activation_bytes.json"
+
+    def __init__(self, profile_name, config_dir=None):
+        self.profile_name = profile_name
+        self.path = os.path.join(config_dir or audible_config_dir(), self.FILENAME)
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def _read_all(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entry):
+        data = self._read_all()
+        if entry is None:
+            data.pop(self.profile_name, None)
+        else:
+            data[self.profile_name] = entry
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"  Warning: could not update {self.path}: {e}")
+
+    def get(self):
+        with self._lock:
+            if self._entry is None:
+                entry = self._read_all().get(self.profile_name)
+                if isinstance(entry, dict) and re.fullmatch(r'[a-fA-F0-9]{8}', str(entry.get("bytes", ""))):
+                    self._entry = entry
+                else:
+                    value = get_activation_bytes(self.profile_name)
+                    if not value:
+                        return None
+                    self._entry = {"bytes": value, "verified": False}
+                    self._write(self._entry)
+            return self._entry["bytes"]
+
+    def confirm(self, value):
+        """Record that `value` decrypted a file successfully."""
+        with self._lock:
+            if self._entry and self._entry["bytes"] == value and not self._entry.get("verified"):
+                self._entry["verified"] = True
+                self._write(self._entry)
+
+    def invalidate(self, value):
+        """Forget `value` so the next get() asks audible again."""
+        with self._lock:
+            if self._entry and self._entry["bytes"] == value:
+                print(f"  Discarding cached activation bytes for profile '{self.profile_name}'.")
+                self._entry = None
+                self._write(None)
+
+def remux(source_file, tmp_target_m4b, activation_bytes, show_progress=True, converter=None, voucher=None,
+          prefix=""):
+    """Decrypt and copy `source_file` into `tmp_target_m4b` with the given converter.
+
+    AAXC files pass their voucher's (key, iv) instead of relying on activation bytes.
+    Returns (success, errors) where errors is the converter's error output, or None
+    when ffmpeg wrote straight to the terminal.
+    """
+    converter = converter or get_converter()
+    if not show_progress:
+        return converter.convert(source_file, tmp_target_m4b, activation_bytes, voucher=voucher, prefix=prefix)
+
+    duration = get_duration(source_file)
+    if duration and tqdm:
+        with tqdm.tqdm(total=int(duration), unit='s', unit_scale=True, desc="    Progress", leave=False) as pbar:
+            def progress(fraction):
+                pbar.update(int(fraction * duration) - pbar.n)
+            return converter.convert(source_file, tmp_target_m4b, activation_bytes, progress=progress,
+                                     voucher=voucher, prefix=prefix)
+    return converter.convert(source_file, tmp_target_m4b, activation_bytes, show_stats=True, voucher=voucher,
+                             prefix=prefix)
+
+def timed_remux(ws, job, source_file, tmp_target_m4b, activation_bytes, show_progress=True, voucher=None,
+                prefix=""):
+    with metrics.stage("remux", job["asin"], job["title"]) as m:
+        m["bytes"] = files_size([source_file])
+        success, errors = remux(source_file, tmp_target_m4b, activation_bytes, show_progress, ws.converter,
+                                voucher, prefix)
+        m["ok"] = success
+    return success, errors
+
+def record_converted(ws, job, source_file, final_filename, first):
+    ws.m4b_index.add(final_filename)
+    ws.source_index.discard(source_file)
+    ws.state.record_file(final_filename, job["asin"], M4B)
+    ws.state.forget_file(source_file)
+    # Multi-part books keep the first part as their output path
+    ws.state.set_status(job["asin"], CONVERTED, title=job["title"],
+                        output_path=final_filename if first else None)
+
+def convert_sources(ws, job, source_files, show_progress=True, prefix=""):
+    """Steps 5-6: look up activation bytes and remux each source into its final M4B."""
+    activation = ws.activation
+    converted = 0
+
+    # 5. Get Activation Bytes (cached per profile); AAXC files bring their own key
+    activation_bytes = None
+    if any(not f.endswith(".aaxc") for f in source_files):
+        activation_bytes = activation.get()
+        if not activation_bytes:
             reason = "Error: Could not determine activation bytes."
-            print(f"  {reason}")
-            mark_failed(clean_title_prefix, reason)
+            print(f"  {prefix}{reason}")
+            mark_failed(ws, job, reason, prefix)
+            return
+
+    # 6. Convert Loop
+    for source_file in source_files:
+        if lease_lost(ws, job, prefix):
+            return
+        # Author_Series_Title_ASIN, plus _Part_N for multi-part books
+        final_filename = target_path(job["book"], part_number(source_file), ws.layout)
+        tmp_target_m4b = ws.tmp_path(final_filename)
+
+        if os.path.exists(final_filename):
+             print(f"  {prefix}Target already exists: {final_filename}")
+             try: os.remove(source_file)
+             except OSError: pass
+             record_converted(ws, job, source_file, final_filename, first=not converted)
+             converted += 1
+             continue
+
+        voucher = None
+        if source_file.endswith(".aaxc"):
+            voucher = read_voucher(source_file)
+            if voucher is None:
+                reason = f"Error: No usable voucher for {source_file}"
+                print(f"  {prefix}{reason}")
+                mark_failed(ws, job, reason, prefix)
+                continue
+
+        print(f"  {prefix}Converting {source_file} -> {final_filename}...")
+        try:
+            library_layout.make_dirs("", final_filename)
+            success, errors = timed_remux(ws, job, source_file, tmp_target_m4b, activation_bytes, show_progress,
+                                          voucher, prefix)
+
+            if not success and not voucher and (errors is None or DECRYPTION_ERROR_RE.search(errors)):
+                # The cached value may be stale; refetch once and retry if it changed
+                activation.invalidate(activation_bytes)
+                fresh = activation.get()
+                if fresh and fresh != activation_bytes:
+                    activation_bytes = fresh
+                    print(f"  {prefix}Retrying {source_file} with refreshed activation bytes...")
+                    success, errors = timed_remux(ws, job, source_file, tmp_target_m4b, activation_bytes,
+                                                  show_progress, prefix=prefix)
+        except BaseException:
+            # Ctrl-C or a cancelled run: don't leave a half-written M4B behind
+            try: os.remove(tmp_target_m4b)
+            except OSError: pass
+            raise
+
+        if success and lease_lost(ws, job, prefix):
+            try: os.remove(tmp_target_m4b)
+            except OSError: pass
+            return
+        if success:
+            if not voucher:
+                activation.confirm(activation_bytes)
+            print(f"    {prefix}Conversion complete: {final_filename}")
+            try:
+                os.rename(tmp_target_m4b, final_filename)
+                os.remove(source_file)
+                record_converted(ws, job, source_file, final_filename, first=not converted)
+                converted += 1
+                if os.path.exists(voucher_path(source_file)):
+                    os.remove(voucher_path(source_file))
+            except OSError as e:
+                print(f"    {prefix}Error finalizing file: {e}")
+        else:
+            reason = f"Error: FFmpeg failed for {source_file}"
+            print(f"  {prefix}{reason}")
+            try: os.remove(tmp_target_m4b)
+            except OSError: pass
+            mark_failed(ws, job, reason, prefix)
+
+def open_workspace(profile_name, books, rescan=False, retry_failed=False, threaded=False, converter="ffmpeg",
+                   aaxc_policy=AAXC_CONVERT, scheduler=None, stream=False, leases=None):
+    state = StateDB(STATE_FILE, timeout=SHARED_DB_TIMEOUT) if leases else StateDB(STATE_FILE)
+    if leases:
+        leases.start()
+        print(f"Shared mode: working as node {leases.node}.")
+        import_shared(state, books, rescan, leases)
+    elif rescan or not state.is_imported():
+        with metrics.stage("import"):
+            import_state(state, books, library_layout.get_layout(state))
+    if retry_failed:
+        print(f"Retrying {state.reset_failed()} previously failed books.")
+    return Workspace(profile_name, state, threaded=threaded, converter=converter, aaxc_policy=aaxc_policy,
+                     scheduler=scheduler, stream=stream, leases=leases)
+
+def import_shared(state, books, rescan, leases):
+    """Shared mode: import the directory under the import lease, so nodes starting together do it once.
+
+    An import starts by clearing the file index, which would drop the files other
+    nodes are recording for the titles they hold, so --rescan is refused while
+    any other node's heartbeat is live.
+    """
+    if rescan:
+        others = leases.live_nodes()
+        if others:
+            print(f"Error: --rescan clears the file index other nodes rely on; stop them first "
+                  f"(still running: {', '.join(others)}).")
+            leases.close()
+            state.close()
+            sys.exit(1)
+    waiting = False
+    while not leases.acquire(IMPORT_LEASE):
+        if not waiting:
+            print(f"Waiting for {leases.holder(IMPORT_LEASE) or 'another node'} to import the directory...")
+            waiting = True
+        time.sleep(LEASE_POLL)
+    try:
+        # Another node may have finished the import while we waited
+        if rescan or not state.is_imported():
+            with metrics.stage("import"):
+                import_state(state, books, library_layout.get_layout(state))
+    finally:
+        leases.release(IMPORT_LEASE)
+
+def unfinished_books(books, ws):
+    """Books not yet converted or failed: new purchases plus interrupted work."""
+    pending = [b for b in books if ws.statuses.get(b.get('asin')) not in (CONVERTED, FAILED)]
+    print(f"{len(books) - len(pending)} books already converted or failed; {len(pending)} left to check.")
+    return pending
+
+def match_book(book, ws, announce=True):
+    with metrics.stage("match", book.get('asin'), book.get('title')):
+        return prepare_book(book, ws, announce)
+
+# --- Shared mode ---
+
+def claim_book(ws, book):
+    """Lease `book` before any of its files are touched. False if another node is working on it.
+
+    Other nodes may have converted the title or downloaded it since this run
+    loaded the state store, so its status and files are read again.
+    """
+    asin = book.get("asin")
+    if ws.leases is None or not asin:
+        return True
+    if not ws.leases.acquire(asin):
+        return False
+    row = ws.state.get(asin)
+    if row:
+        ws.statuses[asin] = row["status"]
+    for kind, index in ((M4B, ws.m4b_index), (SOURCE, ws.source_index)):
+        for path in ws.state.paths_for(asin, kind):
+            if path not in index:
+                index.add(path)
+    return True
+
+def release_book(ws, book):
+    if ws.leases is not None and book.get("asin"):
+        ws.leases.release(book["asin"])
+
+def lease_lost(ws, job, prefix=""):
+    """True (after saying so) if another node took the title over, so its files are no longer ours to touch."""
+    if ws.leases is None or ws.leases.held(job["asin"]):
+        return False
+    print(f"  {prefix}Another node took over '{job['title']}'; leaving it to that node.")
+    return True
+
+def wait_for_leased(ws, books, stop=None, fallbacks=None):
+    """Titles other nodes were working on: retried once their lease is given up or expires.
+
+    Most will have been converted by then; a node that died leaves its titles to
+    the others this way. Setting `stop` ends the wait. `fallbacks(book)` gives
+    the workspaces process_book() falls back on for a book.
+    """
+    stop = stop or threading.Event()
+    if books:
+        print(f"\nWaiting for {len(books)} titles other nodes are working on...")
+    while books and not stop.wait(LEASE_POLL):
+        books = [b for b in books if ws.leases.holder(b["asin"])
+                 or process_book(ws, b, fallbacks(b) if fallbacks else ()) == LEASED]
+
+def process_book(ws, book, fallbacks=()):
+    """Check, download and convert one book. Returns LEASED if another node is working on it.
+
+    `fallbacks` are the workspaces of other accounts that own the book; when its
+    download fails they try it in turn, and the one that gets it converts it.
+    """
+    startup.first_work()
+    if not claim_book(ws, book):
+        return LEASED
+    try:
+        job = match_book(book, ws)
+        if job is None:
+            return
+
+        source_files = job["source_files"]
+        if source_files and fallbacks:
+            # Left by a run that fell back on another account; only its activation bytes fit
+            by = ws.state.get_meta(DOWNLOADED_BY + job["asin"])
+            ws = next((account for account in fallbacks if account.profile_name == by), ws)
+        if not source_files:
+            if ws.stream and stream_book(ws, job, prefix=ws.prefix):
+                return
+            accounts = [ws] + list(fallbacks)
+            for attempt, account in enumerate(accounts):
+                if attempt:
+                    print(f"  {account.prefix}Trying the download with profile '{account.profile_name}'...")
+                source_files = download_sources(account, job, account.prefix,
+                                                last_try=attempt == len(accounts) - 1)
+                if source_files is not None:
+                    break
+            # Converted with the activation bytes of the account that downloaded it
+            if source_files and fallbacks:
+                ws.state.set_meta(DOWNLOADED_BY + job["asin"], account.profile_name)
+            ws = account
+            if not source_files:
+                return
+
+        convert_sources(ws, job, source_files, prefix=ws.prefix)
+    finally:
+        release_book(ws, book)
+
+def process_books(profile_name, rescan=False, retry_failed=False, pending_only=False,
+                  metrics_file=metrics.METRICS_FILE, converter="ffmpeg", aaxc_policy=AAXC_CONVERT, asins=None,
+                  scheduler=None, stream=False, leases=None):
+    """Process the library one book at a time; `asins` limits the run to the books a plan selected.
+
+    With `leases` (shared mode) titles another node is working on are left for
+    the end, and the run waits for them.
+    """
+    metrics.configure(metrics_file, tool="process_library")
+    books = load_books()
+    ws = open_workspace(profile_name, books, rescan, retry_failed, converter=converter, aaxc_policy=aaxc_policy,
+                        scheduler=scheduler, stream=stream, leases=leases)
+    if asins is not None:
+        books = planned_books(books, ws, asins)
+    else:
+        if pending_only:
+            books = unfinished_books(books, ws)
+        books = ws.scheduler.order(books)
+
+    try:
+        leased = [book for book in books if process_book(ws, book) == LEASED]
+        wait_for_leased(ws, leased)
+    except KeyboardInterrupt:
+        print("\nInterrupted.")
+        raise
+    finally:
+        ws.close()
+        metrics.finish()
+
+# --- Planning ---
+
+def plan_books(profile_name, rescan=False, retry_failed=False, aaxc_policy=AAXC_CONVERT, scheduler=None):
+    """The plan for every book in library.json, without downloading, converting or changing any file.
+
+    Uses the state store's file index. When the store has not been imported yet
+    (or with `rescan`) the directory is imported into a throwaway in-memory store,
+    as the run itself would.
+    """
+    books = load_books(save_sidecar=False)
+    state = planner.open_state(STATE_FILE)
+    statuses = state.statuses()
+    layout = library_layout.get_layout(state)
+    if rescan or not state.is_imported():
+        state.close()
+        state = StateDB(":memory:")
+        import_state(state, books, layout)
+        statuses.update(state.statuses())
+    ws = Workspace(profile_name, state, aaxc_policy=aaxc_policy, scheduler=scheduler, layout=layout)
+    ws.statuses = statuses
+    retried = set()
+    if retry_failed:
+        retried = {asin for asin, status in ws.statuses.items() if status == FAILED}
+        ws.statuses.update(dict.fromkeys(retried, PENDING))
+
+    entries = []
+    for book in ws.scheduler.order(books):
+        entry = plan_book(book, ws)
+        if entry is None:
             continue
-        activation_bytes = match.group(0)
-
-        # 6. Convert Loop
-        for source_file in source_files:
-            # Handle multi-part suffix
-            part_suffix = ""
-            # Look for Part information in the source filename
-            # matches Part_1, Part-1, Part1
-            part_match = re.search(r'(Part[\s_-]?\d+)', source_file, re.IGNORECASE)
-            if part_match:
-                part_suffix = "_" + part_match.group(1).replace('-', '_').replace(' ', '_')
-            
-            final_filename = f"{base_target_name}{part_suffix}.m4b"
-            # Ensure no double underscores
-            final_filename = re.sub(r'_{{2,}}', '_', final_filename)
-            
-            tmp_target_m4b = final_filename.rsplit('.', 1)[0] + "_tmp.m4b"
-            
-            if os.path.exists(final_filename):
-                 print(f"  Target already exists: {final_filename}")
-                 try: os.remove(source_file)
-                 except OSError: pass
-                 continue
-
-            duration = get_duration(source_file)
-            print(f"  Converting {source_file} -> {final_filename}...")
-            
-            ffmpeg_cmd = [
-                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-progress", "pipe:1",
-                "-activation_bytes", activation_bytes, "-i", source_file, "-c", "copy", tmp_target_m4b
-            ]
-            
-            success = False
-            if duration and tqdm:
-                with tqdm(total=int(duration), unit='s', unit_scale=True, desc="    Progress", leave=False) as pbar:
-                    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, text=True)
-                    last_t = 0
-                    for line in process.stdout:
-                        if "out_time_ms=" in line:
-                            try:
-                                t_us = int(line.split("=")[1])
-                                t_s = t_us // 1000000
-                                pbar.update(t_s - last_t)
-                                last_t = t_s
-                            except: pass
-                    process.wait()
-                    success = (process.returncode == 0)
-            else:
-                fallback_cmd = ["ffmpeg", "-y", "-hide_banner", "-stats", "-loglevel", "error",
-                                "-activation_bytes", activation_bytes, "-i", source_file, "-c", "copy", tmp_target_m4b]
-                success = (subprocess.run(fallback_cmd).returncode == 0)
-
-            if success:
-                print("    Conversion complete.")
-                try:
-                    os.rename(tmp_target_m4b, final_filename)
-                    os.remove(source_file)
-                    voucher = source_file.rsplit('.', 1)[0] + ".voucher"
-                    if os.path.exists(voucher):
-                        os.remove(voucher)
-                except OSError as e:
-                    print(f"    Error finalizing file: {e}")
-            else:
-                reason = f"Error: FFmpeg failed for {source_file}"
-                print(f"  {reason}")
-                try: os.remove(tmp_target_m4b)
-                except OSError: pass
-                mark_failed(clean_title_prefix, reason)
+        if entry["asin"] in retried and entry["action"] != planner.SKIP:
+            entry["retry"] = True
+        entries.append(entry)
+    state.close()
+    return planner.make_plan("process_library", entries, directory=os.getcwd(), aaxc=aaxc_policy)
+
+def planned_books(books, ws, asins):
+    """The books a plan selected, in plan order. Failed ones are reset, as the plan retries them."""
+    by_asin = {b.get("asin"): b for b in books}
+    selected = [by_asin[asin] for asin in asins if asin in by_asin]
+    for book in selected:
+        if ws.statuses.get(book["asin"]) == FAILED:
+            ws.state.set_status(book["asin"], PENDING, title=book.get("title"))
+            ws.statuses[book["asin"]] = PENDING
+    print(f"Applying plan: {len(selected)} books to process.")
+    return selected
+
+# --- Pipelined mode ---
+
+# Rough AAX size per minute of runtime (~64 kbit/s), used until the real size is known
+EST_BYTES_PER_MINUTE = 480 * 1024
+
+class LockedIndex:
+    """Serializes access to a FileIndex shared between worker threads."""
+
+    def __init__(self, index):
+        self._index = index
+        self._lock = threading.Lock()
+
+    def __contains__(self, path):
+        with self._lock:
+            return path in self._index
+
+    def __getattr__(self, name):
+        attr = getattr(self._index, name)
+        if not callable(attr):
+            return attr
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked
+
+class DiskBudget:
+    """Caps the bytes held by downloaded-but-not-yet-converted source files.
+
+    A download only starts when its estimated size fits under the cap, or when
+    nothing else is pending (so a single title larger than the cap still runs).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.pending = 0
+        self._cond = threading.Condition()
+
+    def reserve(self, nbytes):
+        with self._cond:
+            while self.max_bytes and self.pending and self.pending + nbytes > self.max_bytes:
+                self._cond.wait()
+            self.pending += nbytes
+
+    def adjust(self, reserved, actual):
+        with self._cond:
+            self.pending += actual - reserved
+            self._cond.notify_all()
+
+    def release(self, nbytes):
+        with self._cond:
+            self.pending = max(0, self.pending - nbytes)
+            self._cond.notify_all()
+
+    def cancel(self):
+        """Let every waiting reserve() through; used when the run is interrupted."""
+        with self._cond:
+            self.max_bytes = 0
+            self._cond.notify_all()
+
+def files_size(paths):
+    total = 0
+    for p in paths:
+        try: total += os.path.getsize(p)
+        except OSError: pass
+    return total
+
+def estimate_size(book):
+    try:
+        return int(book.get("runtime_length_min") or 0) * EST_BYTES_PER_MINUTE
+    except (TypeError, ValueError):
+        return 0
+
+def process_books_pipelined(profile_name, download_workers=2, convert_workers=2,
+                            max_pending_bytes=0, queue_size=None, rescan=False, retry_failed=False,
+                            pending_only=False, metrics_file=metrics.METRICS_FILE, converter="ffmpeg",
+                            aaxc_policy=AAXC_CONVERT, asins=None, scheduler=None, stream=False, leases=None):
+    """Download and convert concurrently.
+
+    Download workers feed a bounded queue of (job, source files); a separate pool of
+    convert workers drains it. `max_pending_bytes` caps the disk used by AAX/AAXC
+    files waiting to be converted (0 = unlimited). In shared mode (`leases`) a title
+    is leased from its download until its conversion is done.
+    """
+    metrics.configure(metrics_file, tool="process_library")
+    download_workers, convert_workers = max(1, download_workers), max(1, convert_workers)
+    subprocesses.configure(download=download_workers, ffmpeg=convert_workers)
+    books = load_books()
+    ws = open_workspace(profile_name, books, rescan, retry_failed, threaded=True, converter=converter,
+                        aaxc_policy=aaxc_policy, scheduler=scheduler, stream=stream, leases=leases)
+    if asins is not None:
+        books = planned_books(books, ws, asins)
+    else:
+        if pending_only:
+            books = unfinished_books(books, ws)
+        books = ws.scheduler.order(books)
+    budget = DiskBudget(max_pending_bytes)
+
+    # Matching runs up front so workers only see books that need work; a book's
+    # header is printed once a worker starts on it. In shared mode matching can
+    # only happen under the lease, so the download workers do it.
+    jobs = []
+    for book in books:
+        job = {"book": book, "asin": book.get("asin")} if leases else match_book(book, ws, announce=False)
+        if job is not None:
+            job["estimated_bytes"] = estimate_size(book)
+            jobs.append(job)
+
+    print(f"\n{len(jobs)} books to {'check' if leases else 'process'} with {download_workers} download / "
+          f"{convert_workers} convert workers.")
+    leased = []
+    try:
+        asyncio.run(run_pipeline(ws, jobs, budget, download_workers, convert_workers,
+                                 queue_size or convert_workers * 2, leased))
+        wait_for_leased(ws, leased)
+    except KeyboardInterrupt:
+        print("\nInterrupted; running downloads and conversions were stopped.")
+        raise
+    finally:
+        ws.close()
+        metrics.finish()
+
+async def run_pipeline(ws, jobs, budget, download_workers, convert_workers, queue_size, leased=None):
+    """The download and convert workers of pipelined mode, as coroutines.
+
+    The per-book steps are blocking, so they run in a thread pool with a thread for
+    every worker; their audible and ffmpeg children go through the subprocesses
+    runner. Cancelling the pipeline (Ctrl-C) kills those children. In shared mode
+    the books other nodes are working on are added to `leased`.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=download_workers + convert_workers)
+    pending = iter(jobs)
+    converts = asyncio.Queue(maxsize=queue_size)
+
+    def fetch(job):
+        book = job["book"]
+        if ws.leases is not None:
+            if not claim_book(ws, book):
+                leased.append(book)
+                return job, [], 0
+            job = match_book(book, ws, announce=False)
+            if job is None:
+                release_book(ws, book)
+                return job, [], 0
+            job["estimated_bytes"] = estimate_size(book)
+        announce_book(job)
+        try:
+            source_files, nbytes = download(job)
+        except BaseException:
+            release_book(ws, book)
+            raise
+        if not source_files:
+            release_book(ws, book)
+        return job, source_files, nbytes
+
+    def download(job):
+        source_files = job["source_files"]
+        if source_files:
+            nbytes = files_size(source_files)
+            budget.reserve(nbytes)
+        else:
+            # A streamed title never has a source file waiting for conversion
+            if ws.stream and stream_book(ws, job, show_progress=False, prefix=f"[{job['asin']}] "):
+                return [], 0
+            reserved = job["estimated_bytes"]
+            budget.reserve(reserved)
+            try:
+                source_files = download_sources(ws, job, prefix=f"[{job['asin']}] ")
+                nbytes = files_size(source_files)
+            except BaseException:
+                # A reservation left behind would block every later reserve() under the cap
+                budget.release(reserved)
+                raise
+            budget.adjust(reserved, nbytes)
+        if not source_files:
+            budget.release(nbytes)
+        return source_files, nbytes
+
+    async def download_worker():
+        for job in pending:
+            try:
+                job, source_files, nbytes = await loop.run_in_executor(executor, fetch, job)
+            except Exception as e:
+                print(f"  [{job['asin']}] Download worker error: {e}")
+                continue
+            if source_files:
+                await converts.put((job, source_files, nbytes))
+
+    async def convert_worker():
+        while (item := await converts.get()) is not None:
+            job, source_files, nbytes = item
+            try:
+                await loop.run_in_executor(executor, convert_sources, ws, job, source_files, False,
+                                           f"[{job['asin']}] ")
+            except Exception as e:
+                print(f"  [{job['asin']}] Convert worker error: {e}")
+            finally:
+                # Failed sources stay on disk for a retry but no longer hold up the pipeline
+                budget.release(nbytes)
+                release_book(ws, job["book"])
+
+    converters = [asyncio.create_task(convert_worker()) for _ in range(convert_workers)]
+    try:
+        await asyncio.gather(*(download_worker() for _ in range(download_workers)))
+        for _ in converters:
+            await converts.put(None)
+        await asyncio.gather(*converters)
+    except asyncio.CancelledError:
+        subprocesses.cancel_all()
+        budget.cancel()
+        raise
+    finally:
+        for task in converters:
+            task.cancel()
+        executor.shutdown(wait=True)
+
+def parse_size(value):
+    """Parse sizes like '500M', '20G' or plain bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_duration(value):
+    """Parse durations like '90', '15m', '6h' or '1d' into seconds."""
+    units = {"S": 1, "M": 60, "H": 3600, "D": 86400}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def parse_assignments(value, parse):
+    """Parse 'kind=value,kind=value' (e.g. 'download=3,ffmpeg=2') into a dict."""
+    result = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        kind, sep, setting = item.partition("=")
+        if not sep:
+            raise ValueError(item)
+        result[kind.strip()] = parse(setting)
+    return result
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python process_library.py <profile_name>")
+    parser = argparse.ArgumentParser(description="Download and convert an Audible library to M4B.")
+    parser.add_argument("profile_name", nargs="?")
+    parser.add_argument("--profiles", metavar="NAMES",
+                        help="Process several accounts together instead of one profile: comma-separated "
+                             "profile names from config.toml, or 'all'. Their libraries are synced and merged "
+                             "by ASIN, and each title is downloaded once")
+    parser.add_argument("--profile-rates", default="",
+                        help="With --profiles, --max-download-rate per profile, e.g. 'alice=5M,bob=2M'")
+    parser.add_argument("--download-workers", type=int, default=0,
+                        help="Enable pipelined mode with N concurrent downloads")
+    parser.add_argument("--convert-workers", type=int, default=0,
+                        help="Enable pipelined mode with M concurrent ffmpeg remuxes")
+    parser.add_argument("--max-pending-size", type=parse_size, default=0,
+                        help="Cap on disk used by AAX/AAXC files awaiting conversion (e.g. 20G)")
+    parser.add_argument("--rescan", action="store_true",
+                        help=f"Rebuild {STATE_FILE} from the files in the working directory")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Retry books previously marked as failed")
+    parser.add_argument("--pending-only", action="store_true",
+                        help="Only check books that aren't converted or failed yet")
+    parser.add_argument("--sync", action="store_true",
+                        help="Incrementally sync library.json first (implies --pending-only)")
+    parser.add_argument("--converter", choices=sorted(CONVERTERS), default="ffmpeg",
+                        help="ffmpeg subprocess, in-process 'native' decryption, or 'auto' (native, "
+                             "falling back to ffmpeg)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Decrypt downloads as they arrive so only the M4B is written; titles that can't "
+                             "be streamed are downloaded first as usual")
+    parser.add_argument("--audible-cli", action="store_true",
+                        help="Start the audible CLI for activation bytes, library exports and downloads instead "
+                             "of calling the audible API in-process")
+    parser.add_argument("--shared", action="store_true",
+                        help="Let several nodes (containers or hosts) work on this directory at once: each "
+                             f"title is claimed through a lease file in {LEASE_DIR} and processed by one node")
+    parser.add_argument("--lease-ttl", default=f"{DEFAULT_TTL:.0f}s",
+                        help="With --shared, how long a title stays claimed after its node stops renewing the "
+                             "lease before another node takes it over (e.g. 90s, 5m)")
+    parser.add_argument("--aaxc", choices=[AAXC_CONVERT, AAXC_PREFER_AAX], default=AAXC_CONVERT,
+                        help="Convert existing AAXC files with their voucher (default), or delete them "
+                             "and download the book again as AAX")
+    parser.add_argument("--metrics", default=metrics.METRICS_FILE, metavar="FILE",
+                        help="Append per-stage timings to this JSON-lines file ('' to disable)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running: sync the library every --interval and process new or failed "
+                             "titles as they come in")
+    parser.add_argument("--interval", default="6h",
+                        help="How often the daemon checks for new purchases (e.g. 30m, 6h, 1d)")
+    parser.add_argument("--health-port", type=int, default=0,
+                        help="Serve /health and /metrics on this localhost port in daemon mode")
+    parser.add_argument("--retry-failed-after", default="1h",
+                        help="Daemon delay before retrying a failed title, doubled on every failure")
+    parser.add_argument("--limits", default="",
+                        help="Concurrent subprocesses per type, e.g. 'audible=4,ffprobe=8' (types: "
+                             f"{', '.join(subprocesses.DEFAULT_LIMITS)}); pipelined mode sets download "
+                             "and ffmpeg from the worker counts")
+    parser.add_argument("--timeouts", default="",
+                        help="Stop subprocesses that run longer than this, per type, e.g. 'download=2h,ffmpeg=1h'")
+    parser.add_argument("--order", choices=ORDERS, default=ORDER_LIBRARY,
+                        help="Work on books in library order, or shortest/longest runtime first")
+    parser.add_argument("--priority", default="",
+                        help="Comma-separated ASINs to work on before everything else")
+    parser.add_argument("--min-free", type=parse_size, default=0,
+                        help="Keep this much space free on the output volume (e.g. 10G): downloads that "
+                             "would not fit wait for a later run, running ones pause below it")
+    parser.add_argument("--max-download-rate", type=parse_size, default=0,
+                        help="Cap the combined download speed, in bytes per second (e.g. 5M)")
+    parser.add_argument("--plan", metavar="FILE",
+                        help="Only write what a run would do (skip, download, convert) to FILE as JSON "
+                             "('-' for stdout); nothing is downloaded, converted or changed")
+    parser.add_argument("--apply", metavar="FILE",
+                        help="Process the books a plan written with --plan downloads or converts, in plan order")
+    parser.add_argument("--max-titles", type=int, default=0,
+                        help="With --apply, process at most this many titles")
+    parser.add_argument("--max-download-size", type=parse_size, default=0,
+                        help="With --apply, only take on downloads up to this estimated total (e.g. 50G)")
+    args = parser.parse_args()
+    audible_api.set_enabled(not args.audible_cli)
+    if args.converter == "native" and not aax.available():
+        parser.error("--converter native needs the 'cryptography' package")
+    if args.stream and not streaming.available():
+        print("Warning: --stream needs the 'audible' and 'cryptography' packages; downloading to disk instead.")
+        args.stream = False
+    try:
+        subprocesses.configure(**parse_assignments(args.limits, int))
+        subprocesses.configure_timeouts(**parse_assignments(args.timeouts, parse_duration))
+    except ValueError:
+        parser.error("--limits and --timeouts take 'type=value' pairs separated by commas")
+
+    if not library_layout.check_migration():
         sys.exit(1)
-    process_books(sys.argv[1])
\ No newline at end of file
+
+    leases = None
+    if args.shared and not args.plan:
+        try:
+            leases = LeaseTable(ttl=parse_duration(args.lease_ttl))
+        except ValueError:
+            parser.error("durations look like 90s, 30m, 6h or 1d")
+
+    priority = [asin.strip() for asin in args.priority.split(",") if asin.strip()]
+    scheduler = DownloadScheduler(order=args.order, priority=priority, min_free=args.min_free,
+                                  max_rate=args.max_download_rate)
+
+    if args.profiles:
+        import profiles
+        if args.profile_name:
+            parser.error("give either a profile name or --profiles")
+        if args.daemon or args.plan or args.apply or args.download_workers or args.convert_workers:
+            parser.error("--profiles can't be combined with --daemon, --plan, --apply or pipelined mode")
+        try:
+            names = profiles.resolve_profiles(args.profiles, audible_config_dir())
+            rates = parse_assignments(args.profile_rates, parse_size)
+        except ValueError as e:
+            parser.error(f"--profiles/--profile-rates: {e}")
+        try:
+            sys.exit(profiles.process_profiles(
+                names, rescan=args.rescan, retry_failed=args.retry_failed,
+                pending_only=args.sync or args.pending_only, metrics_file=args.metrics, converter=args.converter,
+                aaxc_policy=args.aaxc, stream=args.stream, order=args.order, priority=priority,
+                min_free=args.min_free, max_rate=args.max_download_rate, rates=rates, leases=leases))
+        except KeyboardInterrupt:
+            sys.exit(130)
+    if not args.profile_name:
+        parser.error("a profile name (or --profiles) is required")
+
+    if args.plan:
+        if args.daemon or args.sync or args.apply:
+            parser.error("--plan can't be combined with --daemon, --sync or --apply")
+        with planner.plan_output(args.plan):
+            plan = plan_books(args.profile_name, rescan=args.rescan, retry_failed=args.retry_failed,
+                              aaxc_policy=args.aaxc, scheduler=scheduler)
+        planner.write_plan(plan, args.plan)
+        sys.exit(0)
+
+    asins = None
+    if args.apply:
+        if args.daemon or args.sync:
+            parser.error("--apply can't be combined with --daemon or --sync")
+        try:
+            plan = planner.read_plan(args.apply, "process_library")
+        except planner.PlanError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        asins = planner.select_work(plan, args.max_titles, args.max_download_size)
+        # Books are checked again as they come up, with the AAXC policy the plan was made with
+        args.aaxc = plan.get("aaxc", args.aaxc)
+    elif args.max_titles or args.max_download_size:
+        parser.error("--max-titles and --max-download-size only apply to --apply")
+
+    if args.daemon:
+        import daemon
+        if args.download_workers or args.convert_workers:
+            parser.error("--daemon processes one title at a time; drop --download-workers/--convert-workers")
+        try:
+            interval = parse_duration(args.interval)
+            retry_delay = parse_duration(args.retry_failed_after)
+        except ValueError:
+            parser.error("durations look like 90s, 30m, 6h or 1d")
+        sys.exit(daemon.run_daemon(args.profile_name, interval=interval, health_port=args.health_port,
+                                   converter=args.converter, aaxc_policy=args.aaxc,
+                                   metrics_file=args.metrics, retry_delay=retry_delay, scheduler=scheduler,
+                                   stream=args.stream, leases=leases))
+
+    if args.sync:
+        import library_sync
+        if library_sync.sync_library(args.profile_name) is None:
+            print("Error: Failed to export library.")
+            sys.exit(1)
+
+    try:
+        if args.download_workers or args.convert_workers:
+            process_books_pipelined(args.profile_name,
+                                    download_workers=args.download_workers or 1,
+                                    convert_workers=args.convert_workers or 1,
+                                    max_pending_bytes=args.max_pending_size,
+                                    rescan=args.rescan, retry_failed=args.retry_failed,
+                                    pending_only=args.sync or args.pending_only,
+                                    metrics_file=args.metrics, converter=args.converter, aaxc_policy=args.aaxc,
+                                    asins=asins, scheduler=scheduler, stream=args.stream, leases=leases)
+        else:
+            process_books(args.profile_name, rescan=args.rescan, retry_failed=args.retry_failed,
+                          pending_only=args.sync or args.pending_only, metrics_file=args.metrics,
+                          converter=args.converter, aaxc_policy=args.aaxc, asins=asins, scheduler=scheduler,
+                          stream=args.stream, leases=leases)
+    except KeyboardInterrupt:
+        sys.exit(130)
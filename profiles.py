@@ -0,0 +1,172 @@
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import library_sync
+import metrics
+import process_library
+import subprocesses
+from library_reader import read_books
+from scheduler import DownloadScheduler
+
+ALL_PROFILES = "all"
+# Same check the login steps use to see whether a profile exists
+PROFILE_RE = re.compile(r'^\[profile\.("?)([^"\]]+)\1\]', re.MULTILINE)
+
+def config_profiles(config_dir):
+    """Profile names in audible-cli's config.toml, in file order."""
+    try:
+        with open(os.path.join(config_dir, "config.toml"), "r") as f:
+            return [m.group(2) for m in PROFILE_RE.finditer(f.read())]
+    except OSError:
+        return []
+
+def resolve_profiles(value, config_dir):
+    """The profiles named in `value` ('a,b' or 'all'). Raises ValueError for unknown ones."""
+    known = config_profiles(config_dir)
+    if value.strip() == ALL_PROFILES:
+        names = known
+    else:
+        names = list(dict.fromkeys(n.strip() for n in value.split(",") if n.strip()))
+        unknown = [n for n in names if n not in known]
+        if unknown:
+            raise ValueError(f"not in {os.path.join(config_dir, 'config.toml')}: {', '.join(unknown)}")
+    if not names:
+        raise ValueError("no profiles to process")
+    return names
+
+def library_file(profile_name):
+    return f"library.{profile_name}.json"
+
+def sync_profiles(profile_names, sync=True):
+    """Sync each profile's own library file and merge them by ASIN into library.json.
+
+    Returns {asin: [profiles that own it]}, in profile order. A profile whose
+    export fails keeps the library file from its last sync, if there is one.
+    """
+    owners = {}
+    merged = []
+    for name in profile_names:
+        path = library_file(name)
+        if sync:
+            print(f"\nProfile '{name}':")
+            if library_sync.sync_library(name, path) is None:
+                print(f"Error: Failed to export the library of '{name}'.")
+        if not os.path.exists(path):
+            print(f"  Skipping profile '{name}': no library.")
+            continue
+        for item in library_sync.read_library(path):
+            asin = item.get("asin")
+            if not asin:
+                continue
+            if asin not in owners:
+                owners[asin] = []
+                merged.append(item)
+            owners[asin].append(name)
+
+    try:
+        current = library_sync.read_library(library_sync.LIBRARY_FILE)
+    except (OSError, ValueError):
+        current = None
+    # Rewriting an unchanged file would only force a rebuild of its index
+    if merged and merged != current:
+        library_sync.write_library(library_sync.LIBRARY_FILE, merged)
+    shared = sum(1 for names in owners.values() if len(names) > 1)
+    print(f"\nMerged library has {len(merged)} books from {len(profile_names)} profiles "
+          f"({shared} owned by more than one).")
+    return owners
+
+def pick_profile(asin, owners):
+    """The account a title is downloaded with.
+
+    Titles owned by several accounts are spread over them by ASIN, so the choice
+    is stable across runs: a download left by an interrupted run is converted with
+    the activation bytes of the account that fetched it.
+    """
+    if len(owners) == 1:
+        return owners[0]
+    return owners[hashlib.sha1(asin.encode()).digest()[0] % len(owners)]
+
+def next_owners(name, owners):
+    """The other accounts that own a title, in the order they try it after `name`."""
+    if name not in owners:
+        return list(owners)
+    i = owners.index(name)
+    return owners[i + 1:] + owners[:i]
+
+def process_profiles(profile_names, sync=True, rescan=False, retry_failed=False, pending_only=False,
+                     metrics_file=metrics.METRICS_FILE, converter="ffmpeg", aaxc_policy=process_library.AAXC_CONVERT,
+                     stream=False, order=None, priority=(), min_free=0, max_rate=0, rates=None, leases=None):
+    """Process several accounts at once into the working directory.
+
+    Their libraries are merged by ASIN and every title is assigned to one account
+    that owns it. Each account works through its titles in its own thread, with
+    its own activation bytes and download rate (`rates` overrides `max_rate` per
+    profile); the state store, file indexes, M4B files and `leases` are shared.
+    A download that fails is tried with the title's other owners before the title
+    is marked as failed. Per-title output starts with the profile name.
+    """
+    metrics.configure(metrics_file, tool="process_library --profiles")
+    owners = sync_profiles(profile_names, sync)
+    if not owners:
+        print("Error: No profile library could be loaded.")
+        return 1
+    runner = subprocesses.configure()
+    if runner.limits["download"] < len(profile_names):
+        subprocesses.configure(download=len(profile_names))
+
+    def scheduler_for(name):
+        return DownloadScheduler(order=order or process_library.ORDER_LIBRARY, priority=priority,
+                                 min_free=min_free, max_rate=(rates or {}).get(name, max_rate), group=name)
+
+    books = read_books(library_sync.LIBRARY_FILE)
+    ws = process_library.open_workspace(profile_names[0], books, rescan, retry_failed, threaded=True,
+                                        converter=converter, aaxc_policy=aaxc_policy, stream=stream, leases=leases)
+    workspaces = {name: ws.for_profile(name, scheduler_for(name)) for name in profile_names}
+    if pending_only:
+        books = process_library.unfinished_books(books, ws)
+    queues = {name: [] for name in profile_names}
+    for book in workspaces[profile_names[0]].scheduler.order(books):
+        asin = book.get("asin")
+        if asin in owners:
+            queues[pick_profile(asin, owners[asin])].append(book)
+    print("\n" + ", ".join(f"{name}: {len(queue)} books" for name, queue in queues.items()))
+
+    stop = threading.Event()
+
+    def work(name):
+        def fallbacks(book):
+            return [workspaces[other] for other in next_owners(name, owners[book["asin"]])]
+
+        leased = []
+        for book in queues[name]:
+            if stop.is_set():
+                break
+            try:
+                if process_library.process_book(workspaces[name], book, fallbacks(book)) == process_library.LEASED:
+                    leased.append(book)
+            except subprocesses.Cancelled:
+                break
+            except Exception as e:
+                print(f"  [{name}] Error processing '{book.get('title')}': {e}")
+        try:
+            process_library.wait_for_leased(workspaces[name], leased, stop, fallbacks)
+        except subprocesses.Cancelled:
+            pass
+
+    pool = ThreadPoolExecutor(max_workers=len(profile_names), thread_name_prefix="profile")
+    try:
+        for future in [pool.submit(work, name) for name in profile_names if queues[name]]:
+            future.result()
+    except KeyboardInterrupt:
+        print("\nInterrupted; stopping the running downloads and conversions.")
+        stop.set()
+        subprocesses.cancel_all()
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        ws.close()
+        metrics.finish()
+    return 0
@@ -1,184 +1,168 @@
+import argparse
 import os
-import glob
-import subprocess
-import json
-import re
 import sys
 
+import library_layout
+import metrics
+import planner
+from library_reader import read_books
+from metadata_cache import cached_tags, load_tags
+from naming import build_name, join_authors, layout_path, normalize_string, part_number, target_path
+from state_db import StateDB, STATE_FILE
+
 LIBRARY_FILE = "audiobooks/library.json"
 AUDIOBOOKS_DIR = "audiobooks"
+METRICS_FILE = os.path.join(AUDIOBOOKS_DIR, metrics.METRICS_FILE)
 
-def get_metadata(filepath):
-    """Extract tags from m4b file using ffprobe."""
-    cmd = [
-        "ffprobe", "-v", "quiet", 
-        "-print_format", "json", 
-        "-show_format", 
-        filepath
-    ]
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        return data.get("format", {}).get("tags", {})
-    except Exception as e:
-        print(f"Error reading metadata for {filepath}: {e}")
-        return {}
-
-def sanitize_filename(name):
-    if not name: return ""
-    # Replace non-alphanumeric (except - and .) with _
-    s = re.sub(r'[^a-zA-Z0-9\-\.]', '_', str(name))
-    # Collapse multiple underscores
-    s = re.sub(r'_{2,}', '_', s)
-    return s.strip('_')
-
-def normalize_string(s):
-    if not s: return ""
-    return re.sub(r'[^a-z0-9]', '', s.lower())
-
-def load_library():
+def load_library(save_sidecar=True):
     if not os.path.exists(LIBRARY_FILE):
         return []
     try:
-        with open(LIBRARY_FILE, 'r') as f:
-            return json.load(f)
+        return read_books(LIBRARY_FILE, save_sidecar=save_sidecar)
     except Exception:
         return []
 
-def main():
-    library = load_library()
-    print(f"Loaded {len(library)} books from library cache.")
-    
-    # Create lookup map: (Title, Author) -> Book Info
-    # We use normalized strings for matching
+def plan_renames(library, state, probe=True):
+    """Plan entries for every M4B in the audiobooks dir, matched to books by their tags.
+
+    Without `probe` only cached tags are used and ffprobe never runs.
+    """
+    # Lookup map: normalized title -> [(book, normalized authors)]
+    # Authors are normalized once here rather than for every comparison
     library_map = {}
+    library_by_asin = {}
     for book in library:
+        if book.get("asin"):
+            library_by_asin[book["asin"]] = book
         title = normalize_string(book.get("title", ""))
-        # Author is often list or string
-        authors = book.get("authors", [])
-        if isinstance(authors, list):
-            authors = " ".join(authors)
         
         # We assume the metadata 'artist' matches 'authors' roughly
-        # For lookup, we might just key by Title if unique, or Title+ASIN
-        
-        # Store by normalized title for easy lookup
         if title:
             if title not in library_map:
                 library_map[title] = []
-            library_map[title].append(book)
+            library_map[title].append((book, normalize_string(join_authors(book.get("authors")))))
 
-    files = glob.glob(os.path.join(AUDIOBOOKS_DIR, "*.m4b"))
+    layout = library_layout.get_layout(state)
+    files = library_layout.list_m4b_files(AUDIOBOOKS_DIR, layout)
     print(f"Found {len(files)} M4B files.")
 
+    # Files the state store already attributes to a book don't need probing;
+    # the rest are probed in parallel (or served from the tag cache)
+    known_files = {fp: state.known_file(os.path.relpath(fp, AUDIOBOOKS_DIR)) for fp in files}
+    to_probe = [fp for fp, known in known_files.items()
+                if not (known and known["asin"] in library_by_asin)]
+    if probe:
+        tags_by_path, unprobed = load_tags(to_probe, state), set()
+    else:
+        tags_by_path, misses = cached_tags(to_probe, state)
+        unprobed = {m[0] for m in misses}
+
+    names = []
     for filepath in files:
-        tags = get_metadata(filepath)
-        
-        meta_title = tags.get("title", "")
-        meta_artist = tags.get("artist", "")
-        meta_album = tags.get("album", "")
-        
-        if not meta_title:
-            print(f"Skipping {filepath} - No title in metadata.")
-            continue
+        # Relative to the audiobooks dir, with the layout's directories
+        filename_only = os.path.relpath(filepath, AUDIOBOOKS_DIR)
+        known = known_files[filepath]
+        selected_book = library_by_asin.get(known["asin"]) if known and known["asin"] else None
+        candidates = []
 
-        # Try to find in library
-        norm_title = normalize_string(meta_title)
-        
-        candidates = library_map.get(norm_title, [])
-        
-        # If no direct title match, try fuzzy or album match
-        if not candidates and meta_album:
-             norm_album = normalize_string(meta_album)
-             candidates = library_map.get(norm_album, [])
+        if not selected_book:
+            if filepath in unprobed:
+                names.append((filename_only, None, None, "tags not cached"))
+                continue
+            tags = tags_by_path[filepath]
+            
+            meta_title = tags.get("title", "")
+            meta_artist = tags.get("artist", "")
+            meta_album = tags.get("album", "")
+            
+            if not meta_title:
+                print(f"Skipping {filepath} - No title in metadata.")
+                names.append((filename_only, None, None, "no title in metadata"))
+                continue
 
-        selected_book = None
-        
-        if len(candidates) == 1:
-            selected_book = candidates[0]
-        elif len(candidates) > 1:
-            # Disambiguate by author
-            norm_artist = normalize_string(meta_artist)
-            for b in candidates:
-                b_authors = b.get("authors", "")
-                if isinstance(b_authors, list): b_authors = " ".join(b_authors)
-                if normalize_string(b_authors) in norm_artist or norm_artist in normalize_string(b_authors):
-                    selected_book = b
-                    break
-            # If still ambiguous, maybe check existing filename for ASIN?
-            if not selected_book:
-                current_filename = os.path.basename(filepath)
-                for b in candidates:
-                    if b.get("asin") in current_filename:
+            # Try to find in library
+            norm_title = normalize_string(meta_title)
+            
+            candidates = library_map.get(norm_title, [])
+            
+            # If no direct title match, try fuzzy or album match
+            if not candidates and meta_album:
+                 norm_album = normalize_string(meta_album)
+                 candidates = library_map.get(norm_album, [])
+
+            if len(candidates) == 1:
+                selected_book = candidates[0][0]
+            elif len(candidates) > 1:
+                # Disambiguate by author
+                norm_artist = normalize_string(meta_artist)
+                for b, norm_authors in candidates:
+                    if norm_authors in norm_artist or norm_artist in norm_authors:
                         selected_book = b
                         break
+                # If still ambiguous, maybe check existing filename for ASIN?
+                if not selected_book:
+                    for b, _ in candidates:
+                        if b.get("asin") in os.path.basename(filename_only):
+                            selected_book = b
+                            break
         
+        # Parts are preserved from the original filename (_Part_X, -Part-X, Part X)
+        part = part_number(os.path.basename(filename_only))
+
         # If found in library, construct full name
         if selected_book:
-            new_author = sanitize_filename(selected_book.get("authors"))
-            new_series = sanitize_filename(selected_book.get("series_title"))
-            new_title = sanitize_filename(selected_book.get("title"))
-            new_asin = selected_book.get("asin")
-            
-            parts = [new_author]
-            if new_series:
-                parts.append(new_series)
-            parts.append(new_title)
-            parts.append(new_asin)
-            
-            base_name = "_".join(parts)
+            final_name = target_path(selected_book, part, layout)
         else:
-            # Fallback to metadata only
-            # Schema: Author_Title_Album.m4b? Or just Author_Title.m4b
-            # We don't have ASIN or Series strictly (Album might be series or title)
+            # Fallback to metadata only: no ASIN, and the album stands in for the
+            # series when it differs from the title
             print(f"Warning: '{meta_title}' not found in library. Using metadata tags directly.")
-            clean_author = sanitize_filename(meta_artist)
-            clean_title = sanitize_filename(meta_title)
-            # If album is different from title, maybe it's series?
-            clean_series = ""
-            if meta_album and meta_album != meta_title:
-                 clean_series = sanitize_filename(meta_album)
-            
-            parts = [clean_author]
-            if clean_series: parts.append(clean_series)
-            parts.append(clean_title)
-            # No ASIN
-            
-            base_name = "_".join(parts)
-
-        # Handle Parts (preserve from original filename if detected)
-        # Regex to find _Part_X or -Part-X or Part X
-        filename_only = os.path.basename(filepath)
-        part_suffix = ""
-        part_match = re.search(r'(Part[\s_-]?\d+)', filename_only, re.IGNORECASE)
-        if part_match:
-            part_str = part_match.group(1)
-            # Normalize part string to _Part_X
-            part_num = re.search(r'\d+', part_str).group(0)
-            part_suffix = f"_Part_{part_num}"
-
-        final_name = f"{base_name}{part_suffix}.m4b"
-        final_name = re.sub(r'_{{2,}}', '_', final_name) # Dedup underscores
-        
-        new_filepath = os.path.join(AUDIOBOOKS_DIR, final_name)
-        
-        if filepath != new_filepath:
-            if os.path.exists(new_filepath):
-                print(f"Target exists: {final_name}. Overwriting...")
-                try:
-                    os.remove(new_filepath)
-                    os.rename(filepath, new_filepath)
-                except OSError as e:
-                    print(f"Error overwriting: {e}")
-            else:
-                print(f"Renaming: {filename_only}\n      ->  {final_name}")
-                try:
-                    os.rename(filepath, new_filepath)
-                except OSError as e:
-                    print(f"Error renaming: {e}")
-        else:
-            # print(f"Skipping {filename_only} (Already named correctly)")
-            pass
+            series = meta_album if meta_album and meta_album != meta_title else ""
+            final_name = layout_path({"authors": meta_artist, "series_title": series},
+                                     build_name(meta_artist, series, meta_title, part=part), layout)
+        names.append((filename_only, final_name, selected_book, known is not None))
+    return planner.rename_entries(AUDIOBOOKS_DIR, names)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rename M4B files in audiobooks/ after their tags.")
+    planner.add_rename_arguments(parser)
+    args = parser.parse_args(argv)
+    if not library_layout.check_migration(AUDIOBOOKS_DIR):
+        return 1
+    tool = os.path.splitext(os.path.basename(__file__))[0]
+    state_path = os.path.join(AUDIOBOOKS_DIR, STATE_FILE)
+
+    if args.plan:
+        with planner.plan_output(args.plan):
+            library = load_library(save_sidecar=False)
+            print(f"Loaded {len(library)} books from library cache.")
+            state = planner.open_state(state_path)
+            entries = plan_renames(library, state, probe=False)
+            state.close()
+        planner.write_plan(planner.make_plan(tool, entries), args.plan)
+        return 0
+
+    if args.apply:
+        try:
+            plan = planner.read_plan(args.apply, tool)
+        except planner.PlanError as e:
+            print(f"Error: {e}")
+            return 1
+
+    metrics.configure(METRICS_FILE, tool=tool)
+    state = StateDB(state_path)
+    if args.apply:
+        entries = plan["entries"]
+    else:
+        with metrics.stage("load_library"):
+            library = load_library()
+        print(f"Loaded {len(library)} books from library cache.")
+        entries = plan_renames(library, state)
+    # A direct run replaces existing targets, as it always has
+    planner.apply_renames(entries, AUDIOBOOKS_DIR, state, overwrite=args.overwrite or not args.apply)
+
+    state.close()
+    metrics.finish()
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
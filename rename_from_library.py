@@ -1,129 +1,173 @@
+import argparse
 import os
-import glob
-import json
-import re
-import subprocess
+import sys
+from collections import defaultdict
+
+import library_layout
+import metrics
+import planner
+from library_reader import read_books
+from metadata_cache import cached_tags, load_tags
+from naming import join_authors, part_number, target_path
+from state_db import StateDB, STATE_FILE
 
 LIBRARY_FILE = "audiobooks/library.json"
 AUDIOBOOKS_DIR = "audiobooks"
+METRICS_FILE = os.path.join(AUDIOBOOKS_DIR, metrics.METRICS_FILE)
 
-def sanitize_filename(name):
-    if not name: return ""
-    s = re.sub(r'[^a-zA-Z0-9\-\.]', '_', str(name))
-    s = re.sub(r'_{2,}', '_', s)
-    return s.strip('_')
-
-def get_metadata_title_artist(filepath):
-    cmd = [
-        "ffprobe", "-v", "quiet", 
-        "-print_format", "json", 
-        "-show_format", 
-        filepath
-    ]
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        tags = data.get("format", {}).get("tags", {})
-        return tags.get("title"), tags.get("artist")
-    except:
-        return None, None
-
-def load_library():
+class AsinMatcher:
+    """Finds known ASINs inside filenames with one pass over each name.
+
+    Every substring of a known ASIN length is looked up in a hash map. When a name
+    contains several ASINs, the one listed first in the library wins, as with a
+    linear scan of the library.
+    """
+    # Ensure ASIN is long enough to avoid partial matches (e.g. "B0")
+    MIN_LEN = 8
+
+    def __init__(self, asins):
+        self._rank = {}
+        for asin in asins:
+            if len(asin) >= self.MIN_LEN and asin not in self._rank:
+                self._rank[asin] = len(self._rank)
+        self._lengths = sorted({len(a) for a in self._rank})
+
+    def find(self, filename):
+        best = None
+        for n in self._lengths:
+            for i in range(len(filename) - n + 1):
+                window = filename[i:i + n]
+                rank = self._rank.get(window)
+                if rank is not None and (best is None or rank < self._rank[best]):
+                    best = window
+        return best
+
+def load_library(save_sidecar=True):
     try:
-        with open(LIBRARY_FILE, 'r') as f:
-            return json.load(f)
+        return read_books(LIBRARY_FILE, save_sidecar=save_sidecar)
     except Exception as e:
         print(f"Error loading library: {e}")
         return []
 
-def main():
-    library = load_library()
-    print(f"Loaded {len(library)} books from library.")
+def plan_renames(library, state, probe=True):
+    """Plan entries for every M4B in the audiobooks dir.
 
+    Files are identified by the state store, an ASIN in their name, then their
+    tags. Without `probe` only cached tags are used and ffprobe never runs.
+    """
     library_by_asin = {b['asin']: b for b in library if 'asin' in b}
     
     library_by_meta = {}
     for b in library:
         t = b.get('title')
-        a = b.get('authors')
-        if isinstance(a, list): a = " ".join(a)
+        a = join_authors(b.get('authors'))
         if t and a:
             key = (t.lower().strip(), a.lower().strip())
             library_by_meta[key] = b
 
-    files = glob.glob(os.path.join(AUDIOBOOKS_DIR, "*.m4b"))
+    # Title-only fallback: normalized title -> candidate books
+    meta_by_title = defaultdict(list)
+    for (t, a), b in library_by_meta.items():
+        meta_by_title[t].append(b)
+
+    asin_matcher = AsinMatcher(library_by_asin)
+
+    layout = library_layout.get_layout(state)
+    files = library_layout.list_m4b_files(AUDIOBOOKS_DIR, layout)
     print(f"Scanning {len(files)} files...")
 
+    # First pass: identify books without reading any tags
+    matches = {}
+    known_files = {}
     for filepath in files:
-        filename = os.path.basename(filepath)
+        filename = os.path.relpath(filepath, AUDIOBOOKS_DIR)
         
-        matched_book = None
+        # 0. Files the state store already attributes to a book
+        known = known_files[filepath] = state.known_file(filename)
+        matched_book = library_by_asin.get(known["asin"]) if known and known["asin"] else None
         
         # 1. Try to find ASIN in filename
-        # Ensure ASIN is long enough to avoid partial matches (e.g. "B0")
-        for asin, book in library_by_asin.items():
-            if len(asin) >= 8 and asin in filename:
-                matched_book = book
-                break
+        if not matched_book:
+            asin = asin_matcher.find(os.path.basename(filename))
+            if asin:
+                matched_book = library_by_asin[asin]
+        matches[filepath] = matched_book
+
+    # Only the leftovers need ffprobe; those run in parallel or come from the tag cache
+    leftovers = [fp for fp, b in matches.items() if not b]
+    if probe:
+        tags_by_path, unprobed = load_tags(leftovers, state), set()
+    else:
+        tags_by_path, misses = cached_tags(leftovers, state)
+        unprobed = {m[0] for m in misses}
+
+    names = []
+    for filepath in files:
+        filename = os.path.relpath(filepath, AUDIOBOOKS_DIR)
+        matched_book = matches[filepath]
         
         # 2. If no ASIN match, try metadata
-        if not matched_book:
-            meta_title, meta_artist = get_metadata_title_artist(filepath)
+        if not matched_book and filepath not in unprobed:
+            tags = tags_by_path[filepath]
+            meta_title, meta_artist = tags.get("title"), tags.get("artist")
             if meta_title and meta_artist:
                 key = (meta_title.lower().strip(), meta_artist.lower().strip())
                 matched_book = library_by_meta.get(key)
                 if not matched_book:
-                    candidates = [b for k, b in library_by_meta.items() if k[0] == key[0]]
+                    candidates = meta_by_title.get(key[0], [])
                     if len(candidates) == 1:
                         matched_book = candidates[0]
 
         if matched_book:
-            authors = matched_book.get("authors")
-            if isinstance(authors, list): authors = ", ".join(authors)
-            
-            new_author = sanitize_filename(authors)
-            new_series = sanitize_filename(matched_book.get("series_title"))
-            new_title = sanitize_filename(matched_book.get("title"))
-            new_asin = matched_book.get("asin")
-            
-            parts = [new_author]
-            if new_series:
-                parts.append(new_series)
-            parts.append(new_title)
-            parts.append(new_asin)
-            
-            base_name = "_".join(parts)
-            
-            part_suffix = ""
-            part_match = re.search(r'(Part[\s_-]?\d+)', filename, re.IGNORECASE)
-            if part_match:
-                p_str = part_match.group(1)
-                nums = re.findall(r'\d+', p_str)
-                if nums:
-                    part_suffix = f"_Part_{nums[0]}"
-            
-            final_name = f"{base_name}{part_suffix}.m4b"
-            final_name = re.sub(r'_{2,}', '_', final_name)
-            
-            new_filepath = os.path.join(AUDIOBOOKS_DIR, final_name)
-            
-            if filepath != new_filepath:
-                print(f"Match: {filename} -> {matched_book.get('title')} ({new_asin})")
-                if os.path.exists(new_filepath):
-                    print(f"  Target exists. Overwriting: {final_name}")
-                    try:
-                        os.remove(new_filepath)
-                        os.rename(filepath, new_filepath)
-                    except OSError as e:
-                        print(f"  Error overwriting: {e}")
-                else:
-                    print(f"  Renaming to: {final_name}")
-                    try:
-                        os.rename(filepath, new_filepath)
-                    except OSError as e:
-                        print(f"  Error renaming: {e}")
+            final_name = target_path(matched_book, part_number(os.path.basename(filename)), layout)
+            if filename != final_name:
+                print(f"Match: {filename} -> {matched_book.get('title')} ({matched_book.get('asin')})")
+            names.append((filename, final_name, matched_book, known_files[filepath] is not None))
         else:
-            print(f"Could not identify book for: {filename}")
+            names.append((filename, None, None, "tags not cached" if filepath in unprobed else "no match"))
+    return planner.rename_entries(AUDIOBOOKS_DIR, names)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rename M4B files in audiobooks/ after library.json.")
+    planner.add_rename_arguments(parser)
+    args = parser.parse_args(argv)
+    if not library_layout.check_migration(AUDIOBOOKS_DIR):
+        return 1
+    tool = os.path.splitext(os.path.basename(__file__))[0]
+    state_path = os.path.join(AUDIOBOOKS_DIR, STATE_FILE)
+
+    if args.plan:
+        with planner.plan_output(args.plan):
+            library = load_library(save_sidecar=False)
+            print(f"Loaded {len(library)} books from library.")
+            state = planner.open_state(state_path)
+            entries = plan_renames(library, state, probe=False)
+            state.close()
+        planner.write_plan(planner.make_plan(tool, entries), args.plan)
+        return 0
+
+    if args.apply:
+        try:
+            plan = planner.read_plan(args.apply, tool)
+        except planner.PlanError as e:
+            print(f"Error: {e}")
+            return 1
+
+    metrics.configure(METRICS_FILE, tool=tool)
+    state = StateDB(state_path)
+    if args.apply:
+        entries = plan["entries"]
+    else:
+        with metrics.stage("load_library"):
+            library = load_library()
+        print(f"Loaded {len(library)} books from library.")
+        entries = plan_renames(library, state)
+    # A direct run replaces existing targets, as it always has
+    planner.apply_renames(entries, AUDIOBOOKS_DIR, state, overwrite=args.overwrite or not args.apply)
+
+    state.close()
+    metrics.finish()
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
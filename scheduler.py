@@ -0,0 +1,218 @@
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import subprocesses
+
+# Book orders: as listed in library.json, or by runtime
+ORDER_LIBRARY = "library"
+ORDER_SHORTEST = "shortest"
+ORDER_LONGEST = "longest"
+ORDERS = (ORDER_LIBRARY, ORDER_SHORTEST, ORDER_LONGEST)
+
+# How often running downloads are measured against the limits
+MONITOR_INTERVAL = 0.5
+# Seconds of unused bandwidth a download may catch up on at full speed
+BURST_SECONDS = 1.0
+
+# Why downloads are paused
+LOW_SPACE = "low space"
+RATE_LIMITED = "rate limited"
+
+def free_bytes(path="."):
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+def staged_sizes(path):
+    """{file: size} for the files under `path`, one directory level deep (the staging layout)."""
+    sizes = {}
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return sizes
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                for e in os.scandir(entry.path):
+                    if e.is_file():
+                        sizes[e.path] = e.stat().st_size
+            elif entry.is_file():
+                sizes[entry.path] = entry.stat().st_size
+        except OSError:
+            pass
+    return sizes
+
+def runtime_minutes(book):
+    try:
+        return int(book.get("runtime_length_min") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class DownloadScheduler:
+    """Decides the order titles are worked on and when their downloads may run.
+
+    Books are ordered by runtime (the only size hint in the library export), with
+    `priority` ASINs first. A download only starts if its source file and the M4B
+    made from it fit on the volume above `min_free`. While downloads run, a monitor
+    thread pauses them (SIGSTOP) whenever they are ahead of `max_rate` bytes per
+    second or free space drops under `min_free`, and resumes them once they are
+    back within the limits.
+    """
+
+    def __init__(self, order=ORDER_LIBRARY, priority=(), min_free=0, max_rate=0, volume=".", group=None):
+        self.order_by = order
+        self.priority = {asin: i for i, asin in enumerate(priority)}
+        self.min_free = min_free
+        self.max_rate = max_rate
+        self.volume = volume
+        self.group = group  # only downloads run with this subprocess group are paused
+        self._dirs = Counter()  # staging dirs of running downloads
+        self.reserved = 0
+        self._active = 0
+        self._cond = threading.Condition()
+        self._monitor = None
+        self.paused = None  # why downloads are paused, or None
+        self._tokens = max_rate * BURST_SECONDS
+        self._last_sizes = None
+        self._last_time = time.monotonic()
+
+    def order(self, books):
+        """`books` in scheduling order; sorting is stable, so ties keep their library order."""
+        books = list(books)
+        if self.order_by == ORDER_SHORTEST:
+            # Unknown runtimes sort last
+            books.sort(key=lambda b: runtime_minutes(b) or float("inf"))
+        elif self.order_by == ORDER_LONGEST:
+            books.sort(key=runtime_minutes, reverse=True)
+        if self.priority:
+            books.sort(key=lambda b: self.priority.get(b.get("asin"), len(self.priority)))
+        return books
+
+    def admit(self, nbytes, copies=2):
+        """Reserve room for a download of about `nbytes`. Returns False if it would not fit.
+
+        The title needs room for its source file and, during conversion, an M4B of
+        about the same size, on top of what running downloads have reserved. A
+        streamed title only ever has its M4B on disk (`copies=1`).
+        """
+        if not self.min_free:
+            return True
+        free = free_bytes(self.volume)
+        with self._cond:
+            if free is not None and free - self.reserved - copies * nbytes < self.min_free:
+                return False
+            self.reserved += copies * nbytes
+        return True
+
+    def release(self, nbytes, copies=2):
+        if self.min_free:
+            with self._cond:
+                self.reserved = max(0, self.reserved - copies * nbytes)
+
+    def throttle(self, nbytes):
+        """Account for `nbytes` received by an in-process download, and wait while it is over the limits.
+
+        The in-process counterpart of pausing `audible` children: the caller
+        simply doesn't read on until the limits allow it.
+        """
+        if not (self.min_free or self.max_rate):
+            return
+        while True:
+            with self._cond:
+                self._refill()
+                self._tokens -= nbytes
+                nbytes = 0
+                reason = self._limit()
+                self._set_paused(reason)
+                delay = -self._tokens / self.max_rate if reason == RATE_LIMITED else MONITOR_INTERVAL
+            if not reason:
+                return
+            time.sleep(delay)
+
+    @contextmanager
+    def downloading(self, staging):
+        """Wrap a running download into `staging` so the monitor watches it."""
+        if not (self.min_free or self.max_rate):
+            yield
+            return
+        with self._cond:
+            # Settle the running downloads first, then measure the new one from what its
+            # staging dir holds now: a partial file from an earlier attempt isn't new traffic
+            self._account()
+            self._dirs[staging] += 1
+            if self._last_sizes is None:
+                self._last_sizes = {}
+            self._last_sizes.update(staged_sizes(staging))
+            self._active += 1
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._watch, name="scheduler", daemon=True)
+                self._monitor.start()
+        try:
+            yield
+        finally:
+            with self._cond:
+                # Count the last bytes before the finished file leaves the staging dir
+                self._account()
+                self._active -= 1
+                self._dirs[staging] -= 1
+                if not self._dirs[staging]:
+                    del self._dirs[staging]
+                self._cond.notify_all()
+
+    def _account(self):
+        """Spend the bytes downloaded since the last call from the token bucket.
+
+        Credit accrues at max_rate bytes per second, up to BURST_SECONDS worth;
+        downloaded bytes are measured as growth of the files in the staging dirs
+        of running downloads.
+        """
+        sizes = {}
+        for staging in self._dirs:
+            sizes.update(staged_sizes(staging))
+        self._refill()
+        if self._last_sizes is not None:
+            self._tokens -= sum(max(0, size - self._last_sizes.get(path, 0)) for path, size in sizes.items())
+        self._last_sizes = sizes
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_rate * BURST_SECONDS, self._tokens + self.max_rate * (now - self._last_time))
+        self._last_time = now
+
+    def _limit(self):
+        """Why downloads should pause right now, or None."""
+        if self.min_free:
+            free = free_bytes(self.volume)
+            if free is not None and free < self.min_free:
+                return LOW_SPACE
+        if self.max_rate and self._tokens < 0:
+            return RATE_LIMITED
+        return None
+
+    def _watch(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._set_paused(None)
+                    self._cond.wait()
+                self._account()
+                self._set_paused(self._limit())
+            time.sleep(MONITOR_INTERVAL)
+
+    def _set_paused(self, reason):
+        if reason:
+            if reason == LOW_SPACE and self.paused != LOW_SPACE:
+                print(f"  Pausing downloads: less than {self.min_free // 2**20} MB free on the output volume...")
+            self.paused = reason
+            # Every tick, so downloads that started since are stopped too
+            subprocesses.pause("download", self.group)
+        elif self.paused:
+            if self.paused == LOW_SPACE:
+                print("  Resuming downloads.")
+            self.paused = None
+            subprocesses.resume("download", self.group)
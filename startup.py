@@ -0,0 +1,163 @@
+import importlib.util
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Modules listed in the --profile-startup report
+REPORT_IMPORTS = 12
+
+def lazy_import(name):
+    """The top-level module `name`, executed on first attribute access; None if it isn't installed.
+
+    For optional packages most runs never use: finding one costs a few stat
+    calls, importing it can cost more than the rest of startup.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.loader is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def process_age():
+    """Seconds since this process was started, from /proc (Linux only), or None."""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class _TimedLoader:
+    """Wraps a module's loader to time its execution; everything else goes to the real loader."""
+
+    def __init__(self, loader, name, timer):
+        self._loader = loader
+        self._name = name
+        self._timer = timer
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.run(self._name, self._loader.exec_module, module)
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+class ImportTimer:
+    """Meta path finder that records how long each module takes to import.
+
+    Like `python -X importtime`, but collected in-process so it can be reported
+    next to the time to first work. Built-in and frozen modules are left alone.
+    """
+
+    def __init__(self):
+        self.times = {}  # module -> (seconds including its imports, seconds on its own)
+        self.total = 0.0  # outermost imports only, so nothing is counted twice
+        self._stack = []
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module") and \
+                spec.origin not in ("built-in", "frozen"):
+            spec.loader = _TimedLoader(spec.loader, name, self)
+        return spec
+
+    def run(self, name, exec_module, module):
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            exec_module(module)
+        finally:
+            total = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += total
+            else:
+                self.total += total
+            self.times[name] = (total, total - nested)
+
+class StartupProfile:
+    def __init__(self):
+        self.timer = ImportTimer()
+        self.before_main = process_age()
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.waited = 0.0  # time spent at prompts, left out of every figure
+        self.marks = []
+        self.reported = False
+
+    def now(self):
+        return time.perf_counter() - self.waited
+
+    def mark(self, label):
+        now = self.now()
+        self.marks.append((label, now - self.last))
+        self.last = now
+
+    def report(self, label):
+        self.mark(label)
+        self.reported = True
+        top_level = [(n, t) for n, t in self.timer.times.items() if "." not in n]
+        print("\n--- Startup profile ---")
+        if self.before_main is not None:
+            print(f"  {'interpreter start':<28}{self.before_main:8.3f}s")
+        for name, seconds in self.marks:
+            print(f"  {name:<28}{seconds:8.3f}s")
+        total = self.now() - self.started + (self.before_main or 0)
+        print(f"  {'time to first work':<28}{total:8.3f}s")
+        print(f"  Imports: {self.timer.total:.3f}s in {len(self.timer.times)} modules; "
+              f"slowest (with their imports / alone):")
+        for name, (cumulative, own) in sorted(top_level, key=lambda x: -x[1][0])[:REPORT_IMPORTS]:
+            print(f"    {name:<26}{cumulative:8.3f}s {own:8.3f}s")
+        print("-----------------------\n")
+
+_profile = None
+
+def enable():
+    """Start profiling: every import from here on is timed."""
+    global _profile
+    _profile = StartupProfile()
+    sys.meta_path.insert(0, _profile.timer)
+
+def mark(label):
+    """End a startup phase called `label`."""
+    if _profile and not _profile.reported:
+        _profile.mark(label)
+
+def first_work(label="first title"):
+    """Real work starts here: print the startup report, once."""
+    if _profile and not _profile.reported:
+        _profile.report(label)
+        sys.meta_path.remove(_profile.timer)
+
+@contextmanager
+def waiting():
+    """Time spent in this block (a prompt) doesn't count towards startup."""
+    if not _profile:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profile.waited += time.perf_counter() - start
@@ -0,0 +1,267 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Lives next to library.json; paths inside are relative to that directory
+STATE_FILE = "library_state.db"
+
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+CONVERTED = "converted"
+FAILED = "failed"
+
+# File kinds tracked in the files table
+M4B = "m4b"
+SOURCE = "source"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    asin TEXT PRIMARY KEY,
+    title TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    output_path TEXT,
+    size INTEGER,
+    mtime REAL,
+    failure_reason TEXT,
+    retry_count INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS books_status ON books(status);
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    asin TEXT,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_asin ON files(asin);
+CREATE INDEX IF NOT EXISTS files_kind ON files(kind);
+
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    tags TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    digest TEXT NOT NULL,
+    asin TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def stat_file(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+    except OSError:
+        return None, None
+
+class StateDB:
+    """Persistent run state: one row per ASIN plus every file the tools know about.
+
+    Safe to share between threads; all access goes through one connection and lock.
+    """
+
+    def __init__(self, path=STATE_FILE, timeout=5.0):
+        self.path = path
+        self.base_dir = os.path.dirname(path)
+        self._lock = threading.Lock()
+        # `timeout`: how long a write waits for another process's transaction
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _full_path(self, path):
+        return os.path.join(self.base_dir, path) if self.base_dir else path
+
+    # --- meta ---
+
+    def get_meta(self, key, default=None):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0]["value"] if rows else default
+
+    def set_meta(self, key, value):
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def is_imported(self):
+        return self.get_meta("imported") is not None
+
+    def mark_imported(self):
+        self.set_meta("imported", time.time())
+
+    # --- books ---
+
+    def get(self, asin):
+        rows = self._execute("SELECT * FROM books WHERE asin = ?", (asin,))
+        return dict(rows[0]) if rows else None
+
+    def statuses(self):
+        return {r["asin"]: r["status"] for r in self._execute("SELECT asin, status FROM books")}
+
+    def asins_with_status(self, status):
+        return [r["asin"] for r in self._execute("SELECT asin FROM books WHERE status = ?", (status,))]
+
+    def set_status(self, asin, status, title=None, output_path=None):
+        size = mtime = None
+        if output_path:
+            size, mtime = stat_file(self._full_path(output_path))
+        self._execute(
+            """INSERT INTO books (asin, title, status, output_path, size, mtime, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(asin) DO UPDATE SET
+                   title = COALESCE(excluded.title, books.title),
+                   status = excluded.status,
+                   output_path = COALESCE(excluded.output_path, books.output_path),
+                   size = COALESCE(excluded.size, books.size),
+                   mtime = COALESCE(excluded.mtime, books.mtime),
+                   failure_reason = CASE WHEN excluded.status = 'failed'
+                                         THEN books.failure_reason ELSE NULL END,
+                   updated_at = excluded.updated_at""",
+            (asin, title, status, output_path, size, mtime, time.time()))
+
+    def mark_failed(self, asin, reason, title=None):
+        self._execute(
+            """INSERT INTO books (asin, title, status, failure_reason, retry_count, updated_at)
+               VALUES (?, ?, 'failed', ?, 1, ?)
+               ON CONFLICT(asin) DO UPDATE SET
+                   title = COALESCE(excluded.title, books.title),
+                   status = 'failed',
+                   failure_reason = excluded.failure_reason,
+                   retry_count = books.retry_count + 1,
+                   updated_at = excluded.updated_at""",
+            (asin, title, reason, time.time()))
+
+    def failed_books(self):
+        """{asin: (retry_count, updated_at)} for every failed book."""
+        rows = self._execute("SELECT asin, retry_count, updated_at FROM books WHERE status = 'failed'")
+        return {r["asin"]: (r["retry_count"], r["updated_at"]) for r in rows}
+
+    def reset_failed(self):
+        """Move every failed book back to pending. Returns how many were reset."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE books SET status = 'pending', updated_at = ? WHERE status = 'failed'",
+                (time.time(),)).rowcount
+
+    # --- files ---
+
+    def record_file(self, path, asin, kind):
+        size, mtime = stat_file(self._full_path(path))
+        self._execute("INSERT OR REPLACE INTO files (path, asin, kind, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                      (path, asin, kind, size, mtime))
+
+    def add_file(self, path, kind):
+        """Record a file found on disk unless it is already known. Returns True if it was new."""
+        size, mtime = stat_file(self._full_path(path))
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO files (path, asin, kind, size, mtime) VALUES (?, NULL, ?, ?, ?)",
+                (path, kind, size, mtime)).rowcount == 1
+
+    def forget_file(self, path):
+        self._execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def rename_file(self, old_path, new_path, asin=None):
+        """Track a rename. Replaces any row already stored for `new_path`."""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT asin, kind FROM files WHERE path = ?", (old_path,)).fetchone()
+            kind = row["kind"] if row else M4B
+            asin = asin or (row["asin"] if row else None)
+            size, mtime = stat_file(self._full_path(new_path))
+            self._conn.execute("DELETE FROM files WHERE path IN (?, ?)", (old_path, new_path))
+            self._conn.execute("DELETE FROM tags WHERE path = ?", (new_path,))
+            self._conn.execute("UPDATE tags SET path = ? WHERE path = ?", (new_path, old_path))
+            self._conn.execute("DELETE FROM fingerprints WHERE path = ?", (new_path,))
+            self._conn.execute("UPDATE fingerprints SET path = ? WHERE path = ?", (new_path, old_path))
+            self._conn.execute("INSERT INTO files (path, asin, kind, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                               (new_path, asin, kind, size, mtime))
+            self._conn.execute("UPDATE books SET output_path = ?, size = ?, mtime = ?, updated_at = ? "
+                               "WHERE output_path = ?", (new_path, size, mtime, time.time(), old_path))
+
+    def file(self, path):
+        rows = self._execute("SELECT * FROM files WHERE path = ?", (path,))
+        return dict(rows[0]) if rows else None
+
+    def known_file(self, path):
+        """The stored row for `path` if its size and mtime still match the disk, else None."""
+        row = self.file(path)
+        if row is None:
+            return None
+        size, mtime = stat_file(self._full_path(path))
+        if size is None or (size, mtime) != (row["size"], row["mtime"]):
+            return None
+        return row
+
+    def paths(self, kind):
+        return [r["path"] for r in self._execute("SELECT path FROM files WHERE kind = ? ORDER BY rowid", (kind,))]
+
+    def owner(self, path):
+        """The ASIN a file is recorded for, or None."""
+        rows = self._execute("SELECT asin FROM files WHERE path = ?", (path,))
+        return rows[0]["asin"] if rows else None
+
+    def paths_for(self, asin, kind):
+        return [r["path"] for r in self._execute(
+            "SELECT path FROM files WHERE asin = ? AND kind = ? ORDER BY rowid", (asin, kind))]
+
+    def clear_files(self):
+        self._execute("DELETE FROM files")
+
+    # --- ffprobe tag cache ---
+
+    def tag_cache(self):
+        """All cached tags as {path: (size, mtime, inode, tags_json)}."""
+        rows = self._execute("SELECT path, size, mtime, inode, tags FROM tags")
+        return {r["path"]: (r["size"], r["mtime"], r["inode"], r["tags"]) for r in rows}
+
+    def store_tags(self, rows):
+        """Store (path, size, mtime, inode, tags_json) tuples."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tags (path, size, mtime, inode, tags) VALUES (?, ?, ?, ?, ?)", rows)
+
+    # --- content fingerprints ---
+
+    def fingerprint_cache(self):
+        """All cached fingerprints as {path: (size, mtime, inode, digest, asin)}."""
+        rows = self._execute("SELECT path, size, mtime, inode, digest, asin FROM fingerprints")
+        return {r["path"]: (r["size"], r["mtime"], r["inode"], r["digest"], r["asin"]) for r in rows}
+
+    def fingerprint(self, path):
+        rows = self._execute("SELECT * FROM fingerprints WHERE path = ?", (path,))
+        return dict(rows[0]) if rows else None
+
+    def digest_recorded_for(self, digest, asin):
+        """Whether a file recorded for `asin` has this fingerprint, i.e. is a copy of the same content."""
+        return bool(self._execute(
+            "SELECT 1 FROM fingerprints JOIN files ON files.path = fingerprints.path "
+            "WHERE fingerprints.digest = ? AND files.asin = ? LIMIT 1", (digest, asin)))
+
+    def store_fingerprints(self, rows):
+        """Store (path, size, mtime, inode, digest, asin) tuples."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fingerprints (path, size, mtime, inode, digest, asin) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
@@ -0,0 +1,136 @@
+import aax
+import audible_api
+from audible_api import ApiUnavailable, audible, httpx, load_auth
+
+# Answers with a redirect to the title's AAX file on Audible's CDN, like `audible download --aax`
+CONTENT_URL = "https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/FSDownloadContent"
+CHUNK_SIZE = 1 << 20
+# Seconds without data before a streamed download is given up
+READ_TIMEOUT = 60
+
+class StreamUnavailable(Exception):
+    """The title can't be streamed; it is downloaded to disk instead."""
+
+class StreamInterrupted(StreamUnavailable):
+    """The transfer broke off after it had started; what arrived can be resumed from."""
+
+def available():
+    return audible_api.available() and aax.available()
+
+def best_codec(item):
+    """The highest-quality AAX codec name (e.g. AAX_44_128) a library item is offered in."""
+    best, best_rank = None, (0, 0)
+    for codec in item.get("available_codecs") or []:
+        name = codec.get("name", "")
+        if not name.startswith("aax_"):
+            continue
+        try:
+            rank = tuple(int(n) for n in name[4:].split("_"))
+        except ValueError:
+            continue
+        if rank > best_rank:
+            best, best_rank = name.upper(), rank
+    return best
+
+class ChunkReader:
+    """File-like read(n) over an iterator of byte chunks."""
+
+    def __init__(self, chunks, on_chunk=None):
+        self._chunks = chunks
+        self._buf = bytearray()
+        self._on_chunk = on_chunk
+        self._error = None
+
+    def read(self, size):
+        while len(self._buf) < size and self._error is None:
+            try:
+                chunk = next(self._chunks, None)
+            except StreamInterrupted as e:
+                # What arrived before the break is handed out first; a resume starts after it
+                self._error = e
+                break
+            if chunk is None:
+                break
+            if self._on_chunk:
+                self._on_chunk(len(chunk))
+            self._buf += chunk
+        if self._error is not None and not self._buf:
+            raise self._error
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+class TitleStream:
+    """An open download of a title's AAX file, read front to back.
+
+    Use as a context manager; `reader` is the ChunkReader over the body, `size` the
+    size of the whole file (0 if unknown) and `codec` the codec name, as in
+    audible-cli's file names. With `offset` only the rest of the file from that
+    byte is requested; `offset` is reset to 0 if the server sends all of it.
+    """
+
+    def __init__(self, profile_name, asin, config_dir, on_chunk=None, offset=0):
+        if not audible_api.available():
+            raise StreamUnavailable("needs the audible and tomllib modules")
+        try:
+            self.auth = load_auth(profile_name, config_dir)
+        except ApiUnavailable as e:
+            raise StreamUnavailable(str(e))
+        self.asin = asin
+        self.on_chunk = on_chunk
+        self.offset = offset
+        self._client = None
+        self._response = None
+
+    def __enter__(self):
+        try:
+            with audible.Client(auth=self.auth) as client:
+                item = client.get(f"library/{self.asin}", response_groups="media,product_attrs").get("item") or {}
+                self.codec = best_codec(item)
+                if not self.codec:
+                    raise StreamUnavailable("no AAX version offered")
+                r = client.session.head(CONTENT_URL, follow_redirects=False, params={
+                    "type": "AUDI", "currentTransportMethod": "WIFI", "key": self.asin, "codec": self.codec})
+            location = r.headers.get("Location")
+            if not location:
+                raise StreamUnavailable(f"no download link (HTTP {r.status_code})")
+            url = location.replace("cds.audible.com", f"cds.audible.{self.auth.locale.domain}")
+            self._client = httpx.Client(timeout=httpx.Timeout(30, read=READ_TIMEOUT), follow_redirects=True)
+            self._response = self._request(url)
+            if self.offset and self._response.status_code == 416:
+                # The partial file is no prefix of this one; start over
+                self._response.close()
+                self.offset = 0
+                self._response = self._request(url)
+            elif self.offset and self._response.status_code != 206:
+                self.offset = 0
+            self._response.raise_for_status()
+        except StreamUnavailable:
+            self.close()
+            raise
+        except Exception as e:
+            self.close()
+            raise StreamUnavailable(str(e) or type(e).__name__)
+        length = int(self._response.headers.get("Content-Length") or 0)
+        self.size = self.offset + length if length else 0
+        self.reader = ChunkReader(self._body(), self.on_chunk)
+        return self
+
+    def _request(self, url):
+        headers = {"Range": f"bytes={self.offset}-"} if self.offset else {}
+        return self._client.send(self._client.build_request("GET", url, headers=headers), stream=True)
+
+    def _body(self):
+        try:
+            yield from self._response.iter_bytes(CHUNK_SIZE)
+        except httpx.HTTPError as e:
+            raise StreamInterrupted(f"download interrupted: {e}")
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        if self._client is not None:
+            self._client.close()
@@ -0,0 +1,264 @@
+import asyncio
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import threading
+
+import metrics
+
+# Concurrent children per command type. Cheap audible calls (activation bytes,
+# library export) have their own pool so they never wait behind downloads.
+DEFAULT_LIMITS = {"download": 2, "audible": 4, "ffmpeg": 2, "ffprobe": 8}
+# Seconds before a child is killed; None waits forever
+DEFAULT_TIMEOUTS = {"download": 4 * 3600, "audible": 600, "ffmpeg": 4 * 3600, "ffprobe": 120}
+UNLIMITED = 1 << 16
+
+# Throttled or temporarily unavailable: worth another try after a pause
+THROTTLE_RE = re.compile(r'\b(429|503)\b|too many requests|throttl|rate.?limit|service unavailable',
+                         re.IGNORECASE)
+THROTTLE_RETRIES = 4
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 300.0
+
+# stderr=TEE shows the child's stderr as usual and also keeps its tail for the caller
+TEE = "tee"
+TEE_TAIL_BYTES = 16 * 1024
+
+_DEFAULT = object()
+
+class Cancelled(KeyboardInterrupt):
+    """Raised in callers whose child was killed by cancel_all()."""
+
+class ProcessResult(subprocess.CompletedProcess):
+    def __init__(self, args, returncode, stdout=None, stderr=None, timed_out=False, cancelled=False):
+        super().__init__(args, returncode, stdout, stderr)
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+def backoff_delay(attempt):
+    """Exponential backoff with jitter: about BACKOFF_BASE, twice that, four times... up to BACKOFF_MAX."""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def is_throttled(result):
+    return result.returncode != 0 and bool(THROTTLE_RE.search(result.stderr or ""))
+
+class ProcessRunner:
+    """Runs child processes on a private asyncio event loop.
+
+    Every command type ("download", "audible", "ffmpeg", "ffprobe") has its own
+    concurrency limit and timeout. Coroutines await run_async(); blocking callers
+    such as worker threads use run(), which waits on the loop without holding it,
+    so one slow child never stalls the others. cancel_all() kills every child;
+    results come back marked `cancelled` and run() raises Cancelled for them.
+    """
+
+    def __init__(self, limits=None, timeouts=None):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphores = {}
+        self._children = {}  # running process -> (command type, group)
+        self.cancelled = False
+
+    def set_limits(self, **limits):
+        """Change limits for command types that have not been used yet."""
+        self.limits.update(limits)
+
+    def set_timeouts(self, **timeouts):
+        self.timeouts.update(timeouts)
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="subprocesses", daemon=True).start()
+            return self._loop
+
+    def _semaphore(self, kind):
+        semaphore = self._semaphores.get(kind)
+        if semaphore is None:
+            semaphore = self._semaphores[kind] = asyncio.Semaphore(self.limits.get(kind) or UNLIMITED)
+        return semaphore
+
+    async def _communicate(self, proc, on_line, tee):
+        async def read_stdout():
+            if on_line is None:
+                return await proc.stdout.read() if proc.stdout else None
+            async for line in proc.stdout:
+                on_line(line.decode(errors="replace"))
+            return None
+
+        async def read_stderr():
+            if proc.stderr is None:
+                return None
+            if not tee:
+                return await proc.stderr.read()
+            tail = bytearray()
+            while chunk := await proc.stderr.read(4096):
+                sys.stderr.buffer.write(chunk)
+                sys.stderr.flush()
+                tail += chunk
+                del tail[:-TEE_TAIL_BYTES]
+            return bytes(tail)
+
+        out, err = await asyncio.gather(read_stdout(), read_stderr())
+        await proc.wait()
+        return out, err
+
+    def _kill(self, proc):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    async def _run_once(self, cmd, kind, timeout, stdin, stdout, stderr, on_line, text, group):
+        tee = stderr == TEE
+        async with self._semaphore(kind):
+            if self.cancelled:
+                return ProcessResult(cmd, None, cancelled=True)
+            metrics.subprocess_started(os.path.basename(cmd[0]))
+            # Non-interactive children get their own session, so a Ctrl-C or SIGTERM sent to
+            # our process group reaches only us and we decide whether to stop them
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=stdin,
+                stdout=subprocess.PIPE if on_line else stdout,
+                stderr=subprocess.PIPE if tee else stderr,
+                start_new_session=stdin is not None)
+            self._children[proc] = (kind, group)
+            try:
+                out, err = await asyncio.wait_for(self._communicate(proc, on_line, tee), timeout)
+            except asyncio.TimeoutError:
+                self._kill(proc)
+                await proc.wait()
+                print(f"  {os.path.basename(cmd[0])} timed out after {timeout:.0f}s and was stopped.")
+                return ProcessResult(cmd, proc.returncode, timed_out=True)
+            except BaseException:
+                self._kill(proc)
+                await asyncio.shield(proc.wait())
+                raise
+            finally:
+                self._children.pop(proc, None)
+        if self.cancelled:
+            return ProcessResult(cmd, proc.returncode, cancelled=True)
+        if text:
+            out = out.decode(errors="replace") if out is not None else None
+            err = err.decode(errors="replace") if err is not None else None
+        return ProcessResult(cmd, proc.returncode, out, err)
+
+    async def run_async(self, cmd, kind, timeout=_DEFAULT, stdin=subprocess.DEVNULL, stdout=None, stderr=None,
+                        on_line=None, text=True, retries=0, retry_if=is_throttled, label=None, group=None):
+        """Run `cmd` under the limit for `kind`. Returns a ProcessResult.
+
+        stdout/stderr take what subprocess.run takes, plus stderr=TEE. on_line(line)
+        is called for each line of stdout. While retry_if(result) holds the command
+        is retried up to `retries` times with exponential backoff; the slot is
+        released while waiting. `group` tags the child for pause() and resume().
+        """
+        if timeout is _DEFAULT:
+            timeout = self.timeouts.get(kind)
+        attempt = 0
+        while True:
+            result = await self._run_once(cmd, kind, timeout, stdin, stdout, stderr, on_line, text, group)
+            if result.cancelled or attempt >= retries or not retry_if(result):
+                return result
+            delay = backoff_delay(attempt)
+            attempt += 1
+            print(f"  {label or os.path.basename(cmd[0])} was throttled; retrying in {delay:.0f}s "
+                  f"(attempt {attempt + 1} of {retries + 1})...")
+            await asyncio.sleep(delay)
+
+    def submit(self, cmd, kind, **kwargs):
+        """Start `cmd` in the background. Returns a concurrent.futures.Future of its ProcessResult."""
+        return asyncio.run_coroutine_threadsafe(self.run_async(cmd, kind, **kwargs), self._ensure_loop())
+
+    def run(self, cmd, kind, **kwargs):
+        """Blocking run_async() for code outside the event loop."""
+        future = self.submit(cmd, kind, **kwargs)
+        try:
+            result = future.result()
+        except KeyboardInterrupt:
+            # Ctrl-C while waiting: stop the child before unwinding
+            future.cancel()
+            self.cancel_all()
+            raise
+        if result.cancelled:
+            raise Cancelled()
+        return result
+
+    def cancel_all(self):
+        """Kill every running child; callers waiting on them get Cancelled."""
+        self.cancelled = True
+        loop = self._loop
+        if loop is None:
+            return
+        for proc in list(self._children):
+            loop.call_soon_threadsafe(self._kill, proc)
+
+    def _signal(self, proc, signum):
+        try:
+            # Children in their own session are stopped with everything they started
+            if os.getpgid(proc.pid) == proc.pid:
+                os.killpg(proc.pid, signum)
+            else:
+                proc.send_signal(signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def pause(self, kind, group=None):
+        """Suspend (SIGSTOP) every running child of type `kind`, or only those in `group`.
+
+        Their timeouts keep running.
+        """
+        self._signal_kind(kind, group, signal.SIGSTOP)
+
+    def resume(self, kind, group=None):
+        self._signal_kind(kind, group, signal.SIGCONT)
+
+    def _signal_kind(self, kind, group, signum):
+        loop = self._loop
+        if loop is None:
+            return
+        for proc, (proc_kind, proc_group) in list(self._children.items()):
+            if proc_kind == kind and (group is None or proc_group == group):
+                loop.call_soon_threadsafe(self._signal, proc, signum)
+
+# Process-wide runner used by every tool
+_runner = ProcessRunner()
+
+def configure(**limits):
+    _runner.set_limits(**limits)
+    return _runner
+
+def configure_timeouts(**timeouts):
+    _runner.set_timeouts(**timeouts)
+    return _runner
+
+def run(cmd, kind, **kwargs):
+    return _runner.run(cmd, kind, **kwargs)
+
+async def run_async(cmd, kind, **kwargs):
+    result = await asyncio.wrap_future(_runner.submit(cmd, kind, **kwargs))
+    if result.cancelled:
+        raise Cancelled()
+    return result
+
+def submit(cmd, kind, **kwargs):
+    return _runner.submit(cmd, kind, **kwargs)
+
+def cancel_all():
+    _runner.cancel_all()
+
+def check_cancelled():
+    """Raise Cancelled once cancel_all() was called; for work done in-process rather than in a child."""
+    if _runner.cancelled:
+        raise Cancelled()
+
+def pause(kind, group=None):
+    _runner.pause(kind, group)
+
+def resume(kind, group=None):
+    _runner.resume(kind, group)
@@ -0,0 +1,164 @@
+import hashlib
+import io
+import os
+import random
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aax
+
+ACTIVATION = "1ceb00da"
+SAMPLE_SIZES = (5, 16, 100, 371, 744)
+PER_CHUNK = 10
+
+def box(box_type, payload=b"", wide=False):
+    if wide:
+        return struct.pack(">I4sQ", 1, box_type, 16 + len(payload)) + payload
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def full_box(box_type, payload):
+    return box(box_type, b"\0\0\0\0" + payload)
+
+def sha1(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+def cbc(key, iv, data, encrypt):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+    op = cipher.encryptor() if encrypt else cipher.decryptor()
+    return op.update(data) + op.finalize()
+
+def per_sample(key, iv, sample, encrypt):
+    """Reference AAX sample crypto: one CBC message per sample, the trailing partial block in the clear."""
+    whole = len(sample) & ~15
+    return (cbc(key, iv, sample[:whole], encrypt) if whole else b"") + sample[whole:]
+
+def make_aax(activation=ACTIVATION, nsamples=300, seed=1, mdat_first=False, wide_adrm=False):
+    """A small AAX file: (bytes, plaintext samples, key, iv)."""
+    rng = random.Random(seed)
+    act = bytes.fromhex(activation)
+    key, iv_seed = rng.randbytes(16), rng.randbytes(16)
+    iv = sha1(iv_seed, key, aax.FIXED_KEY)[:16]
+    inter_key = sha1(aax.FIXED_KEY, act)
+    inter_iv = sha1(aax.FIXED_KEY, inter_key, act)
+    blob = act[::-1] + rng.randbytes(4) + key + rng.randbytes(2) + iv_seed + rng.randbytes(14)
+    blob = cbc(inter_key[:16], inter_iv[:16], blob[:48], True) + blob[48:]
+    adrm = rng.randbytes(8) + blob + rng.randbytes(4) + sha1(inter_key[:16], inter_iv[:16]) + rng.randbytes(12)
+
+    plain = [rng.randbytes(rng.choice(SAMPLE_SIZES)) for _ in range(nsamples)]
+    encrypted = [per_sample(key, iv, p, True) for p in plain]
+
+    def moov(data_start):
+        offsets, offset = [], data_start
+        for i in range(0, nsamples, PER_CHUNK):
+            offsets.append(offset)
+            offset += sum(len(e) for e in encrypted[i:i + PER_CHUNK])
+        fields = bytes(6) + struct.pack(">H", 1) + bytes(8) + struct.pack(">HHHHI", 2, 16, 0, 0, 22050 << 16)
+        entry = box(b"aavd", fields + box(b"esds", bytes(30)) + box(b"adrm", adrm, wide_adrm))
+        stbl = box(b"stbl", full_box(b"stsd", struct.pack(">I", 1) + entry)
+                   + full_box(b"stsc", struct.pack(">IIII", 1, 1, PER_CHUNK, 1))
+                   + full_box(b"stsz", struct.pack(">II", 0, nsamples)
+                              + b"".join(struct.pack(">I", len(e)) for e in encrypted))
+                   + full_box(b"stco", struct.pack(">I", len(offsets))
+                              + b"".join(struct.pack(">I", o) for o in offsets)))
+        return box(b"moov", box(b"trak", box(b"mdia", box(b"minf", stbl))))
+
+    ftyp = box(b"ftyp", b"aax \0\0\0\0aax M4B mp42isom")
+    mdat = box(b"mdat", b"".join(encrypted))
+    if mdat_first:
+        data = ftyp + mdat + moov(len(ftyp) + 8)
+    else:
+        header = len(ftyp) + len(moov(0))
+        data = ftyp + moov(header + 8) + mdat
+    return data, plain, key, iv
+
+def reference_decrypt(data, key, iv):
+    """What a decrypted copy should hold: every sample decrypted on its own, the DRM marks removed."""
+    layout = aax.read_layout(data)
+    out = bytearray(data)
+    for offset, size in layout.samples:
+        out[offset:offset + size] = per_sample(key, iv, data[offset:offset + size], False)
+    out[layout.entry_offset + 4:layout.entry_offset + 8] = b"mp4a"
+    _, offset, size, header = layout.adrm
+    out[offset + 4:offset + 8] = b"free"
+    out[offset + header:offset + size] = bytes(size - header)
+    out[layout.ftyp[0] + 8:layout.ftyp[0] + 12] = b"M4B "
+    return bytes(out)
+
+@unittest.skipUnless(aax.available(), "needs the 'cryptography' package")
+class DecryptTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def write(self, name, data):
+        with open(self.path(name), "wb") as f:
+            f.write(data)
+        return self.path(name)
+
+    def read(self, name):
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def test_file_key(self):
+        data, _, key, iv = make_aax()
+        start, end = aax._payload(aax.read_layout(data).adrm)
+        self.assertEqual(aax.file_key(data[start:end], ACTIVATION), (key, iv))
+
+    def test_file_and_stream_match_reference(self):
+        for wide_adrm in (False, True):
+            with self.subTest(wide_adrm=wide_adrm):
+                data, plain, key, iv = make_aax(wide_adrm=wide_adrm)
+                source = self.write("book.aax", data)
+                aax.decrypt_file(source, self.path("file.m4b"), ACTIVATION)
+                aax.decrypt_stream(io.BytesIO(data), self.path("stream.m4b"), ACTIVATION, total=len(data))
+
+                expected = reference_decrypt(data, key, iv)
+                self.assertEqual(self.read("file.m4b"), expected)
+                self.assertEqual(self.read("stream.m4b"), expected)
+                samples = aax.read_layout(data).samples
+                self.assertEqual([expected[o:o + s] for o, s in samples], plain)
+
+    def test_batches_smaller_than_the_file(self):
+        data, _, key, iv = make_aax(nsamples=500)
+        source = self.write("book.aax", data)
+        batch_bytes, aax.BATCH_BYTES = aax.BATCH_BYTES, 1000
+        try:
+            aax.decrypt_file(source, self.path("file.m4b"), ACTIVATION)
+            aax.decrypt_stream(io.BytesIO(data), self.path("stream.m4b"), ACTIVATION)
+        finally:
+            aax.BATCH_BYTES = batch_bytes
+        expected = reference_decrypt(data, key, iv)
+        self.assertEqual(self.read("file.m4b"), expected)
+        self.assertEqual(self.read("stream.m4b"), expected)
+
+    def test_wrong_activation_bytes(self):
+        data, _, _, _ = make_aax()
+        source = self.write("book.aax", data)
+        with self.assertRaisesRegex(aax.AaxError, "mismatch in checksums"):
+            aax.decrypt_file(source, self.path("file.m4b"), "deadbeef")
+        with self.assertRaisesRegex(aax.AaxError, "mismatch in checksums"):
+            aax.decrypt_stream(io.BytesIO(data), self.path("stream.m4b"), "deadbeef")
+
+    def test_mdat_before_moov_is_not_streamable(self):
+        data, _, key, iv = make_aax(mdat_first=True)
+        with self.assertRaises(aax.NotStreamable) as caught:
+            aax.decrypt_stream(io.BytesIO(data), self.path("stream.m4b"), ACTIVATION)
+        self.assertTrue(data.startswith(caught.exception.head))
+        self.assertFalse(os.path.exists(self.path("stream.m4b")))
+        # The whole file can still be decrypted from disk
+        aax.decrypt_file(self.write("book.aax", data), self.path("file.m4b"), ACTIVATION)
+        self.assertEqual(self.read("file.m4b"), reference_decrypt(data, key, iv))
+
+if __name__ == "__main__":
+    unittest.main()
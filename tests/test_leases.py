@@ -0,0 +1,120 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import leases
+
+KEY = "B000000001"
+
+class LeaseTableTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+
+    def table(self, node, ttl=60.0, start=False):
+        table = leases.LeaseTable(self.tmp.name, node=node, ttl=ttl)
+        self.tables.append(table)
+        os.makedirs(self.tmp.name, exist_ok=True)
+        return table.start() if start else table
+
+    def age_lease(self, table, key, seconds):
+        """Make the lease on `key` look like it was last renewed `seconds` ago."""
+        mtime = table.volume_time() - seconds
+        os.utime(table.path(key), (mtime, mtime))
+
+    def test_fresh_lease_is_not_taken_over(self):
+        a, b = self.table("a"), self.table("b")
+        self.assertTrue(a.acquire(KEY))
+        self.age_lease(a, KEY, a.ttl / 2)
+        self.assertFalse(b.acquire(KEY))
+        self.assertEqual(b.holder(KEY), "a")
+        self.assertTrue(a.held(KEY))
+
+    def test_stale_lease_is_taken_over(self):
+        a, b = self.table("a"), self.table("b")
+        self.assertTrue(a.acquire(KEY))
+        self.age_lease(a, KEY, a.ttl + 5)
+        self.assertIsNone(b.holder(KEY))
+        self.assertTrue(b.acquire(KEY))
+        self.assertTrue(b.held(KEY))
+        self.assertFalse(a.held(KEY))
+        # The holder that was taken over must not remove the new lease
+        a.release(KEY)
+        self.assertTrue(b.held(KEY))
+        self.assertEqual(os.listdir(self.tmp.name).count(KEY + leases.LEASE_SUFFIX), 1)
+
+    def test_racing_takers_win_once(self):
+        for attempt in range(20):
+            with self.subTest(attempt=attempt):
+                key = f"{KEY}-{attempt}"
+                dead = self.table(f"dead-{attempt}")
+                self.assertTrue(dead.acquire(key))
+                self.age_lease(dead, key, dead.ttl + 5)
+                takers = [self.table(f"taker-{attempt}-{i}") for i in range(6)]
+                barrier = threading.Barrier(len(takers))
+                results = [None] * len(takers)
+
+                def take(i):
+                    barrier.wait()
+                    results[i] = takers[i].acquire(key)
+
+                threads = [threading.Thread(target=take, args=(i,)) for i in range(len(takers))]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(results.count(True), 1)
+                self.assertEqual(sum(t.held(key) for t in takers), 1)
+                self.assertFalse([n for n in os.listdir(self.tmp.name) if n.endswith(".stale")])
+
+    def test_lease_renewed_between_check_and_rename_is_handed_back(self):
+        a, b, c = self.table("a"), self.table("b"), self.table("c")
+        self.assertTrue(a.acquire(KEY))
+        self.age_lease(a, KEY, a.ttl + 5)
+        real_age = c._age
+        calls = []
+
+        def age(path):
+            calls.append(path)
+            if len(calls) == 1:
+                # c has just seen the stale lease; b takes it over before c renames it
+                self.assertTrue(b.acquire(KEY))
+                return c.ttl + 5
+            return real_age(path)
+
+        c._age = age
+        self.assertFalse(c.acquire(KEY))
+        self.assertTrue(b.held(KEY))
+        self.assertFalse(c.held(KEY))
+
+    @mock.patch.object(leases, "MIN_TTL", 0.0)
+    def test_heartbeat_keeps_lease_alive(self):
+        a = self.table("a", ttl=0.6, start=True)
+        b = self.table("b", ttl=0.6)
+        self.assertTrue(a.acquire(KEY))
+        time.sleep(a.ttl * 2.5)
+        self.assertFalse(b.acquire(KEY))
+        self.assertEqual(b.holder(KEY), "a")
+        self.assertIn("a", b.live_nodes())
+
+        # Without a heartbeat the same lease goes stale and can be taken over
+        a._stop.set()
+        a._thread.join()
+        time.sleep(a.ttl * 1.5)
+        self.assertNotIn("a", b.live_nodes())
+        self.assertTrue(b.acquire(KEY))
+        self.assertFalse(a.held(KEY))
+
+if __name__ == "__main__":
+    unittest.main()
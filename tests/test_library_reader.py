@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import library_reader
+
+BOOKS = [
+    {"asin": "B000000001", "title": "It", "authors": "A. Author", "series_title": None,
+     "runtime_length_min": 2.5},
+    {"asin": "B000000002", "title": "Two Parts", "authors": ["A", "B"], "series_title": "Saga",
+     "runtime_length_min": 613},
+    {"asin": "B000000003", "title": "Unknown Length", "runtime_length_min": None},
+]
+
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "library.json")
+        with open(self.path, "w") as f:
+            json.dump(BOOKS, f)
+
+    def test_sidecar_round_trips_values_and_types(self):
+        parsed = library_reader.read_books(self.path)
+        mapped = library_reader.read_books(self.path)
+        self.assertIsInstance(mapped, library_reader.CompactLibrary)
+        try:
+            for book, fresh in zip(mapped, parsed):
+                for name in library_reader.FIELDS:
+                    self.assertEqual(book[name], fresh[name])
+                    self.assertIs(type(book[name]), type(fresh[name]))
+            self.assertEqual(mapped[0]["runtime_length_min"], 2.5)
+            self.assertEqual(mapped[1]["runtime_length_min"], 613)
+        finally:
+            mapped.close()
+
+    def test_older_sidecar_is_rebuilt(self):
+        library_reader.read_books(self.path)
+        sidecar = self.path + library_reader.SIDECAR_SUFFIX
+        with open(sidecar, "r+b") as f:
+            f.write(b"VALIB001")
+        self.assertIsNone(library_reader.open_sidecar(self.path))
+        books = library_reader.read_books(self.path)
+        self.assertEqual(books[0]["runtime_length_min"], 2.5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_library
+
+MB = 1024 * 1024
+
+def make_jobs(count, estimated=MB):
+    jobs = []
+    for i in range(count):
+        asin = f"B00000000{i}"
+        jobs.append({"asin": asin, "title": f"Book {i}", "book": {"asin": asin, "title": f"Book {i}"},
+                     "source_files": [], "estimated_bytes": estimated})
+    return jobs
+
+class RunPipelineTest(unittest.TestCase):
+    def run_pipeline(self, jobs, budget, download):
+        ws = types.SimpleNamespace(stream=False, leases=None)
+        converted = []
+        with mock.patch.object(process_library, "download_sources", side_effect=download), \
+             mock.patch.object(process_library, "convert_sources",
+                               side_effect=lambda ws, job, *args: converted.append(job["asin"])), \
+             mock.patch.object(process_library, "files_size", return_value=MB):
+            asyncio.run(asyncio.wait_for(
+                process_library.run_pipeline(ws, jobs, budget, 1, 1, 2), timeout=10))
+        return converted
+
+    def test_failed_download_releases_its_reservation(self):
+        jobs = make_jobs(3)
+        budget = process_library.DiskBudget(MB)
+
+        def download(ws, job, prefix=""):
+            if job["asin"] == jobs[0]["asin"]:
+                raise FileNotFoundError(2, "No such file or directory", "audible")
+            return [f"{job['asin']}.aax"]
+
+        with mock.patch("builtins.print"):
+            converted = self.run_pipeline(jobs, budget, download)
+        self.assertEqual(converted, [job["asin"] for job in jobs[1:]])
+        self.assertEqual(budget.pending, 0)
+
+    def test_cap_holds_downloads_back_until_converted(self):
+        jobs = make_jobs(4)
+        budget = process_library.DiskBudget(MB)
+        highest = []
+
+        def download(ws, job, prefix=""):
+            highest.append(budget.pending)
+            return [f"{job['asin']}.aax"]
+
+        with mock.patch("builtins.print"):
+            converted = self.run_pipeline(jobs, budget, download)
+        self.assertEqual(len(converted), 4)
+        self.assertLessEqual(max(highest), MB)
+        self.assertEqual(budget.pending, 0)
+
+if __name__ == "__main__":
+    unittest.main()
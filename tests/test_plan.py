@@ -0,0 +1,68 @@
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOOKS = [
+    {"asin": "B000000001", "title": "First Book", "authors": "A. Author", "runtime_length_min": 60},
+    {"asin": "B000000002", "title": "Second Book", "authors": "B. Author", "series_title": "Saga",
+     "runtime_length_min": 90.5},
+]
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def snapshot(directory):
+    """Every file and directory below `directory`, with size and mtime."""
+    listing = {}
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            listing[os.path.relpath(path, directory)] = (st.st_size, st.st_mtime_ns)
+    return listing
+
+class PlanTest(unittest.TestCase):
+    """A plan reads the directory but never changes it."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+        os.makedirs(os.path.join(self.dir, "audiobooks"))
+        for library in ("library.json", os.path.join("audiobooks", "library.json")):
+            with open(os.path.join(self.dir, library), "w") as f:
+                json.dump(BOOKS, f)
+        source = box(b"ftyp", b"aax ") + box(b"moov", b"m" * 100) + box(b"mdat", b"x" * 1000)
+        with open(os.path.join(self.dir, "Second_Book-LC_64_22050_stereo.aax"), "wb") as f:
+            f.write(source)
+        with open(os.path.join(self.dir, "audiobooks", "First Book.m4b"), "wb") as f:
+            f.write(box(b"ftyp", b"M4B ") + box(b"moov", b"") + box(b"mdat", b"y" * 100))
+
+    def plan(self, script, *args):
+        env = dict(os.environ, AUDIBLE_CONFIG_DIR=os.path.join(self.dir, ".audible"))
+        before = snapshot(self.dir)
+        result = subprocess.run([sys.executable, os.path.join(REPO, script)] + list(args) + ["--plan", "-"],
+                                cwd=self.dir, env=env, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(snapshot(self.dir), before)
+        return json.loads(result.stdout)
+
+    def test_process_library_plan_leaves_the_directory_alone(self):
+        plan = self.plan("process_library.py", "default")
+        self.assertEqual({e["asin"]: e["action"] for e in plan["entries"]},
+                         {"B000000001": "download", "B000000002": "convert"})
+
+    def test_rename_books_plan_leaves_the_directory_alone(self):
+        self.plan("rename_books.py")
+
+    def test_rename_from_library_plan_leaves_the_directory_alone(self):
+        self.plan("rename_from_library.py")
+
+if __name__ == "__main__":
+    unittest.main()
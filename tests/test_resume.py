@@ -0,0 +1,132 @@
+import os
+import struct
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audible_api
+import process_library
+import streaming
+from downloads import DownloadManifest, PART_SUFFIX, partial_file, verify_source
+
+ASIN = "B000000001"
+CODEC = "AAX_44_128"
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+SOURCE = box(b"ftyp", b"aax ") + box(b"moov", b"m" * 100) + box(b"mdat", bytes(range(256)) * 64)
+
+class HTTPError(Exception):
+    pass
+
+class Response:
+    def __init__(self, data, status_code, fail_after):
+        self.data = data
+        self.status_code = status_code
+        self.fail_after = fail_after
+        self.headers = {"Content-Length": str(len(data))}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_bytes(self, size):
+        for start in range(0, len(self.data), 1000):
+            if self.fail_after is not None and start >= self.fail_after:
+                raise HTTPError("connection reset")
+            yield self.data[start:start + 1000]
+
+    def close(self):
+        pass
+
+class CDN:
+    """Serves SOURCE like the CDN does, honouring Range requests, and breaks off once if asked to."""
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.ranges = []
+
+    def client(self, **kwargs):
+        cdn = self
+
+        class Client:
+            def build_request(self, method, url, headers=None):
+                return headers or {}
+
+            def send(self, headers, stream=False):
+                cdn.ranges.append(headers.get("Range"))
+                offset = int(headers["Range"][len("bytes="):-1]) if "Range" in headers else 0
+                fail_after, cdn.fail_after = cdn.fail_after, None
+                return Response(SOURCE[offset:], 206 if offset else 200, fail_after)
+
+            def close(self):
+                pass
+
+        return Client()
+
+class ApiClient:
+    def __init__(self, auth=None):
+        self.session = types.SimpleNamespace(
+            head=lambda *args, **kwargs: types.SimpleNamespace(status_code=302,
+                                                               headers={"Location": "https://cds.audible.com/x"}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def get(self, path, **params):
+        return {"item": {"available_codecs": [{"name": CODEC.lower()}]}}
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.staging = self.tmp.name
+        self.ws = types.SimpleNamespace(profile_name="default",
+                                        scheduler=types.SimpleNamespace(throttle=lambda nbytes: None))
+        self.job = {"asin": ASIN, "title": "Book One"}
+        auth = types.SimpleNamespace(locale=types.SimpleNamespace(domain="com"))
+        for patcher in (mock.patch.object(audible_api, "available", return_value=True),
+                        mock.patch.object(streaming, "load_auth", return_value=auth),
+                        mock.patch.object(streaming, "audible", types.SimpleNamespace(Client=ApiClient)),
+                        mock.patch("builtins.print")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch(self, cdn):
+        httpx = types.SimpleNamespace(Client=cdn.client, Timeout=lambda *args, **kwargs: None, HTTPError=HTTPError)
+        with mock.patch.object(streaming, "httpx", httpx):
+            return process_library.fetch_aax(self.ws, self.job, self.staging, DownloadManifest(self.staging))
+
+    def test_interrupted_download_resumes_with_a_range_request(self):
+        half = len(SOURCE) // 2 // 1000 * 1000
+        cdn = CDN(fail_after=half)
+        # Bytes have arrived, so the CLI is not started to fetch it all over again
+        self.assertTrue(self.fetch(cdn))
+        part = partial_file(self.staging)
+        self.assertEqual(os.path.getsize(part), half)
+        entry = DownloadManifest(self.staging).data["files"][os.path.basename(part)]
+        self.assertEqual((entry["size"], entry["expected_size"]), (half, len(SOURCE)))
+
+        self.assertTrue(self.fetch(cdn))
+        self.assertEqual(cdn.ranges, [None, f"bytes={half}-"])
+        path = part[:-len(PART_SUFFIX)]
+        self.assertTrue(path.endswith(f"-{CODEC}.aax"))
+        self.assertIsNone(partial_file(self.staging))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), SOURCE)
+        self.assertEqual(verify_source(path), (True, ""))
+        self.assertEqual(DownloadManifest(self.staging).data["files"], {})
+
+    def test_failure_before_any_data_falls_back_to_the_cli(self):
+        self.assertFalse(self.fetch(CDN(fail_after=0)))
+        self.assertIsNone(partial_file(self.staging))
+
+if __name__ == "__main__":
+    unittest.main()